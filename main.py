@@ -8,6 +8,7 @@ sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
 from src.agent.graph import GenerativeAgent
 from src.world.environment import World
+from src.warmup import warmup
 
 async def main():
     # 清除螢幕
@@ -34,6 +35,9 @@ async def main():
         collection_name="text_sim_fixed_v1" # 改個名字確保記憶乾淨
     )
     
+    # 預熱: 載入 embedding 模型、預先 embed 固定檢索句、讓遠端與本地 LLM 常駐
+    await warmup([agent_name])
+
     # 3. 設定初始狀態
     current_time = datetime.strptime("2025-06-01 08:00", "%Y-%m-%d %H:%M")
     
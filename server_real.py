@@ -1,24 +1,68 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from datetime import datetime, timedelta
+import asyncio
 from contextlib import asynccontextmanager
 import sys
 import os
 
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
-from src.agent.graph import GenerativeAgent
+from src.agent.graph import EARLY_RETRACTED, EARLY_TENTATIVE, GenerativeAgent
 from src.world.environment import World
+from src.executors import executor_stats
+from src.warmup import warmup
+from src.ollama_pool import close_ollama_clients
+from src.llm_scheduler import scheduler_stats
+from src.llm_router import router_stats
+from src.llm_telemetry import load_records, summarize
+from src.tracing import export_chrome_trace, format_breakdown, span, tick_breakdowns, tracing_enabled
+from src.config import config
 
 simulation_data = {
     "world": None,
     "agents": {},
     "current_time": datetime.strptime("2025-06-01 08:00", "%Y-%m-%d %H:%M"),
-    "agent_states": {}
+    "agent_states": {},
+    "pending_actions": {}, # 串流中已先決定的行動 (status: tentative / confirmed，Godot 可以在 /agent/decide 回應前先開始移動)
+    "warmup": None
 }
 
+def on_early_action(agent_name: str, status: str, fields: dict):
+    """
+    react 串流中行動欄位一完成就先移動 agent (暫定)，不等 reason / should_replan 生成完
+    完整決策驗證後確認；撤回時 (決策不同 / 解析失敗 / 逾時) 把 agent 移回原本的地點，
+    之後 /agent/decide 再依最終決策移動
+    """
+    world = simulation_data["world"]
+    state = simulation_data["agent_states"][agent_name]
+    pending = simulation_data["pending_actions"]
+    if status == EARLY_TENTATIVE:
+        pending[agent_name] = {**fields, "status": status, "moved_from": None}
+        target_loc_id = fields.get("target_location_id")
+        if target_loc_id and target_loc_id in world.locations_map and target_loc_id != state["last_location"]:
+            print(f"   🚶 [提前] 移動: {state['last_location']} -> {target_loc_id}")
+            pending[agent_name]["moved_from"] = state["last_location"]
+            world.move_agent(agent_name, target_loc_id)
+            state["last_location"] = target_loc_id
+        return
+    entry = pending.get(agent_name)
+    if entry is None:
+        return
+    if status == EARLY_RETRACTED and entry["moved_from"]:
+        print(f"   ↩️ [撤回] 移回: {state['last_location']} -> {entry['moved_from']}")
+        world.move_agent(agent_name, entry["moved_from"])
+        state["last_location"] = entry["moved_from"]
+    if status == EARLY_RETRACTED:
+        pending.pop(agent_name, None)
+    else:
+        entry["status"] = status
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    # 模型載入 / 遠端 LLM 暖機放到背景，lifespan 不等它完成
+    simulation_data["warmup"] = asyncio.create_task(warmup(["Klaus"]))
+
     print("🌍 [Server] 初始化 Data-Driven World...")
     simulation_data["world"] = World("world_config.json")
     
@@ -30,6 +74,7 @@ async def lifespan(app: FastAPI):
         summary="Klaus 是成大學生，住在宿舍。生活規律，喜歡整潔。",
         collection_name="godot_klaus_final_v4"
     )
+    klaus.add_action_listener(on_early_action)
     simulation_data["agents"]["Klaus"] = klaus
     simulation_data["agent_states"]["Klaus"] = {
         "daily_plan": [],
@@ -39,6 +84,10 @@ async def lifespan(app: FastAPI):
     }
     print("✅ [Server] 系統就緒！")
     yield
+    simulation_data["warmup"].cancel()
+    close_ollama_clients()
+    if tracing_enabled():
+        export_chrome_trace()
 
 app = FastAPI(lifespan=lifespan)
 app.add_middleware(
@@ -53,6 +102,59 @@ app.add_middleware(
 async def get_world_map():
     return simulation_data["world"].get_map_config()
 
+# 👇 各 executor 的 queue 深度 (embedding / 向量庫 I/O / LLM)
+@app.get("/metrics/executors")
+async def get_executor_metrics():
+    return executor_stats()
+
+# 👇 LLM 排程器狀態 (各 host 的執行中 / 排隊數量 / 各優先權的平均等待時間)
+@app.get("/metrics/llm")
+async def get_llm_metrics():
+    return scheduler_stats()
+
+# 👇 模型路由: 各後端的成功 / 失敗 / 超出預算次數，與目前是否暫停使用
+@app.get("/metrics/router")
+async def get_router_metrics():
+    return router_stats()
+
+# 👇 各 node (role) 的 LLM 延遲百分位數、prefill / decode 時間與 tokens/sec (需設定 LLM_TELEMETRY_PATH)
+@app.get("/metrics/telemetry")
+async def get_llm_telemetry(by: str = "role"):
+    path = config.LLM_TELEMETRY_PATH
+    if not path or not os.path.exists(path):
+        return {}
+    records = await asyncio.to_thread(load_records, path)
+    return summarize(records, by=by)
+
+# 👇 最近幾個 tick 各 node / 操作的時間分佈 (需設定 TRACE_ENABLED=1)
+@app.get("/metrics/ticks")
+async def get_tick_metrics(last: int = 20):
+    return tick_breakdowns(last)
+
+# 👇 把目前累積的 span 匯出成 Chrome trace (chrome://tracing / ui.perfetto.dev 開啟)
+@app.post("/trace/export")
+async def export_trace():
+    count = await asyncio.to_thread(export_chrome_trace)
+    return {"spans": count, "path": config.TRACE_PATH}
+
+# 👇 react 決策延遲 (time-to-first-action / 完整輸出)
+@app.get("/metrics/react")
+async def get_react_metrics():
+    return {name: agent.react_metrics() for name, agent in simulation_data["agents"].items()}
+
+# 👇 細部計畫的語意快取命中率
+@app.get("/metrics/plan_cache")
+async def get_plan_cache_metrics():
+    return {
+        name: agent.planner.plan_cache.stats() if agent.planner.plan_cache else None
+        for name, agent in simulation_data["agents"].items()
+    }
+
+# 👇 Godot 在等待 /agent/decide 時可以輪詢，提前取得移動目標
+@app.get("/agent/pending")
+async def get_pending_action():
+    return simulation_data["pending_actions"]
+
 @app.get("/agent/decide")
 async def agent_decide():
     klaus = simulation_data["agents"]["Klaus"]
@@ -77,7 +179,12 @@ async def agent_decide():
     }
     
     print(f"\n🧠 Processing Tick: {current_time}")
-    result = await klaus.graph.ainvoke(agent_input)
+    simulation_data["pending_actions"].pop(klaus.name, None)
+    with span("tick", cat="tick", agent=klaus.name, sim_time=agent_input["current_time"]):
+        result = await klaus.graph.ainvoke(agent_input)
+    simulation_data["pending_actions"].pop(klaus.name, None)
+    if tracing_enabled():
+        print(format_breakdown(tick_breakdowns(1)[-1]))
     
     # 2. 更新狀態
     state["daily_plan"] = result.get("daily_plan", [])
@@ -1,16 +1,82 @@
 import json
 import asyncio
-import re 
+import inspect
+import time
+from collections import deque
 from datetime import datetime, timedelta
-from langgraph.graph import StateGraph, END
-from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.output_parsers import JsonOutputParser
+from typing import Any, Callable, Dict, List, Optional
+from pydantic import BaseModel, Field
 
 from src.agent.state import AgentState
+from src.agent.prompting import ContextBudget, Section, get_prompt, memory_lines
 from src.memory.retriever import GenerativeRetriever
 from src.agent.planning import Planner
+from src.agent.plan_repair import PlanRepairer, ESCALATE, REPAIRED
+from src.agent.similarity import embed_for_similarity
 from src.agent.reflection import Reflector
 from src.llm_factory import get_llm
+from src.config import config
+from src.llm_scheduler import llm_deadline_at, set_llm_agent
+from src.llm_telemetry import llm_node_attempt
+from src.tracing import traced
+from src.json_repair import IncrementalJsonObject, RepairingJsonParser
+
+class ReactDecision(BaseModel):
+    """
+    react_node 的輸出結構 (同時是送給 Ollama 的 JSON schema)
+    欄位順序即生成順序: 推進世界需要的欄位放前面，串流時可以先送出
+    EARLY_ACTION_FIELDS 都是必填 (不用的目標填 null)，schema 限制輸出時一定會生成，提前行動才會觸發
+    """
+    action: str = Field(description="繁體中文描述行動 (1句話)")
+    target_location_id: Optional[str] = Field(description="要移動過去的地點 ID，不移動時為 null")
+    target_object_id: Optional[str] = Field(description="要操作的物品 ID，不操作時為 null")
+    duration: int = Field(description="持續時間 (分鐘)")
+    emoji: str = Field(default="🤖", description="表情")
+    reason: str = Field(default="", description="原因")
+    should_replan: bool = Field(default=False, description="是否需要重新規劃今天的計畫")
+
+# 這些欄位都生成完就可以先讓世界 / Godot 開始移動 (reason 等欄位還在生成中)
+EARLY_ACTION_FIELDS = ("action", "target_location_id", "target_object_id", "duration")
+
+# react_node 的 prompt (模板是常數，編譯結果由 get_prompt 快取)
+# 固定前綴: 身分、地圖與規則，同一個 agent 每個 tick 都完全相同 (可重用伺服器端的 KV cache)
+REACT_SYSTEM = """
+        你是 {agent_name}。背景: {agent_summary}。
+        
+        [地圖資訊]
+        {world_desc}
+        
+        **導航與行動規則 (請嚴格遵守)**:
+        1. **優先檢查地點**：看一眼 [當前計畫] 的「建議地點」。如果你現在不在那個地點，請優先設定 `target_location_id` 移動過去。
+        2. **到達後操作**：如果你已經在正確地點，則尋找該地點的物品進行操作 (設定 `target_object_id`)。
+        3. **填寫 JSON** (action 用繁體中文 1 句話，duration 以分鐘計):
+           - 移動時: `target_location_id` 填 ID (如 'bedroom'), `target_object_id` 填 null。
+           - 操作時: `target_location_id` 填 null, `target_object_id` 填 ID (如 'bed')。
+        """
+
+# 每個 tick 變動的部分
+REACT_TEMPLATE = """
+        時間: {current_time}。
+        
+        [當前計畫]
+        {plan_ctx}
+        
+        [相關記憶]
+        {memories}
+        
+        [目前的觀察]
+        {observations}
+        
+        請決定你現在的行動。
+        """
+
+# 提前行動的狀態: 串流中先送出 (暫定)，完整輸出驗證後確認或撤回
+EARLY_TENTATIVE = "tentative"
+EARLY_CONFIRMED = "confirmed"   # 最終決策的行動欄位與暫定的相同
+EARLY_RETRACTED = "retracted"   # 最終決策不同或解析失敗 / 逾時，暫定行動造成的變更要復原
+
+# on_action(agent_name, status, fields): fields 只包含 EARLY_ACTION_FIELDS (暫定的內容)，可以是一般函式或 coroutine function
+ActionListener = Callable[[str, str, Dict[str, Any]], Any]
 
 class GenerativeAgent:
     def __init__(self, name: str, summary: str, collection_name: str):
@@ -18,17 +84,27 @@ class GenerativeAgent:
         self.summary = summary
         
         # 初始化各模組
-        self.retriever = GenerativeRetriever(collection_name=collection_name)
+        # MEMORY_SHARED_COLLECTION 有設定時，所有 agent 共用一個 store，以 agent 名稱分區
+        self.retriever = GenerativeRetriever(collection_name=collection_name, agent_id=name)
         self.planner = Planner(self.retriever)
+        self.plan_repairer = PlanRepairer(embed_for_similarity)
         self.reflector = Reflector(self.retriever)
         
         # 決策用模型 (通常是慢思考/大模型)
-        self.llm = get_llm(temperature=0.4, json_mode=True)
+        self.llm = get_llm(temperature=0.4, json_mode=True, role="react")
+        # 輸出由 Ollama 依 ReactDecision 的 JSON schema 限制，本地只需做容錯修復
+        self.react_llm = self.llm.with_schema(ReactDecision)
+
+        # 串流決策: 行動欄位一完成就通知 listener，並記錄 time-to-first-action
+        self.action_listeners: List[ActionListener] = []
+        self._ttfa_ms: deque = deque(maxlen=256)
+        self._react_ms: deque = deque(maxlen=256)
         
         # 編譯 Graph
         self.graph = self._build_graph()
 
     def _build_graph(self):
+        from langgraph.graph import StateGraph, END # 延遲 import，建立 agent 時才載入 langgraph
         workflow = StateGraph(AgentState)
 
         # 定義 node
@@ -53,6 +129,13 @@ class GenerativeAgent:
         return workflow.compile()
 
 # 輔助方法 (請放在 class 內)
+    def _parse_time(self, current_time_str: str):
+        """解析模擬時間，失敗時回傳 None (由 retriever 退回系統時間)"""
+        try:
+            return datetime.strptime(current_time_str, "%Y-%m-%d %I:%M %p")
+        except ValueError:
+            return None
+
     def _get_current_block(self, daily_plan: list, current_time_str: str):
         """找出當下應該執行的 Daily Plan Block (包含結束時間計算)"""
         try:
@@ -81,12 +164,15 @@ class GenerativeAgent:
         except: return None
 
     # Perceive Node 核心
+    @traced("perceive_node", cat="node")
     async def perceive_node(self, state: AgentState):
         print(f"\n👀 {state['agent_name']} 正在感知世界...")
+        set_llm_agent(state["agent_name"]) # LLM 排程器依 agent 輪流
         
-        # 1. 儲存觀察
+        # 1. 儲存觀察 (以模擬時間作為 created_at，才能做時間範圍檢索)
+        sim_now = self._parse_time(state["current_time"])
         for obs in state["observations"]:
-            await self.retriever.add_memory(obs)
+            await self.retriever.add_memory(obs, created_at=sim_now)
 
         # 2. 檢查是否忙碌 (Persistence Check)
         # 目前使用簡單字串規則判斷是否為例行公事 (is_routine)
@@ -143,19 +229,27 @@ class GenerativeAgent:
                 state["agent_name"],
                 current_activity_name,
                 curr_block['start_time'],
-                curr_block.get("calculated_end_time", "Unknown")
+                curr_block.get("calculated_end_time", "Unknown"),
+                state["current_time"]
             )
             if subtasks:
                 short = [t.dict() for t in subtasks]
 
+        # 6. 規劃 (冷路徑) 結束後才開始計算本 tick 的思考預算
+        tick_deadline = None
+        if config.LLM_TICK_BUDGET > 0:
+            tick_deadline = asyncio.get_running_loop().time() + config.LLM_TICK_BUDGET
+
         return {
             "daily_plan": daily,
             "short_term_plan": short,
             "busy_until": None, 
             "skip_thinking": False,
+            "tick_deadline": tick_deadline,
             "current_daily_block_activity": current_activity_name # 更新當前任務
         }
 
+    @traced("retrieve_node", cat="node")
     async def retrieve_node(self, state: AgentState):
         """
         檢索節點
@@ -166,14 +260,89 @@ class GenerativeAgent:
         observations_str = ", ".join(state["observations"])
         query = f"情境: {observations_str}. {state['agent_name']} 接下來該做什麼?"
         
-        memories = await self.retriever.retrieve(query, k=5)
+        memories = await self.retriever.retrieve(query, now=self._parse_time(state["current_time"]), k=5)
         return {"relevant_memories": memories}
 
+    def add_action_listener(self, listener: ActionListener):
+        """
+        註冊提前行動的 callback: 串流中行動欄位一完成就以 EARLY_TENTATIVE 呼叫 (每次決策最多一次)，
+        之後一定會再以 EARLY_CONFIRMED 或 EARLY_RETRACTED 呼叫一次
+        """
+        self.action_listeners.append(listener)
+
+    async def _emit_early_action(self, agent_name: str, status: str, fields: Dict[str, Any]):
+        for listener in self.action_listeners:
+            try:
+                result = listener(agent_name, status, fields)
+                if inspect.isawaitable(result):
+                    await result
+            except Exception as e:
+                print(f"   ⚠️ 提前行動 callback 失敗: {e}")
+
+    async def _stream_decision(self, chain, inputs: Dict[str, Any], agent_name: str) -> ReactDecision:
+        """
+        串流取得決策: 以增量 JSON 解析追蹤已完成的欄位，
+        EARLY_ACTION_FIELDS 全部完成時先以暫定行動通知 listener，整段輸出完成後再做完整驗證:
+        驗證通過且行動欄位相同 ---> 確認；不同、解析失敗或中途逾時 / 取消 ---> 撤回
+        """
+        start = time.perf_counter()
+        fields = IncrementalJsonObject()
+        chunks = []
+        first_action_at = None
+        tentative: Optional[Dict[str, Any]] = None
+        try:
+            async for chunk in chain.astream(inputs):
+                chunks.append(chunk.content)
+                if first_action_at is not None:
+                    continue
+                fields.feed(chunk.content)
+                if all(f in fields.fields for f in EARLY_ACTION_FIELDS):
+                    first_action_at = time.perf_counter()
+                    tentative = {f: fields.fields[f] for f in EARLY_ACTION_FIELDS}
+                    print(f"   ⚡ 提前行動 (暫定): {tentative['action']} ({(first_action_at - start) * 1000:.0f}ms)")
+                    await self._emit_early_action(agent_name, EARLY_TENTATIVE, tentative)
+            decision = RepairingJsonParser(pydantic_object=ReactDecision).parse("".join(chunks))
+        except BaseException:
+            if tentative is not None:
+                print(f"   ↩️ 撤回提前行動: {tentative['action']}")
+                await asyncio.shield(self._emit_early_action(agent_name, EARLY_RETRACTED, tentative))
+            raise
+        if tentative is not None:
+            final = decision.model_dump(include=set(EARLY_ACTION_FIELDS))
+            if final == tentative:
+                await self._emit_early_action(agent_name, EARLY_CONFIRMED, tentative)
+            else:
+                print(f"   ↩️ 最終決策與提前行動不同，撤回: {tentative['action']}")
+                await self._emit_early_action(agent_name, EARLY_RETRACTED, tentative)
+        end = time.perf_counter()
+        # 沒能提前取得行動時，first action 就是整段輸出完成的時間
+        self._ttfa_ms.append(((first_action_at or end) - start) * 1000)
+        self._react_ms.append((end - start) * 1000)
+        return decision
+
+    def react_metrics(self) -> Dict[str, Any]:
+        """最近的決策延遲: time-to-first-action 與完整輸出時間 (毫秒)"""
+        def summarize(samples) -> Dict[str, Any]:
+            if not samples:
+                return {"count": 0}
+            ordered = sorted(samples)
+            return {
+                "count": len(ordered),
+                "mean": round(sum(ordered) / len(ordered), 1),
+                "p50": round(ordered[len(ordered) // 2], 1),
+                "p95": round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 1),
+            }
+        return {
+            "time_to_first_action_ms": summarize(self._ttfa_ms),
+            "full_decision_ms": summarize(self._react_ms),
+        }
+
+    @traced("react_node", cat="node")
     async def react_node(self, state: AgentState):
         print(f"   🤔 決定行動...")
+        set_llm_agent(state["agent_name"])
         
         # 1. 準備 Context
-        memories_text = "\n".join([f"- {m.page_content}" for m in state["relevant_memories"]])
         world_desc = state.get("world_map_desc", "")
         
         short = state.get("short_term_plan", [])
@@ -194,130 +363,134 @@ class GenerativeAgent:
         else:
             plan_ctx = "目前沒有具體計畫。"
 
-        # 2. 構建 Prompt
-        prompt = ChatPromptTemplate.from_template("""
-        你是 {agent_name}。背景: {agent_summary}。時間: {current_time}。
-        
-        [地圖資訊]
-        {world_desc}
+        # 2. 依 token 預算組裝各區塊 (觀察與計畫最重要，記憶最先被截斷)
+        #    地圖在固定前綴中: min_tokens = max_tokens，不會因為其他區塊的長度而被截斷，前綴才會每個 tick 都相同
+        ctx = ContextBudget("react").fit([
+            Section("world_desc", world_desc.splitlines(), max_tokens=800, priority=0, min_tokens=800),
+            Section("plan_ctx", plan_ctx.splitlines(), max_tokens=400, priority=0),
+            Section("observations", list(state["observations"]), max_tokens=500, priority=0, dedupe=True),
+            Section("memories", memory_lines(state["relevant_memories"]), max_tokens=600, priority=2,
+                    dedupe=True, empty="(沒有相關記憶)"),
+        ], template=REACT_SYSTEM + REACT_TEMPLATE)
+        prompt = get_prompt(REACT_TEMPLATE, REACT_SYSTEM)
         
-        [當前計畫]
-        {plan_ctx}
+        # 3. 串流執行 LLM (輸出結構由 schema 限制，重試只是保險)
+        #    請求受本 tick 的 deadline 限制，逾時時排隊中 / 執行中的請求都會被取消
+        chain = prompt | self.react_llm
+        max_retries = 2
+        tick_deadline = state.get("tick_deadline")
         
-        [相關記憶]
-        {memories}
-        
-        [目前的觀察]
-        {observations}
+        # 重試與 deadline 只涵蓋 LLM 呼叫；之後的副作用 (寫記憶 / 重規劃) 只執行一次
+        decision = None
+        for attempt in range(max_retries):
+            try:
+                # telemetry 記錄這是 react_node 的第幾次嘗試
+                with llm_deadline_at(tick_deadline), llm_node_attempt(attempt):
+                    decision = await self._stream_decision(chain, {
+                        "agent_name": state["agent_name"], "agent_summary": state["agent_summary"],
+                        "current_time": state["current_time"], **ctx
+                    }, state["agent_name"])
+                break
+            except TimeoutError:
+                # deadline 已到，不再重試
+                print(f"   ⏰ 超過本 tick 的思考預算，執行備用行動。")
+                return self._fallback_action(state)
+            except Exception as e:
+                print(f"   ⚠️ JSON 解析失敗 (嘗試 {attempt+1}/{max_retries}): {e}")
+                out_of_time = tick_deadline is not None and asyncio.get_running_loop().time() >= tick_deadline
+                if attempt == max_retries - 1 or out_of_time:
+                    print(f"   ❌ 放棄思考，執行備用行動。")
+                    return self._fallback_action(state)
+        res = decision.model_dump()
         
-        請決定你現在的行動。
+        # --- 邏輯處理 ---
         
-        **導航與行動規則 (請嚴格遵守)**:
-        1. **優先檢查地點**：看一眼 [當前計畫] 的「建議地點」。如果你現在不在那個地點，請優先設定 `target_location_id` 移動過去。
-        2. **到達後操作**：如果你已經在正確地點，則尋找該地點的物品進行操作 (設定 `target_object_id`)。
-        3. **填寫 JSON**:
-           - 移動時: `target_location_id` 填 ID (如 'bedroom'), `target_object_id` 填 null。
-           - 操作時: `target_location_id` 填 null, `target_object_id` 填 ID (如 'bed')。
+        # 計算時間
+        dur = res.get("duration", 15)
+        if dur < 15: dur = 15
         
-        請輸出 JSON (不要包含 Markdown):
-        {{
-            "action": "繁體中文描述行動 (1句話)",
-            "emoji": "表情",
-            "reason": "原因",
-            "target_location_id": "ID or null", 
-            "target_object_id": "ID or null",
-            "duration": 整數 (分鐘),
-            "should_replan": true 或 false
-        }}
-        """)
+        time_fmt = "%Y-%m-%d %I:%M %p"
+        curr_dt = datetime.strptime(state["current_time"], time_fmt)
+        action_end_dt = curr_dt + timedelta(minutes=dur)
+        busy_until = action_end_dt.strftime(time_fmt)
         
-        # 3. 執行 LLM (包含重試機制)
-        chain = prompt | self.llm 
+        print(f"   🎬 {res.get('emoji', '🤖')} {res['action']} ({dur}min)")
         
-        import re # 確保有引入 re
-        max_retries = 3
+        # 存記憶 (失敗不影響這次的決策)
+        try:
+            await self.retriever.add_memory(f"{state['agent_name']} {res['action']}", created_at=curr_dt, type="observation")
+        except Exception as e:
+            print(f"   ⚠️ 行動記憶寫入失敗: {e}")
         
-        for attempt in range(max_retries):
+        # A. 處理重規劃
+        final_daily_plan = daily
+        if res.get("should_replan"):
+            print(f"   ⚠️ 偵測到重規劃需求...")
+            # 先嘗試本地修正 (超時 / 提早開始)，語意不同才呼叫 LLM 重新規劃
+            # 重規劃失敗 (包含逾時) 時沿用原本的計畫
             try:
-                # Invoke
-                raw_response = chain.invoke({
-                    "agent_name": state["agent_name"], "agent_summary": state["agent_summary"],
-                    "current_time": state["current_time"], "memories": memories_text,
-                    "plan_ctx": plan_ctx, "observations": state["observations"], "world_desc": world_desc
-                })
-                
-                # Clean JSON
-                content = raw_response.content
-                if "```" in content:
-                    content = re.sub(r"```json\s*", "", content)
-                    content = re.sub(r"```", "", content)
-                content = content.strip()
-
-                # Parse
-                parser = JsonOutputParser()
-                res = parser.parse(content)
-                
-                # --- 邏輯處理 ---
-                
-                # 計算時間
-                dur = res.get("duration", 15)
-                if dur < 15: dur = 15
-                
-                time_fmt = "%Y-%m-%d %I:%M %p"
-                curr_dt = datetime.strptime(state["current_time"], time_fmt)
-                action_end_dt = curr_dt + timedelta(minutes=dur)
-                busy_until = action_end_dt.strftime(time_fmt)
-                
-                print(f"   🎬 {res.get('emoji', '🤖')} {res['action']} ({dur}min)")
-                
-                # 存記憶
-                await self.retriever.add_memory(f"{state['agent_name']} {res['action']}", type="observation")
-                
-                # A. 處理重規劃
-                final_daily_plan = daily
-                if res.get("should_replan"):
-                    print(f"   ⚠️ 偵測到重規劃需求...")
+                outcome, repaired = await self.plan_repairer.repair(daily, curr_dt, action_end_dt, res['action'])
+                if outcome == ESCALATE:
                     new_schedule = await self.planner.update_plan(
                         state["agent_name"], daily, state["current_time"], res['action']
                     )
                     if new_schedule:
                         final_daily_plan = [item.dict() for item in new_schedule]
                         short = [] 
+                else:
+                    label = "本地修正時間" if outcome == REPAIRED else "距離上次重規劃太近，只做本地修正"
+                    print(f"   🔧 {label}: " + ", ".join(f"{b['start_time']} {b['activity']}" for b in repaired))
+                    final_daily_plan = repaired
+            except Exception as e:
+                print(f"   ⚠️ 重規劃失敗，沿用原本的計畫: {e!r}")
+        
+        # B. 處理任務推進 (比對時間)
+        elif short:
+            current_subtask = short[0]
+            try:
+                task_end_str = current_subtask['end_time'].replace("：", ":")
+                today_str = curr_dt.strftime("%Y-%m-%d")
+                # 這裡假設 end_time 格式正確，若有跨日需額外處理，目前簡化
+                task_end_dt = datetime.strptime(f"{today_str} {task_end_str}", "%Y-%m-%d %H:%M")
                 
-                # B. 處理任務推進 (比對時間)
-                elif short:
-                    current_subtask = short[0]
-                    try:
-                        task_end_str = current_subtask['end_time'].replace("：", ":")
-                        today_str = curr_dt.strftime("%Y-%m-%d")
-                        # 這裡假設 end_time 格式正確，若有跨日需額外處理，目前簡化
-                        task_end_dt = datetime.strptime(f"{today_str} {task_end_str}", "%Y-%m-%d %H:%M")
-                        
-                        # 如果動作結束時間 >= 任務結束時間，視為完成
-                        if action_end_dt >= task_end_dt:
-                            removed = short.pop(0)
-                            print(f"   ✅ 完成細項: {removed['description']} (地點: {removed.get('location', '未指定')})")
-                            if short: print(f"   🔜 下一項: {short[0]['description']} @ {short[0].get('location')}")
-                        else:
-                            print(f"   ▶️ 任務進行中: {current_subtask['description']}")
-                    except ValueError:
-                        pass
-                
-                return {
-                    "current_action": res['action'], 
-                    "current_emoji": res.get("emoji", "🤖"),
-                    "target_location_id": res.get("target_location_id"),
-                    "target_object_id": res.get("target_object_id"),
-                    "busy_until": busy_until,
-                    "daily_plan": final_daily_plan,
-                    "short_term_plan": short
-                }
+                # 如果動作結束時間 >= 任務結束時間，視為完成
+                if action_end_dt >= task_end_dt:
+                    removed = short.pop(0)
+                    print(f"   ✅ 完成細項: {removed['description']} (地點: {removed.get('location', '未指定')})")
+                    if short: print(f"   🔜 下一項: {short[0]['description']} @ {short[0].get('location')}")
+                else:
+                    print(f"   ▶️ 任務進行中: {current_subtask['description']}")
+            except ValueError:
+                pass
+        
+        return {
+            "current_action": res['action'], 
+            "current_emoji": res.get("emoji", "🤖"),
+            "target_location_id": res.get("target_location_id"),
+            "target_object_id": res.get("target_object_id"),
+            "busy_until": busy_until,
+            "daily_plan": final_daily_plan,
+            "short_term_plan": short
+        }
 
-            except Exception as e:
-                print(f"   ⚠️ JSON 解析或執行失敗 (嘗試 {attempt+1}/{max_retries}): {e}")
-                if attempt == max_retries - 1:
-                    print(f"   ❌ 放棄思考，執行發呆。")
-                    return {"current_action": "發呆", "busy_until": None}
+    def _fallback_action(self, state: AgentState) -> Dict[str, Any]:
+        """
+        沒有 LLM 決策時的行動: 照短期計畫的目前細項執行，沒有計畫就發呆 (不設 busy_until，下個 tick 再思考)
+        計畫原樣帶回，呼叫端不會因為沒有 daily_plan / short_term_plan 而清空計畫
+        """
+        short = state.get("short_term_plan") or []
+        plans = {"daily_plan": state.get("daily_plan") or [], "short_term_plan": short}
+        if short:
+            task = short[0]
+            return {
+                "current_action": task["description"],
+                "current_emoji": "🤖",
+                "target_location_id": task.get("location"),
+                "target_object_id": None,
+                "busy_until": None,
+                **plans,
+            }
+        return {"current_action": "發呆", "busy_until": None, **plans}
     
     def interview(self, question: str):
         # 簡單的同步接口，實際應使用 async
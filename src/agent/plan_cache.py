@@ -0,0 +1,142 @@
+import threading
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from src.config import config
+
+# 時長區間 (分鐘): 同一個區間內的時段才會互相重用，避免把 30 分鐘的早餐套到 3 小時的時段
+_DURATION_BUCKETS = (30, 60, 120, 240, 480)
+_MINUTES_PER_DAY = 24 * 60
+
+def _to_minutes(hhmm: str) -> int:
+    h, m = hhmm.replace("：", ":").strip().split(":")
+    return (int(h) * 60 + int(m)) % _MINUTES_PER_DAY
+
+def _to_hhmm(minutes: int) -> str:
+    minutes %= _MINUTES_PER_DAY
+    return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+def window_minutes(start_time: str, end_time: str) -> int:
+    """時段長度 (跨午夜也可以，例如 22:00 - 06:00 = 480)"""
+    span = (_to_minutes(end_time) - _to_minutes(start_time)) % _MINUTES_PER_DAY
+    return span or _MINUTES_PER_DAY
+
+def duration_bucket(minutes: int) -> int:
+    for i, limit in enumerate(_DURATION_BUCKETS):
+        if minutes <= limit:
+            return i
+    return len(_DURATION_BUCKETS)
+
+class _Entry:
+    __slots__ = ("activity", "embedding", "subtasks", "created_at", "reuse_count")
+
+    def __init__(self, activity: str, embedding: np.ndarray, subtasks: List[Dict[str, Any]], created_at: float):
+        self.activity = activity
+        self.embedding = embedding
+        self.subtasks = subtasks # 時間存成在原時段中的相對位置 (0~1)
+        self.created_at = created_at # 模擬時間 (timestamp)
+        self.reuse_count = 0
+
+class PlanCache:
+    """
+    decompose_activity 的語意快取
+    key:   (agent, 時長區間) 完全相同，且活動描述的 embedding cosine 相似度 >= threshold
+    value: 子任務列表，時間存成相對位置，重用時依新的時段等比例縮放 (對齊 5 分鐘)
+    過期:  建立超過 max_age_hours (模擬時間)，或已被重用 max_reuse 次 ---> 淘汰並重新生成 (行程不會永遠一模一樣)
+    """
+
+    def __init__(
+        self,
+        threshold: Optional[float] = None,
+        max_age_hours: Optional[float] = None,
+        max_reuse: Optional[int] = None,
+        max_entries: int = 256,
+    ):
+        self.threshold = config.PLAN_CACHE_THRESHOLD if threshold is None else threshold
+        self.max_age = (config.PLAN_CACHE_MAX_AGE_HOURS if max_age_hours is None else max_age_hours) * 3600
+        self.max_reuse = config.PLAN_CACHE_MAX_REUSE if max_reuse is None else max_reuse
+        self.max_entries = max_entries
+        self._entries: Dict[Tuple[str, int], List[_Entry]] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _normalize(embedding: Sequence[float]) -> np.ndarray:
+        vec = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vec)
+        return vec / norm if norm > 0 else vec
+
+    def _is_stale(self, entry: _Entry, now: float) -> bool:
+        if self.max_age > 0 and now - entry.created_at > self.max_age:
+            return True
+        return self.max_reuse > 0 and entry.reuse_count >= self.max_reuse
+
+    def lookup(self, agent: str, embedding: Sequence[float], start_time: str, end_time: str,
+               now: datetime) -> Optional[List[Dict[str, Any]]]:
+        """找到夠相似的快取時，回傳縮放到新時段的子任務 (dict: start_time / end_time / description / location)"""
+        span = window_minutes(start_time, end_time)
+        key = (agent, duration_bucket(span))
+        query = self._normalize(embedding)
+        with self._lock:
+            entries = [e for e in self._entries.get(key, []) if not self._is_stale(e, now.timestamp())]
+            self._entries[key] = entries
+            best, best_score = None, self.threshold
+            for entry in entries:
+                score = float(entry.embedding @ query)
+                if score >= best_score:
+                    best, best_score = entry, score
+            if best is None:
+                self.misses += 1
+                return None
+            best.reuse_count += 1
+            self.hits += 1
+            subtasks = best.subtasks
+        start = _to_minutes(start_time)
+        return [
+            {
+                "start_time": _to_hhmm(start + round(t["start"] * span / 5) * 5),
+                "end_time": _to_hhmm(start + round(t["end"] * span / 5) * 5),
+                "description": t["description"],
+                "location": t["location"],
+            }
+            for t in subtasks
+        ]
+
+    def store(self, agent: str, activity: str, embedding: Sequence[float], start_time: str, end_time: str,
+              subtasks: List[Dict[str, Any]], now: datetime):
+        """把 LLM 生成的子任務存成相對時間 (時間格式不對的子任務無法縮放，整份不快取)"""
+        span = window_minutes(start_time, end_time)
+        start = _to_minutes(start_time)
+        try:
+            relative = [
+                {
+                    "start": ((_to_minutes(t["start_time"]) - start) % _MINUTES_PER_DAY) / span,
+                    "end": ((_to_minutes(t["end_time"]) - start) % _MINUTES_PER_DAY) / span,
+                    "description": t["description"],
+                    "location": t["location"],
+                }
+                for t in subtasks
+            ]
+        except (ValueError, KeyError):
+            return
+        if not relative or any(t["start"] > 1 or t["end"] > 1 for t in relative):
+            return
+        key = (agent, duration_bucket(span))
+        with self._lock:
+            entries = self._entries.setdefault(key, [])
+            entries.append(_Entry(activity, self._normalize(embedding), relative, now.timestamp()))
+            if len(entries) > self.max_entries:
+                del entries[0]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": sum(len(v) for v in self._entries.values()),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 3) if total else 0.0,
+            }
@@ -0,0 +1,129 @@
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from src.config import config
+
+# repair() 的結果
+REPAIRED = "repaired"     # 只是時間偏移，已在本地修好
+ESCALATE = "escalate"     # 行動和計畫的語意不同，需要 LLM 重新規劃
+DEBOUNCED = "debounced"   # 距離上次 LLM 重規劃太近，只做本地修正
+
+def _minutes(hhmm: str) -> int:
+    h, m = hhmm.replace("：", ":").strip().split(":")
+    return int(h) * 60 + int(m)
+
+def _hhmm(minutes: int) -> str:
+    minutes = max(0, min(minutes, 24 * 60 - 1))
+    return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+def _block(block: Dict, start: int) -> Dict:
+    """複製 block 並改開始時間 (calculated_end_time 由 perceive_node 重新計算)"""
+    result = {k: v for k, v in block.items() if k != "calculated_end_time"}
+    result["start_time"] = _hhmm(start)
+    return result
+
+def drop_expired(plan: List[Dict], now: int) -> List[Dict]:
+    """移除已經結束的時段 (保留目前進行中的那一個)"""
+    current = 0
+    for i, block in enumerate(plan):
+        if _minutes(block["start_time"]) <= now:
+            current = i
+    return plan[current:]
+
+def reflow(plan: List[Dict], new_start: int, min_block: int) -> List[Dict]:
+    """
+    plan[0] 改從 new_start 開始，後面的時段吸收延誤，最後一個時段 (通常是睡覺) 的時間盡量不動:
+    1. 還有空間 ---> 中間的時段等比例壓縮
+    2. 壓縮後有時段短於 min_block ---> 從最後面 (錨點之前) 開始捨棄時段
+    3. 連錨點都來不及 ---> 全部順延
+    """
+    if not plan:
+        return []
+    starts = [_minutes(b["start_time"]) for b in plan]
+    if new_start <= starts[0]:
+        return [_block(plan[0], new_start)] + [_block(b, s) for b, s in zip(plan[1:], starts[1:])]
+    if len(plan) == 1:
+        return [_block(plan[0], new_start)]
+
+    blocks, anchor = plan[:-1], starts[-1]
+    while blocks:
+        block_starts = [_minutes(b["start_time"]) for b in blocks]
+        needed = anchor - block_starts[0]
+        available = anchor - new_start
+        if needed > 0 and available >= min_block * len(blocks):
+            scale = available / needed
+            shifted = [new_start + round((s - block_starts[0]) * scale) for s in block_starts]
+            if all(b - a >= min_block for a, b in zip(shifted, shifted[1:] + [anchor])):
+                return [_block(b, s) for b, s in zip(blocks, shifted)] + [_block(plan[-1], anchor)]
+        if len(blocks) == 1:
+            break
+        # 放不下: 捨棄錨點前最後一個時段 (第一個時段是正在延誤的那一個，保留)
+        blocks = blocks[:-1]
+
+    # 錨點也來不及: 從 new_start 開始全部順延
+    shift = new_start - starts[0]
+    return [_block(b, s + shift) for b, s in zip(plan, starts)]
+
+class PlanRepairer:
+    """
+    react 要求重規劃 (should_replan) 時，先在本地判斷能不能不用 LLM:
+    - 目前的行動和「進行中 / 下一個」時段的活動語意相近 ---> 只是超時或提早開始，在本地修正時間:
+        超時: 下一個時段延後到行動結束，後面的時段壓縮吸收 (見 reflow)
+        提早: 下一個時段提前到現在開始
+      並移除已經過去的時段
+    - 語意不同 (計畫被打亂) ---> 交給 Planner.update_plan (LLM)
+      但距離上一次 LLM 重規劃不到 debounce 分鐘 (模擬時間) 時不再呼叫，只做本地修正
+    """
+
+    def __init__(
+        self,
+        embed: Callable[[str], Awaitable[Sequence[float]]],
+        similarity: Optional[float] = None,
+        debounce_minutes: Optional[float] = None,
+        min_block_minutes: Optional[int] = None,
+    ):
+        self.embed = embed
+        self.similarity = config.PLAN_REPAIR_SIMILARITY if similarity is None else similarity
+        self.debounce_minutes = config.PLAN_REPLAN_DEBOUNCE_MINUTES if debounce_minutes is None else debounce_minutes
+        self.min_block = config.PLAN_MIN_BLOCK_MINUTES if min_block_minutes is None else min_block_minutes
+        self._last_escalation: Optional[datetime] = None
+
+    async def _similar(self, action: str, activity: str) -> float:
+        a, b = (np.asarray(v, dtype=np.float32) for v in (await self.embed(action), await self.embed(activity)))
+        denom = float(np.linalg.norm(a) * np.linalg.norm(b))
+        return float(a @ b) / denom if denom else 0.0
+
+    def _debounced(self, now: datetime) -> bool:
+        return (
+            self._last_escalation is not None
+            and (now - self._last_escalation).total_seconds() < self.debounce_minutes * 60
+        )
+
+    async def repair(self, daily_plan: List[Dict], now: datetime, action_end: datetime,
+                     action: str) -> Tuple[str, Optional[List[Dict]]]:
+        """回傳 (REPAIRED / ESCALATE / DEBOUNCED, 修正後的計畫)，ESCALATE 時計畫為 None"""
+        now_min = now.hour * 60 + now.minute
+        end_min = now_min + int((action_end - now).total_seconds() // 60)
+        try:
+            plan = drop_expired(daily_plan, now_min)
+        except (KeyError, ValueError):
+            return ESCALATE, None # 時間格式不對，無法在本地處理
+
+        if plan:
+            current = plan[0]
+            nxt = plan[1] if len(plan) > 1 else None
+            if await self._similar(action, current["activity"]) >= self.similarity:
+                # 延續目前的時段: 下一個時段至少要等這個行動結束
+                if nxt is None or end_min <= _minutes(nxt["start_time"]):
+                    return REPAIRED, plan
+                return REPAIRED, [_block(current, _minutes(current["start_time"]))] + reflow(plan[1:], end_min, self.min_block)
+            if nxt is not None and await self._similar(action, nxt["activity"]) >= self.similarity:
+                # 提早開始下一個時段
+                return REPAIRED, reflow(plan[1:], now_min, self.min_block)
+
+        if self._debounced(now):
+            return DEBOUNCED, plan
+        self._last_escalation = now
+        return ESCALATE, None
@@ -1,9 +1,14 @@
 from typing import List
+from datetime import datetime, timedelta
 from pydantic import BaseModel, Field
-from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.output_parsers import PydanticOutputParser
+from src.config import config
 from src.llm_factory import get_llm
+from src.agent.prompting import ContextBudget, Section, get_prompt, memory_lines
+from src.agent.plan_cache import PlanCache
+from src.agent.similarity import embed_for_similarity
+from src.json_repair import RepairingJsonParser
 from src.memory.retriever import GenerativeRetriever
+from src.tracing import traced
 
 class PlanItem(BaseModel):
     start_time: str = Field(description="Time in HH:MM format (e.g., 08:00)")
@@ -21,63 +26,91 @@ class SubTask(BaseModel):
 class DetailedRoutine(BaseModel):
     subtasks: List[SubTask]
 
+class CoreGoal(BaseModel):
+    goal: str = Field(description="最重要的 1 個長期目標")
+
+# 計畫流程中固定的檢索句 (只依 agent 名稱變化，warmup 時會先算好 embedding)
+YESTERDAY_QUERY = "{agent_name} 昨天做了什麼？有哪些未完成的事？"
+INTERNAL_STATE_QUERY = "{agent_name} 最近的心情、感覺與反思洞察"
+PLANNER_QUERY_TEMPLATES = [YESTERDAY_QUERY, INTERNAL_STATE_QUERY]
+
+def _parse_sim_time(current_time: str) -> datetime:
+    """模擬時間格式為 "%Y-%m-%d %I:%M %p"，解析失敗時退回系統時間"""
+    try:
+        return datetime.strptime(current_time, "%Y-%m-%d %I:%M %p")
+    except ValueError:
+        return datetime.now()
+
 class Planner:
     def __init__(self, retriever: GenerativeRetriever):
         self.retriever = retriever
-        self.llm = get_llm(temperature=0.4, json_mode=True) 
+        self.llm = get_llm(temperature=0.4, json_mode=True, role="plan")
+        # 細分活動的優先權與每日計畫分開排程
+        self.decompose_llm = get_llm(temperature=0.4, json_mode=True, role="decompose")
+        # 輸出結構由 Ollama 依 Pydantic model 的 JSON schema 限制，prompt 不再附 format instructions
+        self.plan_llm = self.llm.with_schema(DailyPlan)
+        self.goal_llm = self.llm.with_schema(CoreGoal)
+        self.routine_llm = self.decompose_llm.with_schema(DetailedRoutine)
+        # 每天重複的活動 (睡覺 / 吃早餐 / 寫論文) 重用之前細分好的子任務
+        self.plan_cache = PlanCache() if config.PLAN_CACHE_ENABLED else None
 
     # ==========================================
     # Step 1: 獲取昨日脈絡 (Temporal Context)
     # ==========================================
-    async def _get_yesterday_context(self, agent_name: str) -> str:
+    async def _get_yesterday_context(self, agent_name: str, current_dt: datetime) -> str:
         """檢索昨天發生了什麼，以決定今天的延續性"""
-        # 這裡用模糊查詢，依賴語意搜尋找到相關的時間點
-        query = f"{agent_name} 昨天做了什麼？有哪些未完成的事？"
-        memories = await self.retriever.retrieve(query, k=3)
+        # 只在「昨天」的時間範圍內做語意搜尋，而不是整個記憶流
+        today_start = current_dt.replace(hour=0, minute=0, second=0, microsecond=0)
+        query = YESTERDAY_QUERY.format(agent_name=agent_name)
+        memories = await self.retriever.retrieve(
+            query, now=current_dt, k=3,
+            created_after=today_start - timedelta(days=1),
+            created_before=today_start
+        )
         if not memories:
             return "沒有關於昨天的特別紀錄。"
-        return "\n".join([f"- {m.page_content}" for m in memories])
+        return "\n".join(memory_lines(memories))
 
     # ==========================================
     # Step 2: 獲取內在狀態 (Reflection Context)
     # ==========================================
-    async def _get_internal_state(self, agent_name: str) -> str:
+    async def _get_internal_state(self, agent_name: str, current_dt: datetime) -> str:
         """檢索最近的反思與心情"""
-        query = f"{agent_name} 最近的心情、感覺與反思洞察"
-        # 這裡我們希望抓到 'reflection' 類型的記憶
-        memories = await self.retriever.retrieve(query, k=3)
+        query = INTERNAL_STATE_QUERY.format(agent_name=agent_name)
+        # 只抓 'reflection' 類型的記憶
+        memories = await self.retriever.retrieve(query, now=current_dt, k=3, memory_types=["reflection"])
         if not memories:
             return "心情平靜，沒有特別的想法。"
-        return "\n".join([f"- {m.page_content}" for m in memories])
+        return "\n".join(memory_lines(memories))
 
     # ==========================================
     # Step 3: 獲取目標進度 (Goal Context)
     # ==========================================
-    async def _get_goal_context(self, agent_name: str, agent_summary: str) -> str:
+    async def _get_goal_context(self, agent_name: str, agent_summary: str, current_dt: datetime) -> str:
         """先從 Summary 提取核心目標，再檢索該目標的進度"""
         
         # 3.1 先問 LLM 核心目標是什麼 (簡單提取)
-        extract_prompt = ChatPromptTemplate.from_template("""
+        extract_prompt = get_prompt("""
         根據以下描述，{agent_name} 目前人生中最重要的 1 個長期目標是什麼？
         (例如：寫完論文、準備馬拉松、交到女朋友)
-        請用 JSON 回傳: {{ "goal": "目標描述" }}
+        請用 JSON 回傳 goal 欄位。
         
         描述: {summary}
         """)
         try:
-            chain = extract_prompt | self.llm | JsonOutputParser()
-            result = chain.invoke({"agent_name": agent_name, "summary": agent_summary})
-            core_goal = result.get("goal", "過好每一天")
+            chain = extract_prompt | self.goal_llm | RepairingJsonParser(pydantic_object=CoreGoal)
+            result = await chain.ainvoke({"agent_name": agent_name, "summary": agent_summary})
+            core_goal = result.goal or "過好每一天"
         except:
             core_goal = "日常雜務"
 
         # 3.2 檢索該目標的狀態
         query = f"{agent_name} 的 '{core_goal}' 目前進度與相關活動"
-        memories = await self.retriever.retrieve(query, k=3)
+        memories = await self.retriever.retrieve(query, now=current_dt, k=3)
         
         context_str = f"核心目標: {core_goal}\n相關記憶:\n"
         if memories:
-            context_str += "\n".join([f"- {m.page_content}" for m in memories])
+            context_str += "\n".join(memory_lines(memories))
         else:
             context_str += "目前還沒有開始執行此目標。"
             
@@ -86,63 +119,71 @@ class Planner:
     # ==========================================
     # 主流程: 綜合生成計畫
     # ==========================================
+    @traced("planner.create_initial_plan", cat="planner")
     async def create_initial_plan(self, agent_name: str, agent_summary: str, current_time: str):
         print(f"📅 {agent_name} 正在進行深度規劃 (Context-Aware)...")
         
         # 平行執行三個檢索任務
         # 同時發出三個查詢，不用一個等一個
         import asyncio
+        current_dt = _parse_sim_time(current_time)
         yesterday_ctx, state_ctx, goal_ctx = await asyncio.gather(
-            self._get_yesterday_context(agent_name),
-            self._get_internal_state(agent_name),
-            self._get_goal_context(agent_name, agent_summary)
+            self._get_yesterday_context(agent_name, current_dt),
+            self._get_internal_state(agent_name, current_dt),
+            self._get_goal_context(agent_name, agent_summary, current_dt)
         )
         
         print(f"   🔍 [昨日] 檢索完成")
         print(f"   🔍 [狀態] 檢索完成")
         print(f"   🔍 [目標] 檢索完成")
         # 把 LLM response json 格式轉成 pydantic 格式
-        parser = PydanticOutputParser(pydantic_object=DailyPlan)
+        parser = RepairingJsonParser(pydantic_object=DailyPlan)
 
-        template = """
+        # 固定前綴 (同一個 agent 每次都一樣，可重用伺服器端的 KV cache)
+        system = """
         你是 {agent_name}。
         背景設定: {agent_summary}
-        目前時間: {current_time}
         
-        為了制定今天的計畫，請參考以下資訊：
+        你要參考「昨日回顧」、「內在狀態」、「目標進度」三段資訊，為今天制定計畫：
+        - 如果昨天有未完成的事，今天請優先安排
+        - 如果最近很累，請安排休息；如果很有動力，請安排困難工作
+        - 請確保今天的行程能推進核心目標
+        
+        行程應該具體且連貫，涵蓋從起床到睡覺的時間 (5-8 個主要時段)。
+        請使用繁體中文回答，以 JSON 輸出 schedule。
+        """
+
+        # 每次變動的部分
+        template = """
+        目前時間: {current_time}
         
         === 1. 昨日回顧 (Yesterday) ===
         {yesterday_ctx}
-        (如果昨天有未完成的事，今天請優先安排)
         
         === 2. 內在狀態 (Internal State) ===
         {state_ctx}
-        (如果最近很累，請安排休息；如果很有動力，請安排困難工作)
         
         === 3. 目標進度 (Core Goal) ===
         {goal_ctx}
-        (請確保今天的行程能推進這個目標)
-        
-        --- 任務 ---
-        請綜合以上資訊，為今天制定一個具體且連貫的行程表。
-        行程應該涵蓋從起床到睡覺的時間 (5-8 個主要時段)。
-        請使用繁體中文回答。
         
-        {format_instructions}
+        請為今天制定行程表。
         """
         
-        prompt = ChatPromptTemplate.from_template(template)
-        chain = prompt | self.llm | parser
+        # 依 token 預算截斷三段脈絡 (目標最重要，內在狀態最先被截斷)
+        ctx = ContextBudget("plan").fit([
+            Section("goal_ctx", goal_ctx.splitlines(), max_tokens=400, priority=0, dedupe=True),
+            Section("yesterday_ctx", yesterday_ctx.splitlines(), max_tokens=500, priority=1, dedupe=True),
+            Section("state_ctx", state_ctx.splitlines(), max_tokens=300, priority=2, dedupe=True),
+        ], template=system + template)
+        prompt = get_prompt(template, system)
+        chain = prompt | self.plan_llm | parser
         
         try:
-            plan = chain.invoke({
+            plan = await chain.ainvoke({
                 "agent_name": agent_name,
                 "agent_summary": agent_summary,
                 "current_time": current_time,
-                "yesterday_ctx": yesterday_ctx,
-                "state_ctx": state_ctx,
-                "goal_ctx": goal_ctx,
-                "format_instructions": parser.get_format_instructions()
+                **ctx
             })
             
             # 合併 Str and 存入記憶
@@ -152,13 +193,14 @@ class Planner:
                 plan_text += line + "\n"
                 print(f"   📌 {line}")
             
-            await self.retriever.add_memory(content=plan_text, type="plan")
+            await self.retriever.add_memory(content=plan_text, created_at=current_dt, type="plan")
             return plan.schedule
             
         except Exception as e:
             print(f"❌ 計畫生成失敗: {e}")
             return []
         
+    @traced("planner.update_plan", cat="planner")
     async def update_plan(self, agent_name: str, current_plan: List[dict], current_time: str, reason: str):
         """
         重規劃功能
@@ -166,13 +208,22 @@ class Planner:
         """
         print(f"🔄 {agent_name} 正在修正行程表 (原因: {reason})...")
         
-        parser = PydanticOutputParser(pydantic_object=DailyPlan)
+        parser = RepairingJsonParser(pydantic_object=DailyPlan)
 
         # 將舊計畫轉成字串方便 LLM 閱讀
         old_plan_str = "\n".join([f"{p['start_time']}: {p['activity']}" for p in current_plan])
 
-        template = """
+        system = """
         你是 {agent_name}。
+        當你偏離原訂計畫時，要根據目前時間和狀況，**重新安排今天剩餘的行程**。
+        1. 移除已經過去的時間段。
+        2. 根據新的狀況調整接下來的活動（例如：如果遲到了，可能要取消某些事，或是順延）。
+        3. 保持行程的連貫性。
+        
+        請使用繁體中文回答，以 JSON 輸出 schedule。
+        """
+
+        template = """
         目前時間: {current_time}。
         
         [原本的計畫]
@@ -180,27 +231,20 @@ class Planner:
         
         [發生的狀況]
         你剛剛偏離了計畫，原因: {reason}。
-        
-        請根據目前時間和狀況，**重新安排今天剩餘的行程**。
-        1. 移除已經過去的時間段。
-        2. 根據新的狀況調整接下來的活動（例如：如果遲到了，可能要取消某些事，或是順延）。
-        3. 保持行程的連貫性。
-        
-        請使用繁體中文回答。
-        
-        {format_instructions}
         """
         
-        prompt = ChatPromptTemplate.from_template(template)
-        chain = prompt | self.llm | parser
+        ctx = ContextBudget("replan").fit([
+            Section("old_plan_str", old_plan_str.splitlines(), max_tokens=600, priority=0),
+        ], template=system + template)
+        prompt = get_prompt(template, system)
+        chain = prompt | self.plan_llm | parser
         
         try:
-            new_plan = chain.invoke({
+            new_plan = await chain.ainvoke({
                 "agent_name": agent_name,
                 "current_time": current_time,
-                "old_plan_str": old_plan_str,
                 "reason": reason,
-                "format_instructions": parser.get_format_instructions()
+                **ctx
             })
             
             # Log 並存入記憶
@@ -210,7 +254,7 @@ class Planner:
                 plan_text += line + "\n"
                 print(f"   🔄 [修正] {line}")
             
-            await self.retriever.add_memory(content=plan_text, type="plan")
+            await self.retriever.add_memory(content=plan_text, created_at=_parse_sim_time(current_time), type="plan")
             
             return new_plan.schedule
             
@@ -219,44 +263,66 @@ class Planner:
             # 如果失敗，回傳原本的計畫避免崩潰
             return []
         
-    async def decompose_activity(self, agent_name: str, activity: str, start_time: str, end_time: str):
+    @traced("planner.decompose_activity", cat="planner")
+    async def decompose_activity(self, agent_name: str, activity: str, start_time: str, end_time: str,
+                                 current_time: str):
         print(f"🔨 細分活動: {activity} ({start_time}-{end_time})")
+        current_dt = _parse_sim_time(current_time)
+
+        # 先查語意快取 (embedding 失敗或時間格式不對時直接走 LLM)
+        embedding = None
+        if self.plan_cache is not None:
+            try:
+                embedding = await embed_for_similarity(activity)
+                cached = self.plan_cache.lookup(agent_name, embedding, start_time, end_time, current_dt)
+            except Exception as e:
+                print(f"   ⚠️ 計畫快取查詢失敗: {e}")
+                cached = None
+            if cached:
+                subtasks = [SubTask(**t) for t in cached]
+                print(f"   ♻️ 重用快取的細部計畫 (命中率 {self.plan_cache.stats()['hit_rate']:.0%})")
+                await self._remember_subtasks(start_time, subtasks, current_dt)
+                return subtasks
         
-        parser = PydanticOutputParser(pydantic_object=DetailedRoutine)
+        parser = RepairingJsonParser(pydantic_object=DetailedRoutine)
 
         # [修改] Prompt: 要求包含地點 ID
-        template = """
+        system = """
         你是 {agent_name}。
-        大任務: {activity} ({start_time} - {end_time})。
-        
-        請將此時段細分為具體子任務。
+        請將大任務的時段細分為具體子任務。
         對於每個子任務，**務必指定最適合的地點 ID** (參考: bedroom, kitchen, library, lecture_hall)。
         例如：如果是「睡覺」，地點 ID 應為 "bedroom"。如果是「做飯」，地點 ID 應為 "kitchen"。
-        
-        {format_instructions}
+        請以 JSON 輸出 subtasks (時間格式 HH:MM)。
+        """
+        template = """
+        大任務: {activity} ({start_time} - {end_time})。
         """
         
         try:
-            chain = ChatPromptTemplate.from_template(template) | self.llm | parser
-            result = chain.invoke({
+            chain = get_prompt(template, system) | self.routine_llm | parser
+            result = await chain.ainvoke({
                 "agent_name": agent_name,
                 "activity": activity,
                 "start_time": start_time,
-                "end_time": end_time,
-                "format_instructions": parser.get_format_instructions()
+                "end_time": end_time
             })
             
-            # Log 顯示地點
-            for t in result.subtasks: 
-                print(f"   ↳ {t.start_time}: {t.description} @ {t.location}")
-            
-            # 存入記憶
-            detail_text = f"細部計畫 ({start_time}):\n" + \
-                          "\n".join([f"- {t.start_time}: {t.description} (在 {t.location})" for t in result.subtasks])
-            await self.retriever.add_memory(content=detail_text, type="plan")
-
+            if embedding is not None:
+                self.plan_cache.store(agent_name, activity, embedding, start_time, end_time,
+                                      [t.model_dump() for t in result.subtasks], current_dt)
+            await self._remember_subtasks(start_time, result.subtasks, current_dt)
             return result.subtasks
             
         except Exception as e:
             print(f"❌ Decompose Error: {e}")
-            return []
\ No newline at end of file
+            return []
+
+    async def _remember_subtasks(self, start_time: str, subtasks: List[SubTask], created_at: datetime):
+        # Log 顯示地點
+        for t in subtasks: 
+            print(f"   ↳ {t.start_time}: {t.description} @ {t.location}")
+        
+        # 存入記憶
+        detail_text = f"細部計畫 ({start_time}):\n" + \
+                      "\n".join([f"- {t.start_time}: {t.description} (在 {t.location})" for t in subtasks])
+        await self.retriever.add_memory(content=detail_text, created_at=created_at, type="plan")
@@ -0,0 +1,178 @@
+import re
+import threading
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Sequence
+
+from langchain_core.documents import Document
+from langchain_core.prompts import ChatPromptTemplate
+
+from src.config import config
+
+# ==========================================
+# Token 計算
+# ==========================================
+# 中日韓文字大約 1 字 1 token，其他文字大約 4 字元 1 token
+_CJK = re.compile(r"[\u2e80-\u9fff\uac00-\ud7af\uff00-\uffef]")
+
+_tokenizer = None
+_tokenizer_loaded = False
+_tokenizer_lock = threading.Lock()
+
+def _get_tokenizer():
+    """PROMPT_TOKENIZER 有設定時才載入 HuggingFace tokenizer (失敗時退回估算)"""
+    global _tokenizer, _tokenizer_loaded
+    if not _tokenizer_loaded:
+        with _tokenizer_lock:
+            if not _tokenizer_loaded:
+                if config.PROMPT_TOKENIZER:
+                    try:
+                        from transformers import AutoTokenizer
+                        _tokenizer = AutoTokenizer.from_pretrained(config.PROMPT_TOKENIZER)
+                    except Exception as e:
+                        print(f"⚠️ [Prompt] 無法載入 tokenizer {config.PROMPT_TOKENIZER}，改用估算: {e}")
+                _tokenizer_loaded = True
+    return _tokenizer
+
+def count_tokens(text: str) -> int:
+    tokenizer = _get_tokenizer()
+    if tokenizer is not None:
+        return len(tokenizer.encode(text, add_special_tokens=False))
+    cjk = len(_CJK.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+def truncate_text(text: str, max_tokens: int) -> str:
+    """把單一段文字截到 max_tokens 以內 (結尾加上 …)"""
+    if count_tokens(text) <= max_tokens:
+        return text
+    lo, hi = 0, len(text)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if count_tokens(text[:mid]) + 1 <= max_tokens:
+            lo = mid
+        else:
+            hi = mid - 1
+    return text[:lo] + "…"
+
+# ==========================================
+# Template 快取
+# ==========================================
+@lru_cache(maxsize=None)
+def get_prompt(template: str, system: Optional[str] = None) -> ChatPromptTemplate:
+    """
+    模板字串是常數，編譯好的 ChatPromptTemplate 依字串快取，不用每次呼叫都重新解析
+    有 system 時分成兩則訊息: system 只放每個 agent 固定不變的內容 (身分 / 地圖 / 規則)，
+    每次呼叫都會變的內容 (時間 / 觀察 / 記憶) 放在後面的 human 訊息，
+    這樣同一個 agent 的 prompt 前綴完全相同，Ollama 可以重用已算好的 KV cache
+    """
+    if system is None:
+        return ChatPromptTemplate.from_template(template)
+    return ChatPromptTemplate.from_messages([("system", system), ("human", template)])
+
+# ==========================================
+# 區塊與預算
+# ==========================================
+_BULLET = re.compile(r"^\s*[-•*]\s*")
+
+def dedupe_lines(lines: Iterable[str]) -> List[str]:
+    """去掉內容重複的行 (忽略項目符號與前後空白)，保留第一次出現的順序"""
+    seen = set()
+    result = []
+    for line in lines:
+        key = _BULLET.sub("", line).strip()
+        if not key or key in seen:
+            continue
+        seen.add(key)
+        result.append(line)
+    return result
+
+def memory_lines(memories: Sequence[Document]) -> List[str]:
+    """
+    把檢索到的記憶攤平成行: 多行的記憶 (例如每日計畫) 第一行加 "- "，其餘縮排
+    攤平後重複的行 (同一個時段出現在好幾份計畫中) 可以被 dedupe_lines 去掉
+    """
+    lines = []
+    for m in memories:
+        for i, line in enumerate(l for l in m.page_content.splitlines() if l.strip()):
+            lines.append(f"- {line.strip()}" if i == 0 else f"  {line.strip()}")
+    return lines
+
+@dataclass
+class Section:
+    """
+    prompt 中的一個區塊
+    lines      依重要性排序，超出預算時從後面丟掉
+    max_tokens 此區塊自己的上限
+    priority   數字越小越重要；總長超過預算時從 priority 最大的區塊開始縮減
+    min_tokens 縮減總長時此區塊至少保留的 token 數
+    """
+    name: str
+    lines: List[str]
+    max_tokens: int
+    priority: int = 1
+    min_tokens: int = 0
+    dedupe: bool = False
+    empty: str = "" # 沒有內容時顯示的文字
+
+def _fit_count(counts: List[int], budget: int) -> int:
+    """在 budget 內最多能放前幾行"""
+    used = 0
+    for i, c in enumerate(counts):
+        if used + c > budget:
+            return i
+        used += c
+    return len(counts)
+
+class ContextBudget:
+    """
+    依 token 預算組裝 prompt 的動態區塊 (記憶 / 地圖 / 計畫 / 觀察)
+    1. 各區塊先去重，再截到自己的 max_tokens
+    2. 全部區塊加上模板本身超過 max_tokens 時，依 priority 從最不重要的區塊開始縮減
+    3. 每次組裝都記錄該 node 的 prompt 大小
+    """
+
+    def __init__(self, node: str, max_tokens: Optional[int] = None):
+        self.node = node
+        self.max_tokens = max_tokens or config.PROMPT_MAX_TOKENS
+
+    def fit(self, sections: Iterable[Section], template: str = "") -> Dict[str, str]:
+        sections = list(sections)
+        prepared: Dict[str, List[str]] = {}
+        counts: Dict[str, List[int]] = {}
+        for s in sections:
+            lines = dedupe_lines(s.lines) if s.dedupe else [l for l in s.lines if l.strip()]
+            # 單一行就超過區塊上限時 (例如很長的計畫)，截斷那一行而不是整個區塊清空
+            # (上限扣掉該行的換行，截斷後的行才放得進區塊)
+            prepared[s.name] = [truncate_text(l, max(s.max_tokens - 1, 1)) for l in lines]
+            counts[s.name] = [count_tokens(l) + 1 for l in prepared[s.name]] # +1: 換行
+
+        kept = {s.name: _fit_count(counts[s.name], s.max_tokens) for s in sections}
+        template_tokens = count_tokens(template) if template else 0
+
+        def used(name: str) -> int:
+            return sum(counts[name][:kept[name]])
+
+        over = template_tokens + sum(used(s.name) for s in sections) - self.max_tokens
+        for s in sorted(sections, key=lambda s: -s.priority):
+            if over <= 0:
+                break
+            current = used(s.name)
+            kept[s.name] = _fit_count(counts[s.name], max(s.min_tokens, current - over))
+            over -= current - used(s.name)
+
+        result = {}
+        for s in sections:
+            lines = prepared[s.name][:kept[s.name]]
+            result[s.name] = "\n".join(lines) if lines else s.empty
+        self._log(sections, kept, counts, template_tokens)
+        return result
+
+    def _log(self, sections: List[Section], kept: Dict[str, int], counts: Dict[str, List[int]], template_tokens: int):
+        total = template_tokens
+        parts = []
+        for s in sections:
+            used = sum(counts[s.name][:kept[s.name]])
+            total += used
+            full = sum(counts[s.name])
+            parts.append(f"{s.name} {used}" if used == full else f"{s.name} {used}/{full}")
+        print(f"   📏 [{self.node}] prompt ≈ {total} tokens ({', '.join(parts)})")
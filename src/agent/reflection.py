@@ -1,18 +1,35 @@
+from datetime import datetime
 from typing import List
-from langchain_core.prompts import ChatPromptTemplate
 from src.llm_factory import get_llm
+from src.agent.prompting import ContextBudget, Section, get_prompt, memory_lines
+from src.llm_scheduler import set_llm_agent
 from src.memory.retriever import GenerativeRetriever
+from src.tracing import traced
+
+# 反思時固定的檢索句 (warmup 時會先算好 embedding)
+REFLECTION_QUERY = "{agent_name} 最近發生了什麼事?"
+
+REFLECTION_TEMPLATE = """
+        {observations}
+        
+        僅根據以上資訊，我們可以推斷出關於 {agent_name} 的哪 3 個最重要的高層次洞察 (Insights)？
+        請用繁體中文回答，列出 3 個不同的句子，每行一句。不要包含編號。
+        """
 
 class Reflector:
     def __init__(self, retriever: GenerativeRetriever):
         self.retriever = retriever
-        self.llm = get_llm(temperature=0.5)
+        self.llm = get_llm(temperature=0.5, role="reflect") # 背景工作，排程優先權最低
 
-    async def run(self, agent_name: str, last_k: int = 20):
+    @traced("reflect", cat="reflection")
+    async def run(self, agent_name: str, now: datetime, last_k: int = 20):
+        """now 為模擬時間: 依此檢索最近的記憶，洞察也以此時間寫入"""
         print(f"🤔 {agent_name} 正在反思最近發生的事...")
+        set_llm_agent(agent_name)
         
         recent_memories = await self.retriever.retrieve(
-            query=f"{agent_name} 最近發生了什麼事?",
+            query=REFLECTION_QUERY.format(agent_name=agent_name),
+            now=now,
             k=last_k,
             fetch_k=last_k * 2
         )
@@ -21,22 +38,15 @@ class Reflector:
             print("   沒有足夠的記憶可供反思。")
             return
 
-        observations = [m.page_content for m in recent_memories]
-        observations_str = "\n".join([f"- {o}" for o in observations])
-
-        prompt = ChatPromptTemplate.from_template("""
-        {observations}
-        
-        僅根據以上資訊，我們可以推斷出關於 {agent_name} 的哪 3 個最重要的高層次洞察 (Insights)？
-        請用繁體中文回答，列出 3 個不同的句子，每行一句。不要包含編號。
-        """)
-        
-        chain = prompt | self.llm
+        ctx = ContextBudget("reflect").fit([
+            Section("observations", memory_lines(recent_memories), max_tokens=1200, priority=0, dedupe=True),
+        ], template=REFLECTION_TEMPLATE)
+        chain = get_prompt(REFLECTION_TEMPLATE) | self.llm
         
         try:
-            response = chain.invoke({
-                "observations": observations_str, 
-                "agent_name": agent_name
+            response = await chain.ainvoke({
+                "agent_name": agent_name,
+                **ctx
             })
             insights = response.content.strip().split('\n') # 列出 3 個不同的句子，每行一句 => \n split
             
@@ -46,6 +56,7 @@ class Reflector:
                     print(f"   💡 生成洞察: {insight}")
                     await self.retriever.add_memory(
                         content=insight,
+                        created_at=now,
                         type="reflection"
                     )
                     
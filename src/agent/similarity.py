@@ -0,0 +1,32 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from src.executors import get_executor
+from src.llm_factory import get_similarity_embeddings
+
+# 活動 / 行動描述的 embedding 快取 (每天的計畫活動大多重複出現)
+_CACHE_SIZE = 1024
+_cache: "OrderedDict[str, np.ndarray]" = OrderedDict()
+_cache_lock = threading.Lock()
+
+def _embed(text: str) -> np.ndarray:
+    return np.asarray(get_similarity_embeddings().embed_query(text), dtype=np.float32)
+
+async def embed_for_similarity(text: str) -> np.ndarray:
+    """
+    [Async] 計畫比對 (plan repair / plan cache) 用的 embedding
+    使用多語言模型 (PLAN_SIMILARITY_MODEL_NAME)，在 embed executor 中執行，結果快取
+    """
+    with _cache_lock:
+        vector = _cache.get(text)
+        if vector is not None:
+            _cache.move_to_end(text)
+            return vector
+    vector = await get_executor("embed").run(_embed, text)
+    with _cache_lock:
+        _cache[text] = vector
+        while len(_cache) > _CACHE_SIZE:
+            _cache.popitem(last=False)
+    return vector
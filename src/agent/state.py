@@ -21,6 +21,8 @@ class AgentState(TypedDict):
     
     # 用於內部 Graph 流程控制 (不會存入 DB)
     skip_thinking: Optional[bool]
+    # 本 tick 的思考 deadline (event loop 的 loop.time())，超過就執行備用行動
+    tick_deadline: Optional[float]
 
     # --- 輸出 ---
     current_action: Optional[str]
@@ -1,27 +1,133 @@
 import os
+import threading
 from dotenv import load_dotenv
 
-# 強制載入 .env，如果找不到會報錯提醒
-if not load_dotenv():
-    print("Warning: .env file not found. Ensure environment variables are set.")
-
 class Config:
-    # LLM Settings
-    LLM_API_KEY = os.getenv("LLM_API_KEY")
-    LLM_HOST = os.getenv("LLM_HOST")
-    LLM_MODEL = os.getenv("LLM_MODEL")
-
-    # local 小模型設定 (用於 Scoring)
-    FAST_LLM_HOST = "http://localhost:11434" # 指向本地 Docker
-    FAST_LLM_MODEL = "llama3.2:1b"
-    
-    # Chroma Settings
-    CHROMA_HOST = os.getenv("CHROMA_HOST", "localhost")
-    CHROMA_PORT = os.getenv("CHROMA_PORT", "8000")
-    CHROMA_URL = f"http://{CHROMA_HOST}:{CHROMA_PORT}"
-
-    # Embedding Model (Local)
-    EMBEDDING_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+    """
+    所有設定都在建立實例時才從環境變數讀取
+    (模組 import 時不讀 .env，也不做驗證，見下方的 config proxy)
+    """
+
+    def __init__(self):
+        # LLM Settings
+        self.LLM_API_KEY = os.getenv("LLM_API_KEY")
+        self.LLM_HOST = os.getenv("LLM_HOST")
+        self.LLM_MODEL = os.getenv("LLM_MODEL")
+
+        # local 小模型設定 (用於 Scoring)
+        self.FAST_LLM_HOST = "http://localhost:11434" # 指向本地 Docker
+        self.FAST_LLM_MODEL = "llama3.2:1b"
+        # Ollama 在最後一次請求後把模型留在記憶體中的時間 (避免下一次呼叫重新載入模型)
+        self.OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")
+        # 共用 HTTP 連線池: 每個 host 的連線上限 / 閒置連線保留秒數 / 是否使用 HTTP/2 (需要 h2 套件)
+        self.OLLAMA_TIMEOUT = float(os.getenv("OLLAMA_TIMEOUT", "180"))
+        self.OLLAMA_MAX_CONNECTIONS = int(os.getenv("OLLAMA_MAX_CONNECTIONS", "16"))
+        self.OLLAMA_KEEPALIVE_EXPIRY = float(os.getenv("OLLAMA_KEEPALIVE_EXPIRY", "120"))
+        self.OLLAMA_HTTP2 = os.getenv("OLLAMA_HTTP2", "0") == "1"
+        # LLM 排程器: 每個 host 同時執行的請求上限，與 react / sentry 的 deadline (秒，0 = 不限制)
+        self.LLM_REMOTE_CONCURRENCY = int(os.getenv("LLM_REMOTE_CONCURRENCY", "4"))
+        self.LLM_LOCAL_CONCURRENCY = int(os.getenv("LLM_LOCAL_CONCURRENCY", "2"))
+        self.LLM_REACT_DEADLINE = float(os.getenv("LLM_REACT_DEADLINE", "90"))
+        self.LLM_SENTRY_DEADLINE = float(os.getenv("LLM_SENTRY_DEADLINE", "10"))
+        # 每次 LLM 呼叫的統計 (token 數 / prefill / decode / 排隊時間) 逐行寫入此 JSONL 檔 (空字串 = 不記錄)
+        # 彙整: python -m src.llm_telemetry <path>
+        self.LLM_TELEMETRY_PATH = os.getenv("LLM_TELEMETRY_PATH", "")
+        # tick tracing: 記錄每個 node 與內部操作的 span，結束時匯出 Chrome trace (chrome://tracing / Perfetto)
+        self.TRACE_ENABLED = os.getenv("TRACE_ENABLED", "0") == "1"
+        self.TRACE_PATH = os.getenv("TRACE_PATH", "traces/trace.json")
+        self.TRACE_MAX_SPANS = int(os.getenv("TRACE_MAX_SPANS", "200000"))
+        # 模型路由: role=後端>備援後端 (remote = LLM_HOST 大模型 / local = FAST_LLM_HOST 小模型)
+        self.LLM_ROUTES = os.getenv(
+            "LLM_ROUTES",
+            "react=remote>local,plan=remote>local,decompose=remote>local,reflect=remote,chat=remote,"
+            "score=local,sentry=local"
+        )
+        # 每個 role 單次嘗試的延遲預算 (秒)，超過就改用下一個後端 (最後一個後端不受限，只受 deadline 限制)
+        self.LLM_ROLE_BUDGETS = os.getenv("LLM_ROLE_BUDGETS", "react=45,plan=60,decompose=30,sentry=5,score=10")
+        # 後端失敗後暫停使用的秒數 (期間直接走備援)
+        self.LLM_BACKEND_COOLDOWN = float(os.getenv("LLM_BACKEND_COOLDOWN", "30"))
+        # hedged requests: 主要後端超過歷史延遲的 P{PERCENTILE} 還沒回應時，同時對備援後端送出同一個請求，先回來的勝出
+        self.LLM_HEDGE_ROLES = os.getenv("LLM_HEDGE_ROLES", "react")
+        self.LLM_HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "95"))
+        self.LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20")) # 樣本不足時以 budget 為準
+        # 每個 tick 的思考預算 (秒): 檢索 + react 決策必須在這段時間內完成，否則直接執行備用行動 (0 = 不限制)
+        self.LLM_TICK_BUDGET = float(os.getenv("LLM_TICK_BUDGET", "60"))
+
+        # Chroma Settings
+        self.CHROMA_HOST = os.getenv("CHROMA_HOST", "localhost")
+        self.CHROMA_PORT = os.getenv("CHROMA_PORT", "8000")
+        self.CHROMA_URL = f"http://{self.CHROMA_HOST}:{self.CHROMA_PORT}"
+        # 記憶庫模式: embedded (本地目錄持久化) / http (連到 docker-compose 的 server) / memory (不落地)
+        self.CHROMA_MODE = os.getenv("CHROMA_MODE", "embedded")
+        self.CHROMA_PERSIST_DIR = os.getenv("CHROMA_PERSIST_DIR", "./memory_data/chroma")
+
+        # 記憶儲存後端: chroma / numpy (純 NumPy，不需要 server)
+        self.MEMORY_STORE = os.getenv("MEMORY_STORE", "chroma")
+        self.NUMPY_STORE_DIR = os.getenv("NUMPY_STORE_DIR", "./memory_data/numpy")
+        # NumPy 後端的向量格式: float32 / float16 / int8 (壓縮後以精確向量重新計分前 k * factor 個候選)
+        self.NUMPY_VECTOR_DTYPE = os.getenv("NUMPY_VECTOR_DTYPE", "float32")
+        self.NUMPY_RESCORE_FACTOR = int(os.getenv("NUMPY_RESCORE_FACTOR", "4"))
+        # 落地時 active segment 超過這個筆數或存在超過這個秒數就封存成唯讀 memmap segment
+        self.NUMPY_SEGMENT_ROWS = int(os.getenv("NUMPY_SEGMENT_ROWS", "8192"))
+        self.NUMPY_SEAL_INTERVAL = float(os.getenv("NUMPY_SEAL_INTERVAL", "600"))
+
+        # 記憶存取時間寫回 DB 的頻率 (秒) 與提早寫回的累積門檻
+        self.ACCESS_FLUSH_INTERVAL = float(os.getenv("ACCESS_FLUSH_INTERVAL", "5"))
+        self.ACCESS_FLUSH_THRESHOLD = int(os.getenv("ACCESS_FLUSH_THRESHOLD", "256"))
+        # 待寫回的存取時間超過這個數量時，retrieve 先等寫回完成 (backpressure)
+        self.ACCESS_MAX_PENDING = int(os.getenv("ACCESS_MAX_PENDING", "4096"))
+
+        # 專用 executor 的 thread 數 (embedding / 向量庫 I/O) 與每個 pool 的排隊上限
+        self.EMBED_WORKERS = int(os.getenv("EMBED_WORKERS", "2"))
+        self.VECTOR_IO_WORKERS = int(os.getenv("VECTOR_IO_WORKERS", "8"))
+        self.EXECUTOR_MAX_QUEUE = int(os.getenv("EXECUTOR_MAX_QUEUE", "64"))
+
+        # 記憶壓縮與封存 (INTERVAL 為 0 時不啟動背景壓縮)
+        self.MEMORY_COMPACTION_INTERVAL = float(os.getenv("MEMORY_COMPACTION_INTERVAL", "0"))
+        self.MEMORY_MERGE_MAX_IMPORTANCE = int(os.getenv("MEMORY_MERGE_MAX_IMPORTANCE", "3"))
+        self.MEMORY_MERGE_SIMILARITY = float(os.getenv("MEMORY_MERGE_SIMILARITY", "0.95"))
+        self.MEMORY_ARCHIVE_AFTER_HOURS = float(os.getenv("MEMORY_ARCHIVE_AFTER_HOURS", "72"))
+        self.MEMORY_HOT_CAP = int(os.getenv("MEMORY_HOT_CAP", "0")) # 每個 agent 熱資料層上限，0 = 不限制
+        # segment 中已刪除 (合併 / 封存) 的比例超過此值時重寫該 segment，回收空間與掃描成本
+        self.MEMORY_VACUUM_RATIO = float(os.getenv("MEMORY_VACUUM_RATIO", "0.3"))
+        # 所有 agent 共用一個 collection (以 agent_id 分區)，空字串 = 每個 agent 各自一個 collection
+        self.MEMORY_SHARED_COLLECTION = os.getenv("MEMORY_SHARED_COLLECTION", "")
+
+        # decompose_activity 的語意快取: 相似的活動 (同 agent、同時長區間) 重用之前的子任務
+        self.PLAN_CACHE_ENABLED = os.getenv("PLAN_CACHE_ENABLED", "1") == "1"
+        self.PLAN_CACHE_THRESHOLD = float(os.getenv("PLAN_CACHE_THRESHOLD", "0.92")) # cosine 相似度下限 (PLAN_SIMILARITY_MODEL_NAME)
+        self.PLAN_CACHE_MAX_AGE_HOURS = float(os.getenv("PLAN_CACHE_MAX_AGE_HOURS", "72")) # 模擬時間
+        self.PLAN_CACHE_MAX_REUSE = int(os.getenv("PLAN_CACHE_MAX_REUSE", "10")) # 重用幾次後重新生成，0 = 不限
+
+        # react 要求重規劃時，先在本地修正時間 (超時 / 提早)，語意不同才交給 LLM
+        self.PLAN_REPAIR_SIMILARITY = float(os.getenv("PLAN_REPAIR_SIMILARITY", "0.6"))
+        self.PLAN_REPLAN_DEBOUNCE_MINUTES = float(os.getenv("PLAN_REPLAN_DEBOUNCE_MINUTES", "60")) # 模擬時間
+        self.PLAN_MIN_BLOCK_MINUTES = int(os.getenv("PLAN_MIN_BLOCK_MINUTES", "15"))
+
+        # Prompt 組裝: 各區塊依 token 預算截斷 (TOKENIZER 為空時以字元數估算 token)
+        self.PROMPT_MAX_TOKENS = int(os.getenv("PROMPT_MAX_TOKENS", "2048"))
+        self.PROMPT_TOKENIZER = os.getenv("PROMPT_TOKENIZER", "")
+
+        # Embedding Model (Local)
+        self.EMBEDDING_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+        # 計畫比對 (plan repair / plan cache) 用的模型: 活動名稱是中文，MiniLM-L6 只訓練過英文，
+        # 相關與無關的活動分不開，這裡改用多語言模型 (與 EMBEDDING_MODEL_NAME 相同時共用同一份)
+        self.PLAN_SIMILARITY_MODEL_NAME = os.getenv(
+            "PLAN_SIMILARITY_MODEL_NAME", "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
+        )
+        # >0 時 embedding 改由獨立的 worker process 執行 (跨 agent 的請求合併成大 batch)
+        self.EMBEDDING_SERVICE_WORKERS = int(os.getenv("EMBEDDING_SERVICE_WORKERS", "0"))
+        self.EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "64"))
+        self.EMBEDDING_MAX_WAIT_MS = float(os.getenv("EMBEDDING_MAX_WAIT_MS", "5"))
+        # hf: 原本的 HuggingFaceEmbeddings / cpu: CPUEmbeddingEngine
+        self.EMBEDDING_ENGINE = os.getenv("EMBEDDING_ENGINE", "hf")
+        # CPUEmbeddingEngine 的推論後端: torch / torch-int8 / onnx-int8
+        self.EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch-int8")
+        self.EMBEDDING_ONNX_FILE = os.getenv("EMBEDDING_ONNX_FILE", "onnx/model_quint8_avx2.onnx")
+        self.EMBEDDING_THREADS = int(os.getenv("EMBEDDING_THREADS", "0")) # 0 = 全部核心
+        # 啟動時自動挑選 batch size 與 thread 數 (單一 batch 延遲不超過 MAX_BATCH_LATENCY_MS)
+        self.EMBEDDING_AUTOTUNE = os.getenv("EMBEDDING_AUTOTUNE", "0") == "1"
+        self.EMBEDDING_MAX_BATCH_LATENCY_MS = float(os.getenv("EMBEDDING_MAX_BATCH_LATENCY_MS", "50"))
 
     def validate(self):
         """簡單的驗證邏輯，確保關鍵變數存在"""
@@ -29,6 +135,44 @@ class Config:
             raise ValueError("Missing LLM_API_KEY in .env")
         if not self.LLM_HOST:
             raise ValueError("Missing LLM_HOST in .env")
+        if self.CHROMA_MODE not in ("embedded", "http", "memory"):
+            raise ValueError(f"Unknown CHROMA_MODE: {self.CHROMA_MODE}")
+        if self.MEMORY_STORE not in ("chroma", "numpy"):
+            raise ValueError(f"Unknown MEMORY_STORE: {self.MEMORY_STORE}")
+        for route in self.LLM_ROUTES.split(","):
+            role, _, backends = route.partition("=")
+            if not backends or any(b.strip() not in ("remote", "local") for b in backends.split(">")):
+                raise ValueError(f"Invalid LLM_ROUTES entry: {route!r}")
+        if self.EMBEDDING_ENGINE not in ("hf", "cpu"):
+            raise ValueError(f"Unknown EMBEDDING_ENGINE: {self.EMBEDDING_ENGINE}")
+
+_config: "Config" = None
+_config_lock = threading.Lock()
+
+def load_config() -> Config:
+    """第一次用到設定時才載入 .env 並驗證 (整個 process 只做一次)"""
+    global _config
+    if _config is None:
+        with _config_lock:
+            if _config is None:
+                # 強制載入 .env，如果找不到會報錯提醒
+                if not load_dotenv():
+                    print("Warning: .env file not found. Ensure environment variables are set.")
+                loaded = Config()
+                loaded.validate()
+                _config = loaded
+    return _config
+
+class _LazyConfig:
+    """
+    `from src.config import config` 仍然可以直接使用，
+    但直到第一次讀取屬性時才真正載入設定
+    """
+
+    def __getattr__(self, name):
+        return getattr(load_config(), name)
+
+    def __setattr__(self, name, value):
+        setattr(load_config(), name, value)
 
-config = Config()
-config.validate()
\ No newline at end of file
+config = _LazyConfig()
\ No newline at end of file
@@ -0,0 +1,405 @@
+import atexit
+import multiprocessing as mp
+import os
+import queue
+import threading
+import time
+import weakref
+from concurrent.futures import Future, ThreadPoolExecutor
+from multiprocessing import shared_memory
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from src.config import config
+
+# ==========================================
+# 1. 跨請求合併 (Dynamic Batching)
+# ==========================================
+class DynamicBatcher:
+    """
+    把多個呼叫端 (多個 agent) 同時送進來的小請求合併成一個大 batch
+
+    submit(items) ---> 請求佇列 ---> collector thread
+                                      | 等到湊滿 max_batch 筆，或第一筆已經等了 max_wait_ms
+                                      v
+                              fn(合併後的 items) ---> 一個 (N, dim) 陣列
+                                      |
+                                      +--> 依原本的順序切回各請求 (slice 是 view，不複製)
+
+    max_concurrency > 1 時，多個 batch 可以同時執行 (例如多個 worker process)
+    """
+
+    def __init__(
+        self,
+        fn: Callable[[List[str]], np.ndarray],
+        max_batch: int = 64,
+        max_wait_ms: float = 5.0,
+        max_concurrency: int = 1,
+        name: str = "batcher",
+    ):
+        self.fn = fn
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.0
+        self._requests: "queue.Queue[Optional[Tuple[List[str], Future]]]" = queue.Queue()
+        self._pool = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix=f"{name}-run-")
+        self._closed = False
+        # 統計: 合併後的平均 batch 大小
+        self.batches = 0
+        self.items = 0
+        self._collector = threading.Thread(target=self._collect, name=f"{name}-collect", daemon=True)
+        self._collector.start()
+
+    def submit(self, items: Sequence[str]) -> Future:
+        """送出一個請求，回傳的 Future 結果為 (len(items), dim) 的陣列"""
+        future: Future = Future()
+        if self._closed:
+            future.set_exception(RuntimeError("Batcher is closed"))
+            return future
+        if not items:
+            future.set_result(np.zeros((0, 0), dtype=np.float32))
+            return future
+        self._requests.put((list(items), future))
+        return future
+
+    def __call__(self, items: Sequence[str]) -> np.ndarray:
+        """同步版本: 送出並等待結果"""
+        return self.submit(items).result()
+
+    def _collect(self):
+        while True:
+            first = self._requests.get()
+            if first is None:
+                break
+            batch = [first]
+            size = len(first[0])
+            deadline = time.monotonic() + self.max_wait
+            while size < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    nxt = self._requests.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if nxt is None:
+                    self._requests.put(None) # 處理完這個 batch 再結束
+                    break
+                batch.append(nxt)
+                size += len(nxt[0])
+            self._pool.submit(self._run, batch)
+            # 等下一個請求前先放掉參照 (結果可能是 worker 輸出區上的 view，不要讓它一直被借著)
+            first = nxt = batch = None
+
+    def _run(self, batch: List[Tuple[List[str], Future]]):
+        items = [item for req, _ in batch for item in req]
+        try:
+            vectors = self.fn(items)
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        self.batches += 1
+        self.items += len(items)
+        start = 0
+        for req, future in batch:
+            future.set_result(vectors[start:start + len(req)])
+            start += len(req)
+
+    def mean_batch_size(self) -> float:
+        return self.items / self.batches if self.batches else 0.0
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._requests.put(None)
+        self._collector.join(timeout=5)
+        self._pool.shutdown(wait=True)
+
+# ==========================================
+# 2. Worker process
+# ==========================================
+def load_hf_embeddings(model_name: str):
+    """預設的模型載入函式 (在 worker process 中執行)"""
+    if config.EMBEDDING_ENGINE == "cpu":
+        # worker 之間已經由 EmbeddingService 合併請求，不需要再開一層 batcher
+        from src.llm_factory import build_cpu_engine
+        return build_cpu_engine(model_name, batching=False)
+    from langchain_huggingface import HuggingFaceEmbeddings
+    return HuggingFaceEmbeddings(model_name=model_name)
+
+def _worker_main(conn, model_name: str, threads: int, loader: Callable):
+    """
+    worker process 主迴圈
+    - 啟動後載入模型，回報向量維度
+    - 收到 ("attach", (slot, name)) 後接上主程序建立的輸出 shared memory
+    - 收到 ("embed", (slot, texts)) 後把向量直接寫進第 slot 個輸出區，只回傳筆數
+    """
+    if threads > 0:
+        os.environ.setdefault("OMP_NUM_THREADS", str(threads))
+        try:
+            import torch
+            torch.set_num_threads(threads)
+        except ImportError:
+            pass
+    buffers: Dict[int, shared_memory.SharedMemory] = {}
+    try:
+        model = loader(model_name)
+        dim = len(model.embed_query("warmup"))
+        conn.send(("ready", dim))
+        while True:
+            msg = conn.recv()
+            if msg is None:
+                break
+            kind, payload = msg
+            if kind == "attach":
+                # 由主程序建立與 unlink (spawn 出來的 worker 共用主程序的 resource tracker)
+                slot, name = payload
+                buffers[slot] = shared_memory.SharedMemory(name=name)
+                continue
+            slot, texts = payload
+            try:
+                vectors = np.asarray(model.embed_documents(texts), dtype=np.float32)
+                out = np.ndarray((len(texts), dim), dtype=np.float32, buffer=buffers[slot].buf)
+                out[:] = vectors
+                del out
+                conn.send(("ok", len(texts)))
+            except Exception as e:
+                conn.send(("error", repr(e)))
+    except (EOFError, KeyboardInterrupt):
+        pass
+    except Exception as e:
+        conn.send(("error", repr(e)))
+    finally:
+        for shm in buffers.values():
+            shm.close()
+
+class _Worker:
+    """
+    一個 worker process 與它的輸出區 (shared memory)
+    embed() 回傳的是輸出區上的 view (不複製)，輸出區在 view 與所有切片都被回收後才會再借出；
+    輸出區預設兩個 (雙緩衝)，呼叫端還持有舊結果時再加開一個。長期保存結果時請自行 copy
+    """
+
+    def __init__(self, ctx, index: int, model_name: str, threads: int, rows: int, loader: Callable):
+        self.index = index
+        self.rows = rows
+        self.conn, child = ctx.Pipe()
+        self.process = ctx.Process(
+            target=_worker_main, args=(child, model_name, threads, loader),
+            name=f"embed-worker-{index}", daemon=True
+        )
+        self.process.start()
+        child.close()
+        self.dim: Optional[int] = None
+        self._buffers: List[shared_memory.SharedMemory] = []
+        self._free: "queue.Queue[int]" = queue.Queue() # 可以借出的輸出區 (slot)
+
+    def wait_ready(self, timeout: float):
+        if not self.conn.poll(timeout):
+            raise TimeoutError(f"Embedding worker {self.index} did not start in {timeout}s")
+        kind, payload = self.conn.recv()
+        if kind != "ready":
+            raise RuntimeError(f"Embedding worker {self.index} failed: {payload}")
+        self.dim = payload
+        for _ in range(2):
+            self._free.put(self._add_buffer())
+
+    def _add_buffer(self) -> int:
+        shm = shared_memory.SharedMemory(create=True, size=self.rows * self.dim * 4)
+        slot = len(self._buffers)
+        self._buffers.append(shm)
+        self.conn.send(("attach", (slot, shm.name)))
+        return slot
+
+    def _lease(self) -> int:
+        try:
+            return self._free.get_nowait()
+        except queue.Empty:
+            # 輸出區都還被呼叫端持有，加開一個 (不覆寫別人還在用的結果)
+            return self._add_buffer()
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        slot = self._lease()
+        try:
+            self.conn.send(("embed", (slot, texts)))
+            kind, payload = self.conn.recv()
+            if kind != "ok":
+                raise RuntimeError(f"Embedding worker {self.index} failed: {payload}")
+        except BaseException:
+            self._free.put(slot)
+            raise
+        view = np.ndarray((payload, self.dim), dtype=np.float32, buffer=self._buffers[slot].buf)
+        # view (與從它切出來的 view) 都被回收後，輸出區才歸還
+        weakref.finalize(view, self._free.put, slot)
+        return view
+
+    def leased(self) -> int:
+        """目前被呼叫端持有的輸出區數量"""
+        return len(self._buffers) - self._free.qsize()
+
+    def close(self):
+        try:
+            self.conn.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.terminate()
+        for shm in self._buffers:
+            try:
+                shm.close()
+            except BufferError:
+                pass # 呼叫端還持有 view，等 view 回收時才會真正釋放映射
+            shm.unlink()
+        self._buffers = []
+
+# ==========================================
+# 3. Embedding Service
+# ==========================================
+class EmbeddingService:
+    """
+    多 process 的 embedding 服務 (避開 GIL 與單一 torch intra-op pool)
+
+    agent (thread) --submit--> DynamicBatcher --合併--> 閒置的 worker process
+                                                        | 文字經 pipe 送出
+                                                        | 向量寫入 shared memory (不經過 pickle)
+                                                        v
+                                  (N, dim) float32 (輸出區上的 view) ---> 依請求切成 view 回傳
+
+    每個 worker 使用 cpu_count // workers 個 torch thread，worker 之間不互搶核心
+    worker process 意外結束時重新啟動 (啟動失敗就移除，剩下的 worker 繼續服務)
+    """
+
+    def __init__(
+        self,
+        model_name: str,
+        workers: int = 2,
+        max_batch: int = 64,
+        max_wait_ms: float = 5.0,
+        threads_per_worker: Optional[int] = None,
+        loader: Callable = load_hf_embeddings,
+        start_timeout: float = 300.0,
+    ):
+        ctx = mp.get_context("spawn") # torch 與 fork 不相容
+        threads = threads_per_worker or max(1, (os.cpu_count() or 1) // workers)
+        self.max_batch = max_batch
+        # 重新啟動 worker 時使用
+        self._spawn = lambda index: _Worker(ctx, index, model_name, threads, max_batch, loader)
+        self._start_timeout = start_timeout
+        self._workers_lock = threading.Lock()
+        self._workers = [self._spawn(i) for i in range(workers)]
+        try:
+            for worker in self._workers:
+                worker.wait_ready(start_timeout)
+        except Exception:
+            self.close()
+            raise
+        self.dim = self._workers[0].dim
+        self._idle: "queue.Queue[_Worker]" = queue.Queue()
+        for worker in self._workers:
+            self._idle.put(worker)
+        self.batcher = DynamicBatcher(
+            self._embed_batch, max_batch=max_batch, max_wait_ms=max_wait_ms,
+            max_concurrency=workers, name="embed"
+        )
+        self._closed = False
+        print(f"🧮 [EmbeddingService] {workers} worker(s) ready (dim={self.dim}, {threads} thread(s) each).")
+
+    def _acquire(self) -> _Worker:
+        while True:
+            try:
+                return self._idle.get(timeout=1.0)
+            except queue.Empty:
+                with self._workers_lock:
+                    if not self._workers:
+                        raise RuntimeError("No embedding worker is alive")
+
+    def _embed_batch(self, texts: List[str]) -> np.ndarray:
+        worker = self._acquire()
+        try:
+            if len(texts) <= self.max_batch:
+                result = worker.embed(texts)
+            else:
+                # 單一請求比輸出區大時分段處理，直接寫進同一個結果陣列
+                result = np.empty((len(texts), self.dim), dtype=np.float32)
+                for i in range(0, len(texts), self.max_batch):
+                    result[i:i + self.max_batch] = worker.embed(texts[i:i + self.max_batch])
+        except Exception:
+            if worker.process.is_alive():
+                self._idle.put(worker)
+            else:
+                self._restart(worker)
+            raise
+        self._idle.put(worker)
+        return result
+
+    def _restart(self, worker: _Worker):
+        """worker process 已經結束: 啟動新的 worker 取代，失敗時移除 (不放回閒置佇列)"""
+        print(f"⚠️ [EmbeddingService] worker {worker.index} exited (code {worker.process.exitcode}), restarting.")
+        worker.close()
+        replacement = None
+        try:
+            replacement = self._spawn(worker.index)
+            replacement.wait_ready(self._start_timeout)
+        except Exception as e:
+            print(f"❌ [EmbeddingService] worker {worker.index} restart failed: {e}")
+            if replacement is not None:
+                replacement.close()
+            replacement = None
+        with self._workers_lock:
+            self._workers.remove(worker)
+            if replacement is not None and not self._closed:
+                self._workers.append(replacement)
+                self._idle.put(replacement)
+            elif replacement is not None:
+                replacement.close()
+
+    def embed(self, texts: Sequence[str]) -> np.ndarray:
+        """同步介面: 回傳 (len(texts), dim) 的 float32 陣列 (worker 輸出區上的 view，長期保存請 copy)"""
+        return self.batcher(texts)
+
+    def close(self):
+        if getattr(self, "_closed", False):
+            return
+        self._closed = True
+        if hasattr(self, "batcher"):
+            self.batcher.close()
+        with self._workers_lock:
+            workers, self._workers = self._workers, []
+        for worker in workers:
+            worker.close()
+
+class ServiceEmbeddings:
+    """LangChain Embeddings 介面 (embed_query / embed_documents)，背後交給 EmbeddingService"""
+
+    def __init__(self, service: EmbeddingService):
+        self.service = service
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.service.embed(texts).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.service.embed([text])[0].tolist()
+
+    def embed_array(self, texts: List[str]) -> np.ndarray:
+        """直接回傳 NumPy 陣列 (不轉成 list，也不複製輸出區)"""
+        return self.service.embed(texts)
+
+_service: Optional[EmbeddingService] = None
+_service_lock = threading.Lock()
+
+def get_embedding_service() -> EmbeddingService:
+    """整個 process 共用一個 EmbeddingService (第一次呼叫時啟動 worker)"""
+    global _service
+    with _service_lock:
+        if _service is None:
+            _service = EmbeddingService(
+                config.EMBEDDING_MODEL_NAME,
+                workers=config.EMBEDDING_SERVICE_WORKERS,
+                max_batch=config.EMBEDDING_BATCH_SIZE,
+                max_wait_ms=config.EMBEDDING_MAX_WAIT_MS,
+            )
+            atexit.register(_service.close)
+        return _service
@@ -0,0 +1,130 @@
+import asyncio
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict
+
+from src.config import config
+
+class BoundedExecutor:
+    """
+    有上限的專用 thread pool (取代共用 default executor 的 asyncio.to_thread)
+
+    - max_workers: 同時執行的 thread 數
+    - max_queue:   已送進 pool 但還沒開始執行的上限，超過時呼叫端在 await 上等待 (backpressure)，
+                   而不是把工作無限制地堆在 pool 的 queue 裡
+    - stats():     queue 深度 / 執行中數量 / 平均等待時間，用來觀察哪一類工作塞住了
+    """
+
+    def __init__(self, name: str, max_workers: int, max_queue: int):
+        self.name = name
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f"{name}-")
+        self._lock = threading.Lock()
+        # asyncio.Semaphore 綁定 event loop，每個 loop 各一個
+        self._gates: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore]" = \
+            weakref.WeakKeyDictionary()
+
+        self._waiting = 0   # 因 backpressure 還沒送進 pool
+        self._queued = 0    # 在 pool 的 queue 中
+        self._running = 0
+        self._submitted = 0
+        self._completed = 0
+        self._max_depth = 0
+        self._total_wait = 0.0
+
+    def _gate(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        gate = self._gates.get(loop)
+        if gate is None:
+            gate = self._gates[loop] = asyncio.Semaphore(self.max_workers + self.max_queue)
+        return gate
+
+    def _wrap(self, fn: Callable, args, kwargs, enqueued_at: float):
+        def call():
+            with self._lock:
+                self._queued -= 1
+                self._running += 1
+                self._total_wait += time.perf_counter() - enqueued_at
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self._running -= 1
+                    self._completed += 1
+        return call
+
+    async def run(self, fn: Callable, *args, **kwargs) -> Any:
+        """[Async] 在此 pool 中執行同步函式 (用法同 asyncio.to_thread)"""
+        gate = self._gate()
+        with self._lock:
+            self._waiting += 1
+        try:
+            await gate.acquire()
+        finally:
+            with self._lock:
+                self._waiting -= 1
+        try:
+            enqueued_at = time.perf_counter()
+            with self._lock:
+                self._queued += 1
+                self._submitted += 1
+                self._max_depth = max(self._max_depth, self._queued)
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._pool, self._wrap(fn, args, kwargs, enqueued_at))
+        finally:
+            gate.release()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            started = self._completed + self._running
+            return {
+                "name": self.name,
+                "workers": self.max_workers,
+                "waiting": self._waiting,
+                "queued": self._queued,
+                "running": self._running,
+                "submitted": self._submitted,
+                "completed": self._completed,
+                "max_queue_depth": self._max_depth,
+                "avg_wait_ms": round(self._total_wait / started * 1000, 2) if started else 0.0,
+            }
+
+    def shutdown(self, wait: bool = True):
+        self._pool.shutdown(wait=wait)
+
+# ==========================================
+# 各類工作的專用 pool
+# embed:     CPU 密集 (本地 embedding 模型)，thread 數少，避免與 torch 內部的平行化互搶
+# vector_io: DB 讀寫 (Chroma / NumPy memmap)，多半在等 I/O
+# ==========================================
+_executors: Dict[str, BoundedExecutor] = {}
+_registry_lock = threading.Lock()
+
+def _sizes() -> Dict[str, int]:
+    # 使用 EmbeddingService 時，embed thread 只是在等 worker process 回傳，
+    # 要足夠多才能讓多個 agent 的請求被合併成同一個 batch
+    embed_workers = config.EMBED_WORKERS
+    if config.EMBEDDING_SERVICE_WORKERS > 0:
+        embed_workers = max(embed_workers, config.EMBEDDING_BATCH_SIZE)
+    return {
+        "embed": embed_workers,
+        "vector_io": config.VECTOR_IO_WORKERS,
+    }
+
+def get_executor(kind: str) -> BoundedExecutor:
+    """取得 embed / vector_io 的共用 executor (整個 process 一份)"""
+    with _registry_lock:
+        if kind not in _executors:
+            sizes = _sizes()
+            if kind not in sizes:
+                raise ValueError(f"Unknown executor: {kind}")
+            _executors[kind] = BoundedExecutor(kind, sizes[kind], config.EXECUTOR_MAX_QUEUE)
+        return _executors[kind]
+
+def executor_stats() -> Dict[str, Dict[str, Any]]:
+    """所有已建立 executor 的 queue 深度等指標"""
+    with _registry_lock:
+        return {kind: ex.stats() for kind, ex in _executors.items()}
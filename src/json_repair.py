@@ -0,0 +1,152 @@
+import json
+import re
+from typing import Any, Dict, Optional, Type
+
+from langchain_core.exceptions import OutputParserException
+from langchain_core.output_parsers import BaseOutputParser
+from pydantic import BaseModel, ValidationError
+
+_FENCE = re.compile(r"```(?:json|JSON)?\s*(.*?)```", re.DOTALL)
+_TRAILING_COMMA = re.compile(r",\s*([}\]])")
+_PY_LITERALS = {"True": "true", "False": "false", "None": "null"}
+
+def _extract_block(text: str) -> str:
+    """取出第一個完整的 {...} 或 [...] (略過前後的說明文字)"""
+    start = min((i for i in (text.find("{"), text.find("[")) if i >= 0), default=-1)
+    if start < 0:
+        return text
+    stack, in_string, escaped = [], False, False
+    for i in range(start, len(text)):
+        ch = text[i]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == "\\":
+                escaped = True
+            elif ch == '"':
+                in_string = False
+            continue
+        if ch == '"':
+            in_string = True
+        elif ch in "{[":
+            stack.append("}" if ch == "{" else "]")
+        elif ch in "}]":
+            if stack and stack[-1] == ch:
+                stack.pop()
+            if not stack:
+                return text[start:i + 1]
+    # 輸出被截斷: 補上缺少的結尾括號
+    tail = '"' if in_string else ""
+    return text[start:] + tail + "".join(reversed(stack))
+
+def _replace_outside_strings(text: str) -> str:
+    """只在字串外把 Python 常值換成 JSON 常值"""
+    parts = re.split(r'("(?:\\.|[^"\\])*")', text)
+    for i in range(0, len(parts), 2):
+        parts[i] = re.sub(r"\b(True|False|None)\b", lambda m: _PY_LITERALS[m.group(1)], parts[i])
+    return "".join(parts)
+
+def repair_json(text: str) -> Any:
+    """
+    容錯的 JSON 解析 (本地修復，不需要再呼叫一次 LLM)
+    1. 去掉 ```json 圍欄
+    2. 只取第一個 JSON 物件 / 陣列，截斷的結尾會補上括號
+    3. 移除結尾多餘的逗號，把 True / False / None 換成 JSON 常值
+    """
+    text = text.strip()
+    fenced = _FENCE.search(text)
+    if fenced:
+        text = fenced.group(1).strip()
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError:
+        pass
+    candidate = _extract_block(text)
+    candidate = _TRAILING_COMMA.sub(r"\1", candidate)
+    candidate = _replace_outside_strings(candidate)
+    return json.loads(candidate)
+
+class RepairingJsonParser(BaseOutputParser[Any]):
+    """
+    取代 JsonOutputParser / PydanticOutputParser:
+    先以 repair_json 修復常見的格式問題，再 (選擇性地) 以 Pydantic model 驗證
+    """
+    pydantic_object: Optional[Type[BaseModel]] = None
+
+    def parse(self, text: str) -> Any:
+        try:
+            data = repair_json(text)
+        except json.JSONDecodeError as e:
+            raise OutputParserException(f"Invalid JSON: {e}", llm_output=text) from e
+        if self.pydantic_object is None:
+            return data
+        try:
+            return self.pydantic_object.model_validate(data)
+        except ValidationError as e:
+            raise OutputParserException(f"Schema mismatch: {e}", llm_output=text) from e
+
+    @property
+    def _type(self) -> str:
+        return "repairing_json"
+
+class IncrementalJsonObject:
+    """
+    串流用的增量 JSON 解析: 逐段 feed LLM 輸出，頂層物件中已經完整的欄位會立刻出現在 fields
+    (欄位是否完整以頂層的 , 或 } 判斷，所以數字 / 布林值要等到下一個分隔符號才算完成)
+    """
+
+    def __init__(self):
+        self.fields: Dict[str, Any] = {}
+        self.done = False
+        self._buf = ""
+        self._pos = 0             # 下一個要掃描的位置
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._member_start = -1   # 目前這個 "key": value 的起點
+
+    def feed(self, text: str) -> Dict[str, Any]:
+        """加入新的輸出片段，回傳目前所有完整的欄位"""
+        self._buf += text
+        buf = self._buf
+        i = self._pos
+        while i < len(buf) and not self.done:
+            ch = buf[i]
+            if self._depth == 0:
+                # 略過 { 之前的內容 (例如 ```json)
+                if ch == "{":
+                    self._depth = 1
+                    self._member_start = i + 1
+            elif self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif ch == "\\":
+                    self._escaped = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                self._in_string = True
+            elif ch in "{[":
+                self._depth += 1
+            elif ch in "}]":
+                self._depth -= 1
+                if self._depth == 0:
+                    self._close_member(buf[self._member_start:i])
+                    self.done = True
+            elif ch == "," and self._depth == 1:
+                self._close_member(buf[self._member_start:i])
+                self._member_start = i + 1
+            i += 1
+        self._pos = i
+        return self.fields
+
+    def _close_member(self, segment: str):
+        segment = segment.strip()
+        if not segment:
+            return
+        try:
+            member = repair_json("{" + segment + "}")
+        except json.JSONDecodeError:
+            return
+        if isinstance(member, dict):
+            self.fields.update(member)
@@ -1,51 +1,62 @@
 import os
+import time
 import ollama
-from typing import Any, List, Optional, Dict
-from pydantic import Field, PrivateAttr
+import numpy as np
+import threading
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Sequence, Tuple, Type, Union
+from pydantic import BaseModel, Field, PrivateAttr
 
 # LangChain Core Imports
 from langchain_core.language_models.chat_models import BaseChatModel
-from langchain_core.messages import BaseMessage, SystemMessage, AIMessage, HumanMessage
-from langchain_core.outputs import ChatResult, ChatGeneration
-from langchain_huggingface import HuggingFaceEmbeddings
+from langchain_core.messages import BaseMessage, SystemMessage, AIMessage, AIMessageChunk, HumanMessage
+from langchain_core.outputs import ChatResult, ChatGeneration, ChatGenerationChunk
 from src.config import config
+from src.ollama_pool import get_async_ollama_client, get_ollama_client
+from src.llm_scheduler import current_llm_agent, llm_slot
+from src.llm_telemetry import record_llm_call
+from src.tracing import record_span
+
+# ==========================================
+# Ollama 回應統計 (prefill / decode)
+# ==========================================
+# Ollama 回傳的時間單位是奈秒；prompt_eval_count 只算實際計算的 token (命中 KV cache 的前綴不算)
+_OLLAMA_STATS = ("prompt_eval_count", "prompt_eval_duration", "eval_count", "eval_duration",
+                 "load_duration", "total_duration")
+
+def _response_stats(response: Any) -> Dict[str, int]:
+    return {k: response.get(k) for k in _OLLAMA_STATS if response.get(k) is not None}
 
 class NCKUCustomLLM(BaseChatModel):
     """
-    LangChain → NCKUCustomLLM() → 直接觸發 Ollama API → NCKU Server
+    LangChain → NCKUCustomLLM() → 直接觸發 Ollama API → NCKU Server / 本地 Ollama
     直接使用官方 ollama library 連接 NCKU, 完全繞過 langchain-ollama 的連線邏輯。
     這保證了 Header 一定會被發送。
     1. 繼承 BaseChatModel
     2. 實作 generate
+
+    host / api_key 相同的實例共用同一個 client (見 src/ollama_pool.py)，
+    不會每次 get_llm() 都建立新的連線池
     """
     # LangChain 會嘗試將 模型的屬性轉成 JSON / dict (序列化)
-    model_name: str = Field(default=config.LLM_MODEL)
+    model_name: str = Field(default_factory=lambda: config.LLM_MODEL) # 建立實例時才讀設定
     temperature: float = Field(default=0.7)
+    host: str = Field(default_factory=lambda: config.LLM_HOST)
+    # 金鑰不序列化、不出現在 repr 中
+    api_key: Optional[str] = Field(default_factory=lambda: config.LLM_API_KEY, exclude=True, repr=False)
+    # Ollama 輸出格式: "json" 或 JSON schema (dict)，後者由伺服器端限制輸出結構
+    format: Optional[Union[str, Dict[str, Any]]] = Field(default=None, description="Ollama 輸出格式，json 或 JSON schema")
+    keep_alive: Optional[str] = Field(default_factory=lambda: config.OLLAMA_KEEP_ALIVE)
+    # 用途 (react / plan / decompose / reflect / score / sentry / chat)，決定排程優先權
+    role: str = Field(default="chat")
     _client: ollama.Client = PrivateAttr() # 設定不被序列化, 因為有 key
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
-        self._client = ollama.Client(
-            host=config.LLM_HOST,
-            headers={'Authorization': f'Bearer {config.LLM_API_KEY}'},
-            timeout=180
-        )
         # client 就是一個「用來連線到遠端服務的物件」把「發送請求 → 收到回應」這件事包裝起來
+        self._client = get_ollama_client(self.host, self.api_key)
 
-    def _generate(
-        self,
-        messages: List[BaseMessage],
-        stop: Optional[List[str]] = None,
-        run_manager: Any = None,
-        **kwargs: Any,
-    ) -> ChatResult:
-        """
-        實作 LangChain 的生成介面
-        把 langChain 的參數格式改成 ollama dict
-        塞進 client.chat 取得 response
-        包裝成 LangChain 格式回傳
-        """
-        
+    def _chat_kwargs(self, messages: List[BaseMessage]) -> Dict[str, Any]:
+        """把 langChain 的參數格式改成 ollama dict"""
         # 轉換訊息格式 (LangChain Message -> Ollama Dict)
         ollama_messages = []
         for msg in messages:
@@ -59,26 +70,150 @@ class NCKUCustomLLM(BaseChatModel):
                 "role": role,
                 "content": msg.content
             })
+        return {
+            "model": self.model_name,
+            "messages": ollama_messages,
+            "format": self.format,
+            "keep_alive": self.keep_alive, # 讓模型常駐，避免下一次呼叫重新載入
+            "options": {
+                "temperature": self.temperature,
+            }
+        }
 
+    def _record_call(self, started: float, queue_wait: Optional[float], stats: Dict[str, int],
+                     status: str, stream: bool):
+        """寫入 LLM_TELEMETRY_PATH (見 src/llm_telemetry.py) 並記錄 tracing span"""
+        record_llm_call(
+            model=self.model_name, role=self.role, agent=current_llm_agent(), host=self.host,
+            stream=stream, status=status, started=started, queue_wait=queue_wait, stats=stats,
+        )
+        record_span(f"llm.{self.role}", "llm", started, host=self.host, status=status,
+                    prompt_tokens=stats.get("prompt_eval_count"), eval_tokens=stats.get("eval_count"))
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Any = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        """
+        實作 LangChain 的生成介面 (同步版本，不經過排程器)
+        塞進 client.chat 取得 response
+        包裝成 LangChain 格式回傳
+        """
         # 呼叫 NCKU API (使用官方 Client)
+        started, stats, status = time.perf_counter(), {}, "cancelled"
         try:
-            response = self._client.chat(
-                model=self.model_name,
-                messages=ollama_messages,
-                options={
-                    "temperature": self.temperature,
-                }
-            )
-            
+            response = self._client.chat(**self._chat_kwargs(messages))
             generated_text = response['message']['content']
+            stats = _response_stats(response)
+            status = "ok"
             
             return ChatResult(
-                generations=[ChatGeneration(message=AIMessage(content=generated_text))]
+                generations=[ChatGeneration(message=AIMessage(content=generated_text, response_metadata=stats))]
             )
             
         except Exception as e:
+            status = type(e).__name__
             print(f"NCKU API Error: {e}")
             raise e
+        finally:
+            self._record_call(started, None, stats, status, stream=False)
+
+    async def _agenerate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Any = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        """
+        非同步版本 (ainvoke / abatch 會走這裡)
+        先向排程器取得此 host 的名額 (依 role 決定優先權)，逾時會直接取消請求
+        """
+        # 被取消 (hedge 落後 / deadline) 時 status 維持 cancelled
+        started, queue_wait, stats, status = time.perf_counter(), None, {}, "cancelled"
+        try:
+            async with llm_slot(self.host, self.role) as queue_wait:
+                client = get_async_ollama_client(self.host, self.api_key)
+                response = await client.chat(**self._chat_kwargs(messages))
+            generated_text = response['message']['content']
+            stats = _response_stats(response)
+            status = "ok"
+            return ChatResult(
+                generations=[ChatGeneration(message=AIMessage(content=generated_text, response_metadata=stats))]
+            )
+        except Exception as e:
+            status = type(e).__name__
+            print(f"NCKU API Error ({self.role}): {e}")
+            raise e
+        finally:
+            self._record_call(started, queue_wait, stats, status, stream=False)
+
+    def _stream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Any = None,
+        **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        """串流版本 (stream 會走這裡，同步、不經過排程器)"""
+        started, final_stats, status = time.perf_counter(), {}, "cancelled"
+        try:
+            for part in self._client.chat(**self._chat_kwargs(messages), stream=True):
+                text = part['message']['content']
+                # 最後一段 (done) 才帶有統計
+                stats = _response_stats(part) if part.get('done') else {}
+                final_stats = stats or final_stats
+                chunk = ChatGenerationChunk(message=AIMessageChunk(content=text, response_metadata=stats))
+                if run_manager:
+                    run_manager.on_llm_new_token(text, chunk=chunk)
+                yield chunk
+            status = "ok"
+        except Exception as e:
+            status = type(e).__name__
+            raise
+        finally:
+            self._record_call(started, None, final_stats, status, stream=True)
+
+    async def _astream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Any = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        """
+        非同步串流版本 (astream 會走這裡)
+        與 _agenerate 相同，整個串流期間都佔用排程器的名額並受 deadline 限制
+        """
+        started, queue_wait, final_stats, status = time.perf_counter(), None, {}, "cancelled"
+        try:
+            async with llm_slot(self.host, self.role) as queue_wait:
+                client = get_async_ollama_client(self.host, self.api_key)
+                async for part in await client.chat(**self._chat_kwargs(messages), stream=True):
+                    text = part['message']['content']
+                    stats = _response_stats(part) if part.get('done') else {}
+                    final_stats = stats or final_stats
+                    chunk = ChatGenerationChunk(message=AIMessageChunk(content=text, response_metadata=stats))
+                    if run_manager:
+                        await run_manager.on_llm_new_token(text, chunk=chunk)
+                    yield chunk
+            status = "ok"
+        except Exception as e:
+            status = type(e).__name__
+            print(f"NCKU API Error ({self.role}, stream): {e}")
+            raise e
+        finally:
+            self._record_call(started, queue_wait, final_stats, status, stream=True)
+
+    def with_schema(self, schema: Type[BaseModel]) -> "NCKUCustomLLM":
+        """
+        回傳一個輸出被限制為 schema 結構的副本 (Ollama structured outputs)
+        prompt 中不需要再放 format instructions，搭配 RepairingJsonParser 解析
+        """
+        return self.model_copy(update={"format": schema.model_json_schema()})
 
     @property
     def _llm_type(self) -> str:
@@ -88,17 +223,208 @@ class NCKUCustomLLM(BaseChatModel):
 # factory function
 # ==========================================
 
-def get_llm(temperature=0.7, json_mode=False):
+def get_llm(temperature=0.7, json_mode=False, role="chat"):
+    """
+    回傳 role 對應的模型 (react / plan / decompose / reflect / score / sentry / chat)
+    使用哪個後端、備援順序與延遲預算由 LLM_ROUTES / LLM_ROLE_BUDGETS 決定 (見 src/llm_router.py)，
+    role 同時決定在 LLM 排程器中的優先權 (見 src/llm_scheduler.py)
+    """
+    from src.llm_router import get_routed_llm # llm_router 依賴本模組的 NCKUCustomLLM
+    return get_routed_llm(role, temperature=temperature, json_mode=json_mode)
+
+def get_fast_llm(temperature=0, json_mode=False, role="score"):
     """
-    回傳我們自製的 NCKU Wrapper
+    背景的小工作 (重要性評分 / 哨兵) 用，預設路由到本地小模型
     """
-    return NCKUCustomLLM(
-        model_name=config.LLM_MODEL,
-        temperature=temperature
+    return get_llm(temperature=temperature, json_mode=json_mode, role=role)
+
+# ==========================================
+# CPU 最佳化的 Embedding Engine
+# ==========================================
+# 基準測試用的文字 (長度接近模擬中實際的觀察 / 查詢)
+_BENCHMARK_TEXTS = [
+    "Klaus 在圖書館寫論文。",
+    "這裡有一個 [bed] 床，狀態是: 鋪好的。",
+    "Klaus 今天早上有什麼計畫？",
+    "Maria 在咖啡廳和 Klaus 討論研究主題，兩人聊得很開心。",
+]
+
+class CPUEmbeddingEngine:
+    """
+    純 CPU 節點用的 embedding 引擎 (介面與 HuggingFaceEmbeddings 相同: embed_query / embed_documents)
+
+    backend:
+        torch       ---> sentence-transformers 原始權重
+        torch-int8  ---> torch dynamic quantization，Linear 層改成 int8 權重
+        onnx-int8   ---> ONNX Runtime 載入模型庫中預先量化好的 int8 模型 (EMBEDDING_ONNX_FILE)
+    dynamic batching:
+        多個 agent 的 embed 請求由 DynamicBatcher 合併，最多等 max_wait_ms (延遲上限) 或湊滿 batch_size
+    autotune:
+        啟動時以不同的 batch size / thread 數做基準測試，
+        在單一 batch 延遲不超過 max_batch_latency_ms 的組合中挑吞吐量最高的
+    """
+
+    def __init__(
+        self,
+        model_name: str,
+        backend: str = "torch",
+        batch_size: int = 32,
+        max_wait_ms: float = 5.0,
+        threads: int = 0,
+        autotune: bool = False,
+        max_batch_latency_ms: float = 50.0,
+        onnx_file: str = "onnx/model_quint8_avx2.onnx",
+        batching: bool = True,
+    ):
+        if backend not in ("torch", "torch-int8", "onnx-int8"):
+            raise ValueError(f"Unknown embedding backend: {backend}")
+        self.model_name = model_name
+        self.backend = backend
+        self.batch_size = batch_size
+        self.threads = threads or (os.cpu_count() or 1)
+        self._model = self._load(onnx_file)
+        self._set_threads(self.threads)
+
+        if autotune:
+            self.autotune(max_batch_latency_ms)
+
+        self.batcher = None
+        if batching:
+            from src.embedding_service import DynamicBatcher
+            self.batcher = DynamicBatcher(
+                self._encode, max_batch=self.batch_size, max_wait_ms=max_wait_ms, name="embed-engine"
+            )
+        print(f"🧮 [Embedding] {backend} engine ready (batch={self.batch_size}, threads={self.threads}).")
+
+    def _load(self, onnx_file: str):
+        # 延遲 import: 只有啟用此引擎時才需要 sentence-transformers / torch
+        from sentence_transformers import SentenceTransformer
+        if self.backend == "onnx-int8":
+            return SentenceTransformer(
+                self.model_name, device="cpu", backend="onnx",
+                model_kwargs={"file_name": onnx_file, "provider": "CPUExecutionProvider"}
+            )
+        model = SentenceTransformer(self.model_name, device="cpu")
+        if self.backend == "torch-int8":
+            import torch
+            model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        return model
+
+    def _set_threads(self, threads: int):
+        # ONNX Runtime 有自己的 thread pool，這個設定只影響 torch backend
+        try:
+            import torch
+            torch.set_num_threads(threads)
+        except ImportError:
+            pass
+
+    def _encode(self, texts: Sequence[str]) -> np.ndarray:
+        return self._model.encode(
+            list(texts), batch_size=max(len(texts), 1), convert_to_numpy=True, show_progress_bar=False
+        ).astype(np.float32, copy=False)
+
+    def benchmark(self, batch_sizes: Sequence[int], thread_counts: Sequence[int], rounds: int = 3) -> List[Dict[str, float]]:
+        """量測每個 (batch size, threads) 組合的單批延遲與吞吐量"""
+        results = []
+        for threads in thread_counts:
+            self._set_threads(threads)
+            for batch_size in batch_sizes:
+                texts = [_BENCHMARK_TEXTS[i % len(_BENCHMARK_TEXTS)] for i in range(batch_size)]
+                self._encode(texts) # warmup
+                start = time.perf_counter()
+                for _ in range(rounds):
+                    self._encode(texts)
+                latency = (time.perf_counter() - start) / rounds
+                results.append({
+                    "threads": threads,
+                    "batch_size": batch_size,
+                    "latency_ms": latency * 1000,
+                    "texts_per_sec": batch_size / latency,
+                })
+        return results
+
+    def autotune(self, max_batch_latency_ms: float) -> Tuple[int, int]:
+        """挑出延遲預算內吞吐量最高的組合，並套用到此引擎"""
+        cpus = os.cpu_count() or 1
+        thread_counts = sorted({1, max(1, cpus // 2), cpus})
+        results = self.benchmark([1, 8, 16, 32, 64], thread_counts)
+        within = [r for r in results if r["latency_ms"] <= max_batch_latency_ms]
+        # 全部超過預算時，退而求其次選延遲最低的
+        best = max(within, key=lambda r: r["texts_per_sec"]) if within else min(results, key=lambda r: r["latency_ms"])
+        for r in results:
+            mark = "👉" if r is best else "  "
+            print(f"   {mark} threads={r['threads']:<3} batch={r['batch_size']:<3} "
+                  f"{r['latency_ms']:8.1f} ms  {r['texts_per_sec']:8.1f} texts/s")
+        self.threads, self.batch_size = int(best["threads"]), int(best["batch_size"])
+        self._set_threads(self.threads)
+        return self.batch_size, self.threads
+
+    def embed_array(self, texts: Sequence[str]) -> np.ndarray:
+        if self.batcher is not None:
+            return self.batcher(texts)
+        return self._encode(texts)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.embed_array(texts).tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_array([text])[0].tolist()
+
+def build_cpu_engine(model_name: Optional[str] = None, batching: bool = True) -> CPUEmbeddingEngine:
+    """依 config 建立 CPUEmbeddingEngine"""
+    return CPUEmbeddingEngine(
+        model_name or config.EMBEDDING_MODEL_NAME,
+        backend=config.EMBEDDING_BACKEND,
+        batch_size=config.EMBEDDING_BATCH_SIZE,
+        max_wait_ms=config.EMBEDDING_MAX_WAIT_MS,
+        threads=config.EMBEDDING_THREADS,
+        autotune=config.EMBEDDING_AUTOTUNE,
+        max_batch_latency_ms=config.EMBEDDING_MAX_BATCH_LATENCY_MS,
+        onnx_file=config.EMBEDDING_ONNX_FILE,
+        batching=batching,
     )
 
+_embeddings = None
+_embeddings_lock = threading.Lock()
+
 def get_embeddings():
-    """回傳本地 Embedding 模型"""
+    """
+    回傳本地 Embedding 模型 (整個 process 共用一份，多個 agent 不會重複載入)
+    第一次呼叫時才載入模型 (warmup 與第一個 embed 請求同時進來時也只載入一次)
+    """
+    global _embeddings
+    if _embeddings is None:
+        with _embeddings_lock:
+            if _embeddings is None:
+                _embeddings = _build_embeddings()
+    return _embeddings
+
+_similarity_embeddings = None
+
+def get_similarity_embeddings():
+    """計畫比對用的 embedding 模型 (PLAN_SIMILARITY_MODEL_NAME，第一次呼叫時才載入)"""
+    global _similarity_embeddings
+    if config.PLAN_SIMILARITY_MODEL_NAME == config.EMBEDDING_MODEL_NAME:
+        return get_embeddings()
+    if _similarity_embeddings is None:
+        with _embeddings_lock:
+            if _similarity_embeddings is None:
+                from langchain_huggingface import HuggingFaceEmbeddings
+                _similarity_embeddings = HuggingFaceEmbeddings(model_name=config.PLAN_SIMILARITY_MODEL_NAME)
+    return _similarity_embeddings
+
+def _build_embeddings():
+    """
+    EMBEDDING_SERVICE_WORKERS > 0 時改用多 process 的 EmbeddingService
+    EMBEDDING_ENGINE=cpu 時改用 CPUEmbeddingEngine (int8 / dynamic batching / autotune)
+    """
+    if config.EMBEDDING_SERVICE_WORKERS > 0:
+        from src.embedding_service import ServiceEmbeddings, get_embedding_service
+        return ServiceEmbeddings(get_embedding_service())
+    if config.EMBEDDING_ENGINE == "cpu":
+        return build_cpu_engine()
+    # 延遲 import: langchain_huggingface 會連帶載入 sentence-transformers / torch
+    from langchain_huggingface import HuggingFaceEmbeddings
     return HuggingFaceEmbeddings(
         model_name=config.EMBEDDING_MODEL_NAME
     )
\ No newline at end of file
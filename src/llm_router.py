@@ -0,0 +1,374 @@
+import asyncio
+import threading
+import time
+from collections import deque
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Optional, Tuple, Type
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import BaseMessage
+from langchain_core.outputs import ChatGenerationChunk, ChatResult
+from pydantic import BaseModel, Field
+
+from src.config import config
+from src.llm_factory import NCKUCustomLLM
+from src.llm_telemetry import reset_llm_attempt, set_llm_attempt
+
+# ==========================================
+# 後端
+# ==========================================
+def _backend_settings() -> Dict[str, Dict[str, Any]]:
+    """後端名稱 -> NCKUCustomLLM 的連線參數"""
+    return {
+        "remote": {"host": config.LLM_HOST, "model_name": config.LLM_MODEL, "api_key": config.LLM_API_KEY},
+        "local": {"host": config.FAST_LLM_HOST, "model_name": config.FAST_LLM_MODEL, "api_key": None},
+    }
+
+def _parse_mapping(text: str) -> Dict[str, str]:
+    """"a=x,b=y" ---> {"a": "x", "b": "y"}"""
+    result = {}
+    for item in text.split(","):
+        if item.strip():
+            key, _, value = item.partition("=")
+            result[key.strip()] = value.strip()
+    return result
+
+def _parse_mapping_list(text: str) -> List[str]:
+    return [item.strip() for item in text.split(",") if item.strip()]
+
+def route_for(role: str) -> List[str]:
+    """role 的後端順序 (第一個是主要後端，其餘依序為備援)"""
+    routes = _parse_mapping(config.LLM_ROUTES)
+    chain = [b.strip() for b in routes.get(role, routes.get("chat", "remote")).split(">") if b.strip()]
+    unknown = [b for b in chain if b not in _backend_settings()]
+    if not chain or unknown:
+        raise ValueError(f"Invalid LLM route for {role}: {routes.get(role)!r}")
+    return chain
+
+def budget_for(role: str) -> Optional[float]:
+    seconds = float(_parse_mapping(config.LLM_ROLE_BUDGETS).get(role, 0) or 0)
+    return seconds or None
+
+# ==========================================
+# 後端健康狀態與統計
+# ==========================================
+class _BackendHealth:
+    """失敗的後端在 cooldown 期間直接略過；統計每個後端的成功 / 失敗 / 逾時次數"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._down_until: Dict[str, float] = {}
+        self._counts: Dict[str, Dict[str, int]] = {}
+
+    def is_down(self, backend: str) -> bool:
+        with self._lock:
+            return self._down_until.get(backend, 0.0) > time.monotonic()
+
+    def _count(self, backend: str, key: str):
+        counts = self._counts.setdefault(backend, {"ok": 0, "failed": 0, "over_budget": 0, "fallback_used": 0})
+        counts[key] += 1
+
+    def success(self, backend: str, fallback: bool):
+        with self._lock:
+            self._down_until.pop(backend, None)
+            self._count(backend, "ok")
+            if fallback:
+                self._count(backend, "fallback_used")
+
+    def failure(self, backend: str, over_budget: bool):
+        with self._lock:
+            self._down_until[backend] = time.monotonic() + config.LLM_BACKEND_COOLDOWN
+            self._count(backend, "over_budget" if over_budget else "failed")
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        with self._lock:
+            return {
+                backend: {**counts, "down": self._down_until.get(backend, 0.0) > now}
+                for backend, counts in self._counts.items()
+            }
+
+_health = _BackendHealth()
+
+class _LatencyTracker:
+    """
+    每個 (role, 後端) 最近的延遲 (非串流: 整個請求 / 串流: 第一段輸出)，用來決定 hedge 的等待時間
+    hedge 輸掉或被取消的請求只知道「延遲至少這麼久」，記為 censored 樣本；
+    只用勝出者估計會系統性低估慢的後端 (hedge 越早觸發，慢的樣本越少)，所以百分位數用 Kaplan-Meier 估計
+    """
+
+    def __init__(self, maxlen: int = 200):
+        self._lock = threading.Lock()
+        self._samples: Dict[Tuple[str, str], deque] = {}  # (秒數, 是否 censored)
+        self._maxlen = maxlen
+
+    def record(self, role: str, backend: str, seconds: float, censored: bool = False):
+        with self._lock:
+            self._samples.setdefault((role, backend), deque(maxlen=self._maxlen)).append((seconds, censored))
+
+    def percentile(self, role: str, backend: str, pct: float, min_samples: int) -> Optional[float]:
+        with self._lock:
+            samples = sorted(self._samples.get((role, backend), ()))
+        if len(samples) < max(1, min_samples):
+            return None
+        # Kaplan-Meier: 每個完成的樣本讓存活率乘上 (1 - 1/剩餘樣本數)，censored 樣本只減少剩餘樣本數
+        survival, at_risk = 1.0, len(samples)
+        for seconds, censored in samples:
+            if not censored:
+                survival *= 1.0 - 1.0 / at_risk
+                if 1.0 - survival >= pct / 100.0:
+                    return seconds
+            at_risk -= 1
+        # 尾端都是 censored: 只知道至少是最長的那個樣本
+        return samples[-1][0]
+
+_latency = _LatencyTracker()
+
+def router_stats() -> Dict[str, Any]:
+    """各後端的呼叫結果與目前是否被暫停使用"""
+    return _health.stats()
+
+# pump 結束的標記
+_END = object()
+
+async def _pump(source: AsyncIterator[Any], queue: asyncio.Queue):
+    """
+    在獨立的 task 中跑完一個後端的輸出並放進 queue (結束放 _END，失敗放例外)
+    排程器名額與 deadline 都綁在這個 task 上，取消 task 就會中斷 HTTP 請求並釋放名額
+    """
+    try:
+        async for item in source:
+            await queue.put(item)
+        await queue.put(_END)
+    except Exception as e:
+        await queue.put(e)
+
+async def _single(coro) -> AsyncIterator[Any]:
+    """把一次性的 coroutine 包成只有一個元素的串流 (_agenerate 與 _astream 共用同一套 race 邏輯)"""
+    yield await coro
+
+# ==========================================
+# 路由後的模型
+# ==========================================
+class RoutedLLM(BaseChatModel):
+    """
+    依 role 的路由依序嘗試各後端 (見 LLM_ROUTES):
+    - 後端失敗 ---> 立刻改用下一個後端
+    - 超過觸發時間還沒有回應 (串流: 還沒有第一段輸出) ---> 啟動下一個後端
+        hedge=False: 取消原本的請求 (觸發時間 = budget)
+        hedge=True:  原本的請求繼續跑，兩邊先回來的勝出、另一個取消
+                     (觸發時間 = 主要後端歷史延遲的 P{LLM_HEDGE_PERCENTILE}，不超過 budget)
+    - 失敗的後端在 LLM_BACKEND_COOLDOWN 秒內直接略過 (全部都暫停時仍依序嘗試)
+    - 串流: 只有在還沒輸出任何內容前失敗才能換後端
+    - budget / hedge 只在非同步呼叫 (ainvoke / astream) 生效，同步的 invoke 只做失敗備援
+    每個後端都是 NCKUCustomLLM，各自向自己 host 的排程器取得名額並受 deadline 限制，
+    deadline 到了還在跑的請求都會被取消
+    """
+    role: str
+    backend_names: List[str]
+    backends: List[NCKUCustomLLM]
+    budget: Optional[float] = Field(default=None)
+    hedge: bool = Field(default=False)
+
+    def _order(self) -> List[Tuple[str, NCKUCustomLLM]]:
+        pairs = list(zip(self.backend_names, self.backends))
+        healthy = [p for p in pairs if not _health.is_down(p[0])]
+        return healthy or pairs
+
+    def _log_fallback(self, backend: str, error: BaseException):
+        reason = "逾時" if isinstance(error, TimeoutError) else f"失敗 ({error!r})"
+        print(f"   ↪️ [{self.role}] {backend} {reason}，改用下一個後端")
+
+    def _generate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Any = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        """
+        同步呼叫只依序備援 (後端失敗才換下一個)，不套用 budget 與 hedge:
+        同步的請求無法中途取消，budget 只在 ainvoke / astream 時生效
+        """
+        order = self._order()
+        for i, (name, llm) in enumerate(order):
+            try:
+                result = llm._generate(messages, stop=stop, **kwargs)
+            except Exception as e:
+                _health.failure(name, over_budget=False)
+                if i == len(order) - 1:
+                    raise
+                self._log_fallback(name, e)
+                continue
+            _health.success(name, fallback=i > 0)
+            return result
+
+    def _trigger_delay(self, primary: str) -> Optional[float]:
+        if not self.hedge:
+            return self.budget
+        hedge_at = _latency.percentile(self.role, primary, config.LLM_HEDGE_PERCENTILE, config.LLM_HEDGE_MIN_SAMPLES)
+        if hedge_at is None:
+            return self.budget
+        return hedge_at if self.budget is None else min(hedge_at, self.budget)
+
+    async def _race(self, make_source: Callable[[NCKUCustomLLM], AsyncIterator[Any]]) -> AsyncIterator[Any]:
+        """依路由啟動各後端，第一個產生輸出的後端勝出，其餘的請求取消"""
+        order = self._order()
+        delay = self._trigger_delay(order[0][0])
+        # queue.get 的 task ---> (後端名稱, 第幾個後端, pump task, queue, 開始時間)
+        running: Dict[asyncio.Task, Tuple[str, int, asyncio.Task, asyncio.Queue, float]] = {}
+        tasks: List[asyncio.Task] = []
+        last_error: Optional[BaseException] = None
+
+        def launch():
+            index = len(tasks) // 2
+            name, llm = order[index]
+            queue: asyncio.Queue = asyncio.Queue()
+            # 每個後端的 task 各自複製 context，紀錄中的 attempt 就是第幾個後端
+            token = set_llm_attempt(index)
+            try:
+                pump = asyncio.create_task(_pump(make_source(llm), queue))
+            finally:
+                reset_llm_attempt(token)
+            getter = asyncio.create_task(queue.get())
+            tasks.extend((pump, getter))
+            running[getter] = (name, index, pump, queue, time.perf_counter())
+
+        def launched() -> int:
+            return len(tasks) // 2
+
+        def cancel(getter: asyncio.Task):
+            name, _, pump, _, started = running.pop(getter)
+            getter.cancel()
+            pump.cancel()
+            # 還沒有輸出就被取消: 延遲至少是已經等待的時間
+            _latency.record(self.role, name, time.perf_counter() - started, censored=True)
+
+        try:
+            launch()
+            winner = None
+            while winner is None:
+                timeout = delay if launched() < len(order) else None
+                done, _ = await asyncio.wait(running.keys(), timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # 超過觸發時間: 啟動下一個後端
+                    name = running[next(iter(running))][0]
+                    if self.hedge:
+                        print(f"   🏁 [{self.role}] {name} 超過 {delay:.1f}s 未回應，同時送給 {order[launched()][0]}")
+                    else:
+                        for getter in list(running):
+                            _health.failure(running[getter][0], over_budget=True)
+                            cancel(getter)
+                        print(f"   ↪️ [{self.role}] {name} 逾時，改用下一個後端")
+                    launch()
+                    continue
+                # 先處理失敗的後端，再挑出勝出者
+                for getter in sorted(done, key=lambda g: isinstance(g.result(), Exception), reverse=True):
+                    name, index, pump, queue, started = running.pop(getter)
+                    item = getter.result()
+                    if isinstance(item, Exception) or item is _END:
+                        _health.failure(name, over_budget=isinstance(item, TimeoutError))
+                        last_error = item if isinstance(item, Exception) else RuntimeError(f"{name} returned nothing")
+                        if launched() < len(order):
+                            self._log_fallback(name, last_error)
+                            launch()
+                        continue
+                    if winner is None:
+                        winner = (name, index, pump, queue, started, item)
+                    else:
+                        # 同時回來但輸掉的後端也有完整的延遲
+                        _latency.record(self.role, name, time.perf_counter() - started)
+                        pump.cancel()
+                if winner is None and not running:
+                    raise last_error
+
+            # 其他還在跑的請求全部取消
+            for getter in list(running):
+                cancel(getter)
+            name, index, pump, queue, started, item = winner
+            _latency.record(self.role, name, time.perf_counter() - started)
+            while True:
+                yield item
+                item = await queue.get()
+                if item is _END:
+                    break
+                if isinstance(item, Exception):
+                    _health.failure(name, over_budget=isinstance(item, TimeoutError))
+                    raise item
+            _health.success(name, fallback=index > 0)
+        finally:
+            # 呼叫端取消 / deadline 到時還在等的後端
+            for getter in list(running):
+                cancel(getter)
+            for task in tasks:
+                task.cancel()
+
+    async def _agenerate(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Any = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        # 要把 race 跑完 (讀到 _END) 才會記錄成功
+        results = [r async for r in self._race(lambda llm: _single(llm._agenerate(messages, stop=stop, **kwargs)))]
+        return results[0]
+
+    def _stream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Any = None,
+        **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        order = self._order()
+        for i, (name, llm) in enumerate(order):
+            started = False
+            try:
+                for chunk in llm._stream(messages, stop=stop, run_manager=run_manager, **kwargs):
+                    started = True
+                    yield chunk
+            except Exception as e:
+                _health.failure(name, over_budget=False)
+                if started or i == len(order) - 1:
+                    raise
+                self._log_fallback(name, e)
+                continue
+            _health.success(name, fallback=i > 0)
+            return
+
+    async def _astream(
+        self,
+        messages: List[BaseMessage],
+        stop: Optional[List[str]] = None,
+        run_manager: Any = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        # 後端不拿 run_manager: hedge 時兩邊同時在串流，callback 只送出勝出後端的 token
+        async for chunk in self._race(lambda llm: llm._astream(messages, stop=stop, **kwargs)):
+            if run_manager:
+                await run_manager.on_llm_new_token(chunk.message.content, chunk=chunk)
+            yield chunk
+
+    def with_schema(self, schema: Type[BaseModel]) -> "RoutedLLM":
+        """每個後端都限制輸出為 schema 結構 (見 NCKUCustomLLM.with_schema)"""
+        return self.model_copy(update={"backends": [b.with_schema(schema) for b in self.backends]})
+
+    @property
+    def _llm_type(self) -> str:
+        return "routed-ncku-custom-wrapper"
+
+def get_routed_llm(role: str, temperature: float, json_mode: bool = False) -> RoutedLLM:
+    """依 LLM_ROUTES 建立 role 的模型 (含備援後端)"""
+    settings = _backend_settings()
+    names = route_for(role)
+    backends = [
+        NCKUCustomLLM(
+            **settings[name],
+            temperature=temperature,
+            format="json" if json_mode else None,
+            role=role,
+        )
+        for name in names
+    ]
+    hedge = role in _parse_mapping_list(config.LLM_HEDGE_ROLES) and len(names) > 1
+    return RoutedLLM(role=role, backend_names=names, backends=backends, budget=budget_for(role), hedge=hedge)
@@ -0,0 +1,247 @@
+import asyncio
+import contextlib
+import contextvars
+import time
+import weakref
+from collections import OrderedDict, deque
+from typing import Any, Deque, Dict, Iterator, Optional
+
+from src.config import config
+
+# ==========================================
+# 優先權 (數字越小越優先)
+# ==========================================
+# react / sentry 直接影響 tick 延遲；計畫次之；評分與反思是背景工作
+ROLE_PRIORITY = {
+    "react": 0,
+    "sentry": 0,
+    "chat": 1,
+    "plan": 2,
+    "decompose": 2,
+    "score": 3,
+    "reflect": 4,
+}
+
+class LLMDeadlineExceeded(TimeoutError):
+    """請求在 deadline 前沒有拿到執行名額或沒有完成"""
+
+# 目前是哪個 agent 發出的請求 (同一優先權內各 agent 輪流，避免單一 agent 佔滿名額)
+_current_agent: contextvars.ContextVar[str] = contextvars.ContextVar("llm_agent", default="")
+# 外層設定的絕對 deadline (loop.time())，巢狀呼叫取較早的那一個
+_current_deadline: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar("llm_deadline", default=None)
+
+def current_llm_agent() -> str:
+    return _current_agent.get()
+
+def set_llm_agent(agent_name: str):
+    """
+    在目前的 task 中標記 agent (LangGraph 每個 node 各自在獨立的 context 中執行，
+    node 開頭呼叫一次即可，不會影響其他 agent)
+    """
+    _current_agent.set(agent_name)
+
+@contextlib.contextmanager
+def llm_agent(agent_name: str) -> Iterator[None]:
+    """標記接下來的 LLM 請求屬於哪個 agent"""
+    token = _current_agent.set(agent_name)
+    try:
+        yield
+    finally:
+        _current_agent.reset(token)
+
+@contextlib.contextmanager
+def llm_deadline(seconds: Optional[float]) -> Iterator[None]:
+    """接下來的 LLM 請求 (包含排隊時間) 必須在 seconds 秒內完成"""
+    deadline = None if seconds is None else asyncio.get_running_loop().time() + seconds
+    with llm_deadline_at(deadline):
+        yield
+
+@contextlib.contextmanager
+def llm_deadline_at(deadline: Optional[float]) -> Iterator[None]:
+    """同 llm_deadline，但直接指定絕對時間 (loop.time())，例如整個 tick 的 deadline"""
+    if deadline is None:
+        yield
+        return
+    outer = _current_deadline.get()
+    token = _current_deadline.set(deadline if outer is None else min(outer, deadline))
+    try:
+        yield
+    finally:
+        _current_deadline.reset(token)
+
+def remaining_time() -> Optional[float]:
+    """目前 context 的 deadline 還剩幾秒 (沒有 deadline 時為 None)"""
+    deadline = _current_deadline.get()
+    if deadline is None:
+        return None
+    return deadline - asyncio.get_running_loop().time()
+
+class _Ticket:
+    __slots__ = ("future", "priority", "agent", "enqueued_at")
+
+    def __init__(self, future: asyncio.Future, priority: int, agent: str):
+        self.future = future
+        self.priority = priority
+        self.agent = agent
+        self.enqueued_at = time.perf_counter()
+
+class HostScheduler:
+    """
+    單一 host 的請求排程
+    - 同時執行的請求數不超過 max_concurrency (遠端 server 會限流)
+    - 有空位時，先挑優先權最高的類別；同一類別內依 agent 輪流 (fair queuing)
+    - 排隊超過 deadline 的請求直接放棄，不佔用名額
+    """
+
+    def __init__(self, host: str, max_concurrency: int):
+        self.host = host
+        self.max_concurrency = max_concurrency
+        self._running = 0
+        # priority -> agent -> 該 agent 排隊中的請求 (OrderedDict 的順序即輪流順序)
+        self._queues: Dict[int, "OrderedDict[str, Deque[_Ticket]]"] = {}
+        # 統計
+        self.completed = 0
+        self.expired = 0
+        self._wait_total: Dict[int, float] = {}
+        self._wait_count: Dict[int, int] = {}
+
+    def queued(self) -> int:
+        return sum(len(q) for agents in self._queues.values() for q in agents.values())
+
+    def _record_wait(self, priority: int, enqueued_at: float):
+        self._wait_total[priority] = self._wait_total.get(priority, 0.0) + time.perf_counter() - enqueued_at
+        self._wait_count[priority] = self._wait_count.get(priority, 0) + 1
+
+    async def acquire(self, priority: int, agent: str, deadline: Optional[float]):
+        loop = asyncio.get_running_loop()
+        if self._running < self.max_concurrency and self.queued() == 0:
+            self._running += 1
+            self._record_wait(priority, time.perf_counter())
+            return
+        ticket = _Ticket(loop.create_future(), priority, agent)
+        self._queues.setdefault(priority, OrderedDict()).setdefault(agent, deque()).append(ticket)
+        timeout = None if deadline is None else max(0.0, deadline - loop.time())
+        try:
+            await asyncio.wait_for(asyncio.shield(ticket.future), timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if ticket.future.done() and not ticket.future.cancelled():
+                # 剛好在逾時的同時拿到名額: 還回去
+                self.release()
+            else:
+                ticket.future.cancel()
+                self._discard(ticket)
+            if isinstance(e, asyncio.TimeoutError):
+                self.expired += 1
+                raise LLMDeadlineExceeded(f"LLM request to {self.host} expired in queue") from None
+            raise
+
+    def _discard(self, ticket: _Ticket):
+        agents = self._queues.get(ticket.priority)
+        if not agents or ticket.agent not in agents:
+            return
+        queue = agents[ticket.agent]
+        try:
+            queue.remove(ticket)
+        except ValueError:
+            pass
+        if not queue:
+            del agents[ticket.agent]
+
+    def _next_ticket(self) -> Optional[_Ticket]:
+        for priority in sorted(self._queues):
+            agents = self._queues[priority]
+            while agents:
+                agent, queue = next(iter(agents.items()))
+                ticket = queue.popleft()
+                # 輪到的 agent 排到最後
+                if queue:
+                    agents.move_to_end(agent)
+                else:
+                    del agents[agent]
+                if not ticket.future.done():
+                    return ticket
+        return None
+
+    def release(self):
+        self._running -= 1
+        self.completed += 1
+        ticket = self._next_ticket()
+        if ticket is not None:
+            self._running += 1
+            self._record_wait(ticket.priority, ticket.enqueued_at)
+            ticket.future.set_result(None)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "host": self.host,
+            "max_concurrency": self.max_concurrency,
+            "running": self._running,
+            "queued": {p: sum(len(q) for q in agents.values()) for p, agents in self._queues.items() if agents},
+            "completed": self.completed,
+            "expired": self.expired,
+            "avg_wait_ms": {
+                p: round(self._wait_total[p] / self._wait_count[p] * 1000, 2) for p in self._wait_count
+            },
+        }
+
+# 排程器使用 asyncio.Future，每個 event loop 各一組
+_schedulers: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[str, HostScheduler]]" = \
+    weakref.WeakKeyDictionary()
+
+def _host_limit(host: str) -> int:
+    if host.rstrip("/") == (config.LLM_HOST or "").rstrip("/"):
+        return config.LLM_REMOTE_CONCURRENCY
+    return config.LLM_LOCAL_CONCURRENCY
+
+def get_scheduler(host: str) -> HostScheduler:
+    loop = asyncio.get_running_loop()
+    schedulers = _schedulers.setdefault(loop, {})
+    key = host.rstrip("/")
+    if key not in schedulers:
+        schedulers[key] = HostScheduler(key, _host_limit(key))
+    return schedulers[key]
+
+def _role_deadline(role: str) -> Optional[float]:
+    seconds = {
+        "react": config.LLM_REACT_DEADLINE,
+        "sentry": config.LLM_SENTRY_DEADLINE,
+    }.get(role, 0)
+    return seconds or None
+
+@contextlib.asynccontextmanager
+async def llm_slot(host: str, role: str = "chat"):
+    """
+    [Async] 取得對 host 發送一個請求的名額，離開時釋放 (as 取得排隊等待的秒數)
+    deadline 取 (外層 llm_deadline, 此 role 的預設 deadline) 中較早的，
+    涵蓋排隊與執行時間；逾時會取消請求並丟出 LLMDeadlineExceeded
+    """
+    loop = asyncio.get_running_loop()
+    deadline = _current_deadline.get()
+    role_seconds = _role_deadline(role)
+    if role_seconds is not None:
+        role_deadline = loop.time() + role_seconds
+        deadline = role_deadline if deadline is None else min(deadline, role_deadline)
+
+    scheduler = get_scheduler(host)
+    enqueued_at = time.perf_counter()
+    await scheduler.acquire(ROLE_PRIORITY.get(role, ROLE_PRIORITY["chat"]), _current_agent.get(), deadline)
+    waited = time.perf_counter() - enqueued_at
+    try:
+        if deadline is None:
+            yield waited
+        else:
+            try:
+                async with asyncio.timeout_at(deadline):
+                    yield waited
+            except TimeoutError:
+                raise LLMDeadlineExceeded(f"LLM request to {host} ({role}) missed its deadline") from None
+    finally:
+        scheduler.release()
+
+def scheduler_stats() -> Dict[str, Any]:
+    """目前 event loop 上各 host 的排程狀態"""
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return {}
+    return {host: s.stats() for host, s in _schedulers.get(loop, {}).items()}
@@ -0,0 +1,235 @@
+import contextlib
+import contextvars
+import json
+import os
+import sys
+import threading
+import time
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+import numpy as np
+
+from src.config import config
+
+# ==========================================
+# LLM 呼叫紀錄 (JSONL)
+# ==========================================
+# 這次請求是備援鏈中的第幾次嘗試 (0 = 主要後端，之後每次 fallback / hedge +1)，由 RoutedLLM 設定
+_current_attempt: contextvars.ContextVar[int] = contextvars.ContextVar("llm_attempt", default=0)
+
+def set_llm_attempt(attempt: int) -> contextvars.Token:
+    return _current_attempt.set(attempt)
+
+def reset_llm_attempt(token: contextvars.Token):
+    _current_attempt.reset(token)
+
+def current_llm_attempt() -> int:
+    return _current_attempt.get()
+
+# node 層級的重試次數 (0 = 第一次，例如 react_node 解析失敗後重新呼叫 +1)，與 RoutedLLM 的 attempt 分開記錄
+_current_node_attempt: contextvars.ContextVar[int] = contextvars.ContextVar("llm_node_attempt", default=0)
+
+def set_llm_node_attempt(attempt: int) -> contextvars.Token:
+    return _current_node_attempt.set(attempt)
+
+def reset_llm_node_attempt(token: contextvars.Token):
+    _current_node_attempt.reset(token)
+
+def current_llm_node_attempt() -> int:
+    return _current_node_attempt.get()
+
+@contextlib.contextmanager
+def llm_node_attempt(attempt: int) -> Iterator[None]:
+    """在這個區塊內發出的 LLM 呼叫記錄為 node 的第 attempt 次嘗試"""
+    token = set_llm_node_attempt(attempt)
+    try:
+        yield
+    finally:
+        reset_llm_node_attempt(token)
+
+class TelemetrySink:
+    """
+    每次 LLM 呼叫寫一行 JSON (append)，欄位:
+    ts / model / role / agent / host / stream / attempt (備援鏈) / node_attempt (node 重試) / status
+    queue_ms (排程器排隊) / latency_ms (含排隊的總時間)
+    prompt_tokens / prefill_ms / eval_tokens / decode_ms / load_ms (Ollama 回傳的統計，失敗的呼叫沒有)
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = None
+
+    def write(self, record: Dict[str, Any]):
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self._lock:
+            if self._file is None:
+                directory = os.path.dirname(self.path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                self._file = open(self.path, "a", encoding="utf-8")
+            self._file.write(line)
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+_sink: Optional[TelemetrySink] = None
+_sink_lock = threading.Lock()
+
+def get_sink() -> Optional[TelemetrySink]:
+    """LLM_TELEMETRY_PATH 沒有設定時回傳 None (不記錄)"""
+    global _sink
+    path = config.LLM_TELEMETRY_PATH
+    if not path:
+        return None
+    if _sink is None or _sink.path != path:
+        with _sink_lock:
+            if _sink is None or _sink.path != path:
+                if _sink is not None:
+                    _sink.close()
+                _sink = TelemetrySink(path)
+    return _sink
+
+def _ns_to_ms(value: Optional[int]) -> Optional[float]:
+    return None if value is None else round(value / 1e6, 2)
+
+def record_llm_call(
+    *,
+    model: str,
+    role: str,
+    agent: str,
+    host: str,
+    stream: bool,
+    status: str,
+    started: float,
+    queue_wait: Optional[float],
+    stats: Dict[str, int],
+):
+    """NCKUCustomLLM 每次呼叫結束 (成功 / 失敗 / 取消) 時呼叫；started 為 time.perf_counter()"""
+    sink = get_sink()
+    if sink is None:
+        return
+    sink.write({
+        "ts": round(time.time(), 3),
+        "model": model,
+        "role": role,
+        "agent": agent,
+        "host": host,
+        "stream": stream,
+        "attempt": current_llm_attempt(),
+        "node_attempt": current_llm_node_attempt(),
+        "status": status,
+        "queue_ms": None if queue_wait is None else round(queue_wait * 1000, 2),
+        "latency_ms": round((time.perf_counter() - started) * 1000, 2),
+        "prompt_tokens": stats.get("prompt_eval_count"),
+        "prefill_ms": _ns_to_ms(stats.get("prompt_eval_duration")),
+        "eval_tokens": stats.get("eval_count"),
+        "decode_ms": _ns_to_ms(stats.get("eval_duration")),
+        "load_ms": _ns_to_ms(stats.get("load_duration")),
+    })
+
+# ==========================================
+# 彙整
+# ==========================================
+def load_records(path: str) -> List[Dict[str, Any]]:
+    records = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue # 寫到一半中斷的最後一行
+    return records
+
+def _percentiles(values: List[float]) -> Dict[str, Optional[float]]:
+    if not values:
+        return {"p50": None, "p95": None, "p99": None}
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {"p50": round(float(p50), 1), "p95": round(float(p95), 1), "p99": round(float(p99), 1)}
+
+def _rate(tokens: List[Optional[float]], ms: List[Optional[float]]) -> Optional[float]:
+    pairs = [(t, m) for t, m in zip(tokens, ms) if t is not None and m]
+    total_ms = sum(m for _, m in pairs)
+    return round(sum(t for t, _ in pairs) / total_ms * 1000, 1) if total_ms else None
+
+def _mean(values: List[Optional[float]]) -> Optional[float]:
+    values = [v for v in values if v is not None]
+    return round(float(np.mean(values)), 1) if values else None
+
+def summarize(records: Iterable[Dict[str, Any]], by: str = "role") -> Dict[str, Dict[str, Any]]:
+    """
+    依 role (呼叫的 node: react / plan / decompose / reflect / score / sentry / chat) 或其他欄位彙整:
+    呼叫次數 / 失敗 / 取消 / 重試 (備援鏈與 node 各自計算)、延遲與排隊的百分位數、平均 token 數、
+    prefill 與 decode 的平均時間、tokens/sec 與 prefill 佔 (prefill + decode) 時間的比例
+    """
+    groups: Dict[str, List[Dict[str, Any]]] = {}
+    for r in records:
+        groups.setdefault(str(r.get(by)), []).append(r)
+
+    summary = {}
+    for key, rows in sorted(groups.items()):
+        ok = [r for r in rows if r.get("status") == "ok"]
+        prompt_tokens = [r.get("prompt_tokens") for r in ok]
+        eval_tokens = [r.get("eval_tokens") for r in ok]
+        prefill_ms = [r.get("prefill_ms") for r in ok]
+        decode_ms = [r.get("decode_ms") for r in ok]
+        prefill_total = sum(m for m in prefill_ms if m)
+        decode_total = sum(m for m in decode_ms if m)
+        summary[key] = {
+            "calls": len(rows),
+            "ok": len(ok),
+            "cancelled": sum(r.get("status") == "cancelled" for r in rows),
+            "errors": sum(r.get("status") not in ("ok", "cancelled") for r in rows),
+            "retries": sum((r.get("attempt") or 0) > 0 for r in rows),
+            "node_retries": sum((r.get("node_attempt") or 0) > 0 for r in rows),
+            "latency_ms": _percentiles([r["latency_ms"] for r in ok if r.get("latency_ms") is not None]),
+            "queue_ms": _percentiles([r["queue_ms"] for r in rows if r.get("queue_ms") is not None]),
+            "prompt_tokens": int(sum(t for t in prompt_tokens if t)),
+            "eval_tokens": int(sum(t for t in eval_tokens if t)),
+            "avg_prompt_tokens": round(np.mean([t for t in prompt_tokens if t is not None]), 1)
+                                 if any(t is not None for t in prompt_tokens) else None,
+            "avg_prefill_ms": _mean(prefill_ms),
+            "avg_decode_ms": _mean(decode_ms),
+            "prefill_share": round(prefill_total / (prefill_total + decode_total), 3)
+                             if prefill_total + decode_total else None,
+            "prefill_tok_s": _rate(prompt_tokens, prefill_ms),
+            "decode_tok_s": _rate(eval_tokens, decode_ms),
+        }
+    return summary
+
+def format_summary(summary: Dict[str, Dict[str, Any]]) -> str:
+    """印成表格 (CLI 用)"""
+    def cell(value: Any) -> str:
+        return "-" if value is None else str(value)
+
+    header = ["node", "calls", "ok", "err", "cancel", "retry", "node retry", "lat p50", "lat p95", "lat p99",
+              "queue p95", "prompt tok", "eval tok", "prefill share", "prefill tok/s", "decode tok/s"]
+    rows = [header]
+    for key, s in summary.items():
+        rows.append([
+            key, s["calls"], s["ok"], s["errors"], s["cancelled"], s["retries"], s["node_retries"],
+            s["latency_ms"]["p50"], s["latency_ms"]["p95"], s["latency_ms"]["p99"],
+            s["queue_ms"]["p95"], s["prompt_tokens"], s["eval_tokens"], s["prefill_share"],
+            s["prefill_tok_s"], s["decode_tok_s"],
+        ])
+    rows = [[cell(v) for v in row] for row in rows]
+    widths = [max(len(row[i]) for row in rows) for i in range(len(header))]
+    lines = ["  ".join(v.ljust(w) if i == 0 else v.rjust(w) for i, (v, w) in enumerate(zip(row, widths))) for row in rows]
+    lines.insert(1, "-" * len(lines[0]))
+    return "\n".join(lines)
+
+if __name__ == "__main__":
+    # python -m src.llm_telemetry [path] [role|agent|model|host]
+    path = sys.argv[1] if len(sys.argv) > 1 else config.LLM_TELEMETRY_PATH
+    if not path:
+        sys.exit("usage: python -m src.llm_telemetry <telemetry.jsonl> [group-by]")
+    by = sys.argv[2] if len(sys.argv) > 2 else "role"
+    print(f"📊 LLM telemetry: {path} (依 {by} 彙整，時間單位 ms)")
+    print(format_summary(summarize(load_records(path), by=by)))
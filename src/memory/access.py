@@ -0,0 +1,52 @@
+import threading
+from typing import Dict, List, Tuple
+
+class AccessTracker:
+    """
+    記憶的 last_accessed_at 追蹤器 (id -> timestamp)
+    - retrieve 直接更新這張表，打分數時立即使用，不必等寫回 DB
+    - 同一個 id 的多次存取會合併 (只保留最新時間)
+    - drain() 取出待寫回的資料，格式為欄位式 patch: (ids, timestamps)
+    - 待寫回數量達到 max_pending 時 is_full()，呼叫端應先等寫回完成 (backpressure)
+    """
+
+    def __init__(self, flush_threshold: int = 256, max_pending: int = 4096):
+        self.flush_threshold = flush_threshold
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        self._pending: Dict[str, float] = {}  # 尚未寫回
+        self._inflight: Dict[str, float] = {} # 正在寫回 (寫完前仍以這裡為準)
+
+    def touch(self, ids: List[str], timestamp: float):
+        with self._lock:
+            for doc_id in ids:
+                if timestamp > self._pending.get(doc_id, float("-inf")):
+                    self._pending[doc_id] = timestamp
+
+    def get(self, doc_id: str, default: float) -> float:
+        """回傳最新的存取時間 (記憶體中的值優先於 DB 中的值)"""
+        with self._lock:
+            ts = self._pending.get(doc_id, self._inflight.get(doc_id))
+        return default if ts is None or ts < default else ts
+
+    def pending_count(self) -> int:
+        return len(self._pending)
+
+    def should_flush(self) -> bool:
+        return len(self._pending) >= self.flush_threshold
+
+    def is_full(self) -> bool:
+        return len(self._pending) + len(self._inflight) >= self.max_pending
+
+    def drain(self) -> Tuple[List[str], List[float]]:
+        """取出待寫回的存取時間；寫回完成後需呼叫 commit()"""
+        with self._lock:
+            self._inflight.update(self._pending)
+            self._pending = {}
+            ids = list(self._inflight.keys())
+            return ids, [self._inflight[i] for i in ids]
+
+    def commit(self):
+        """寫回成功，清除 inflight (失敗時不呼叫，下次 drain 會重送)"""
+        with self._lock:
+            self._inflight = {}
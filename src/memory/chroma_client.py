@@ -0,0 +1,37 @@
+import os
+from typing import Any, Dict, Optional
+
+from src.config import config
+
+# 同一個 process 內共用 client
+# (PersistentClient 對同一個目錄只能有一個實例，否則會互相覆蓋)
+_clients: Dict[str, Any] = {}
+
+def get_chroma_client(mode: Optional[str] = None):
+    """
+    依照模式回傳 Chroma client
+    - embedded: 本地目錄持久化，重啟後直接讀回向量，不需要重新 embedding
+    - http: 連到 docker-compose 啟動的 Chroma server
+    - memory: 純記憶體，程式結束就消失 (測試用)
+    """
+    mode = mode or config.CHROMA_MODE
+    if mode in _clients:
+        return _clients[mode]
+
+    # 延遲 import: chromadb 很大，只用 NumPy 後端時不需要載入
+    import chromadb
+    from chromadb.config import Settings
+
+    settings = Settings(anonymized_telemetry=False)
+    if mode == "embedded":
+        os.makedirs(config.CHROMA_PERSIST_DIR, exist_ok=True)
+        client = chromadb.PersistentClient(path=config.CHROMA_PERSIST_DIR, settings=settings)
+    elif mode == "http":
+        client = chromadb.HttpClient(host=config.CHROMA_HOST, port=int(config.CHROMA_PORT), settings=settings)
+    elif mode == "memory":
+        client = chromadb.EphemeralClient(settings=settings)
+    else:
+        raise ValueError(f"Unknown Chroma mode: {mode}")
+
+    _clients[mode] = client
+    return client
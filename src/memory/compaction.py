@@ -0,0 +1,208 @@
+import re
+import uuid
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+import numpy as np
+from langchain_core.documents import Document
+
+from src.memory.models import MemoryFilter
+from src.memory.store import MemoryStore
+
+@dataclass
+class CompactionReport:
+    merged_groups: int = 0   # 合併成幾筆摘要記錄
+    merged_records: int = 0  # 被合併掉的原始記錄數
+    archived: int = 0        # 移到封存層的記錄數
+    hot_count: int = 0       # 壓縮後熱資料層的記錄數
+    reclaimed: int = 0       # 重寫 segment 回收的已刪除記錄數
+    errors: List[str] = field(default_factory=list)
+
+def _normalize(text: str) -> str:
+    """比較重複時忽略空白與標點差異"""
+    return re.sub(r"[\s，。,.!！:：]+", "", text)
+
+class MemoryCompactor:
+    """
+    記憶流壓縮與分層封存
+
+    1. 合併: 最近 merge_window 內低重要性的 observation 中，內容相同或向量幾乎相同 (cosine >= similarity) 的記錄，
+       合併成一筆摘要記錄，metadata 帶上 merged_count / first_seen / last_seen
+       (例如重複出現的「這裡有一個 [bed] 床，狀態是: 鋪好的。」)
+    2. 封存: 超過 archive_after 沒被存取、且不重要的記憶移到 archive store；
+       熱資料層超過 hot_cap 時，再依最後存取時間由舊到新搬移
+       冷熱判斷只讀 metadata 欄位 (條件下推到 store)，只有要搬移的記錄才會載入內容與向量
+       封存層只在 retrieve(include_archive=True) 時才會被搜尋，被檢索到的封存記憶會搬回熱資料層
+    3. 回收: 合併與封存只留下 tombstone，已刪除比例 >= vacuum_ratio 的 segment 重寫 (store.vacuum)
+
+    多個 agent 共用 store 時，agent_ids 限定只處理這些分區 (hot_cap 也只計算分區內的記錄)
+    """
+
+    def __init__(
+        self,
+        hot_store: MemoryStore,
+        archive_store: MemoryStore,
+        max_merge_importance: int = 3,
+        similarity: float = 0.95,
+        merge_window: Optional[timedelta] = timedelta(days=1),
+        archive_after: timedelta = timedelta(days=3),
+        max_archive_importance: int = 5,
+        hot_cap: Optional[int] = None,
+        agent_ids: Optional[List[str]] = None,
+        vacuum_ratio: float = 0.3,
+    ):
+        self.hot_store = hot_store
+        self.archive_store = archive_store
+        self.max_merge_importance = max_merge_importance
+        self.similarity = similarity
+        self.merge_window = merge_window
+        self.archive_after = archive_after
+        self.max_archive_importance = max_archive_importance
+        self.hot_cap = hot_cap
+        self.agent_ids = agent_ids
+        self.vacuum_ratio = vacuum_ratio
+
+    def run(self, now: datetime) -> CompactionReport:
+        """同步執行一輪壓縮 (由 retriever 放到 thread 中執行)"""
+        report = CompactionReport()
+        self._merge_duplicates(now, report)
+        self._archive_cold(now, report)
+        for store in (self.hot_store, self.archive_store):
+            try:
+                report.reclaimed += store.vacuum(self.vacuum_ratio)
+            except Exception as e:
+                report.errors.append(f"vacuum failed: {e}")
+        if self.agent_ids:
+            report.hot_count = len(self.hot_store.scan_columns(self._scope())["id"])
+        else:
+            report.hot_count = self.hot_store.count()
+        return report
+
+    def _scope(self, **conditions) -> MemoryFilter:
+        return MemoryFilter(agent_ids=self.agent_ids, **conditions)
+
+    # ==========================================
+    # 1. 合併近似重複的觀察
+    # ==========================================
+    def _merge_duplicates(self, now: datetime, report: CompactionReport):
+        # 只載入最近 merge_window 內的低重要性觀察 (時間與重要性條件下推到 store)
+        start = now - self.merge_window if self.merge_window else None
+        docs = self.hot_store.scan_by_time(
+            start=start,
+            memory_filter=self._scope(types=["observation"], max_importance=self.max_merge_importance)
+        )
+        if len(docs) < 2:
+            return
+        ids = [d.metadata["id"] for d in docs]
+        fetched, vectors = self.hot_store.fetch(ids)
+        by_id = {d.metadata["id"]: (d, v) for d, v in zip(fetched, vectors)}
+
+        # 先以正規化後的文字分組 (完全重複)，再把向量夠接近的組別併在一起
+        groups: Dict[str, List[str]] = {}
+        for doc_id in ids:
+            if doc_id not in by_id:
+                continue
+            groups.setdefault(_normalize(by_id[doc_id][0].page_content), []).append(doc_id)
+
+        keys = list(groups.keys())
+        heads = np.array([by_id[groups[k][0]][1] for k in keys], dtype=np.float32)
+        heads /= np.maximum(np.linalg.norm(heads, axis=1, keepdims=True), 1e-12)
+        merged_into = list(range(len(keys)))
+        for i in range(len(keys)):
+            if merged_into[i] != i:
+                continue
+            sims = heads[i + 1:] @ heads[i]
+            for offset in np.flatnonzero(sims >= self.similarity):
+                j = i + 1 + int(offset)
+                if merged_into[j] == j:
+                    merged_into[j] = i
+
+        clusters: Dict[int, List[str]] = {}
+        for i, key in enumerate(keys):
+            clusters.setdefault(merged_into[i], []).extend(groups[key])
+
+        for member_ids in clusters.values():
+            if len(member_ids) < 2:
+                continue
+            try:
+                self._write_summary([by_id[i][0] for i in member_ids], by_id[member_ids[0]][1])
+                report.merged_groups += 1
+                report.merged_records += len(member_ids)
+            except Exception as e:
+                report.errors.append(f"merge failed: {e}")
+
+    def _write_summary(self, members: List[Document], vector: List[float]):
+        """寫入摘要記錄後再刪除原始記錄 (中途失敗最多留下重複，不會遺失)"""
+        members.sort(key=lambda d: d.metadata.get("first_seen", d.metadata["created_at"]))
+        count = sum(int(d.metadata.get("merged_count", 1)) for d in members)
+        first_seen = min(d.metadata.get("first_seen", d.metadata["created_at"]) for d in members)
+        last_seen = max(d.metadata.get("last_seen", d.metadata["created_at"]) for d in members)
+        # 已經是摘要的記錄，取回原本的內容 (避免「重複 N 次」疊加)
+        content = members[-1].metadata.get("base_content", members[-1].page_content)
+        span = f"{datetime.fromtimestamp(first_seen):%m-%d %H:%M} ~ {datetime.fromtimestamp(last_seen):%m-%d %H:%M}"
+
+        summary_id = str(uuid.uuid4())
+        # 摘要留在原本的分區
+        partition = {"agent_id": members[-1].metadata["agent_id"]} if "agent_id" in members[-1].metadata else {}
+        self.hot_store.add(
+            [summary_id],
+            [f"{content}（重複 {count} 次，{span}）"],
+            [vector],
+            [{
+                "id": summary_id,
+                "created_at": last_seen,
+                "last_accessed_at": max(d.metadata.get("last_accessed_at", last_seen) for d in members),
+                "importance": max(int(d.metadata.get("importance", 1)) for d in members),
+                "type": "observation",
+                "base_content": content,
+                "merged_count": count,
+                "first_seen": first_seen,
+                "last_seen": last_seen,
+                **partition,
+            }]
+        )
+        self.hot_store.delete([d.metadata["id"] for d in members])
+
+    # ==========================================
+    # 2. 冷資料移到封存層
+    # ==========================================
+    def _archive_cold(self, now: datetime, report: CompactionReport):
+        # 冷資料: 條件下推到 store 的欄位過濾，只取 id
+        cold = self.hot_store.scan_columns(self._scope(
+            accessed_before=now - self.archive_after,
+            max_importance=self.max_archive_importance,
+        ))
+        to_archive = set(cold["id"])
+
+        # 熱資料層上限: observation 優先，再依最後存取時間由舊到新 (一樣只讀欄位)
+        if self.hot_cap is not None:
+            hot_count = len(self.hot_store.scan_columns(self._scope())["id"]) if self.agent_ids else self.hot_store.count()
+            if hot_count - len(to_archive) > self.hot_cap:
+                columns = self.hot_store.scan_columns(self._scope(), ["type", "last_accessed_at"])
+                remaining = sorted(
+                    (
+                        (t != "observation", accessed, doc_id)
+                        for doc_id, t, accessed in zip(columns["id"], columns["type"], columns["last_accessed_at"])
+                        if doc_id not in to_archive
+                    ),
+                    key=lambda item: (item[0], item[1]),
+                )
+                overflow = len(remaining) - self.hot_cap
+                to_archive.update(doc_id for _, _, doc_id in remaining[:overflow])
+
+        if not to_archive:
+            return
+        try:
+            moved, vectors = self.hot_store.fetch(list(to_archive))
+            if moved:
+                self.archive_store.add(
+                    [d.metadata["id"] for d in moved],
+                    [d.page_content for d in moved],
+                    vectors,
+                    [d.metadata for d in moved]
+                )
+                self.hot_store.delete([d.metadata["id"] for d in moved])
+                report.archived += len(moved)
+        except Exception as e:
+            report.errors.append(f"archive failed: {e}")
@@ -1,24 +1,20 @@
 # src/memory/importance.py
 
-from langchain_ollama import ChatOllama
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.output_parsers import PydanticOutputParser
 from pydantic import BaseModel, Field
-from src.config import config
+from src.llm_factory import get_fast_llm
+from src.json_repair import RepairingJsonParser
 
 class ImportanceScore(BaseModel):
     score: int = Field(description="分數介於 1 到 10 之間")
 
 def get_importance_scorer():
-    llm = ChatOllama(
-        base_url=config.FAST_LLM_HOST,
-        model=config.FAST_LLM_MODEL,
-        temperature=0,
-        format="json"
-    ) # LangChain 提供的 LLM 介面，用來跟 Ollama server 溝通
+    # 本地小模型，與其他 LLM 共用連線池 (見 src/ollama_pool.py)
+    # 輸出由 Ollama 依 ImportanceScore 的 JSON schema 限制
+    llm = get_fast_llm(temperature=0, json_mode=True).with_schema(ImportanceScore)
     
-    # 把 LLM response json 格式轉成 pydantic 格式
-    parser = PydanticOutputParser(pydantic_object=ImportanceScore)
+    # 把 LLM response json 格式轉成 pydantic 格式 (容錯修復常見的格式問題)
+    parser = RepairingJsonParser(pydantic_object=ImportanceScore)
     
     template = """
     請評估這段記憶的重要性，範圍從 1 (瑣碎日常，如刷牙) 到 10 (極度重要，如分手)。
@@ -1,6 +1,7 @@
+import uuid
 from pydantic import BaseModel, Field
 from datetime import datetime
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List
 
 class Memory(BaseModel):
     """
@@ -30,4 +31,77 @@ class Memory(BaseModel):
                 "type": self.type,
                 **self.metadata
             }
-        }
\ No newline at end of file
+        }
+
+class MemoryRecord(BaseModel):
+    """
+    批次匯入 / 匯出時的一行 (JSONL)
+    importance 或 embedding 缺少時，匯入會再補算
+    """
+    id: Optional[str] = Field(default=None, description="缺少時匯入會自動產生 UUID")
+    content: str
+    type: str = "observation"
+    created_at: datetime
+    last_accessed_at: Optional[datetime] = None
+    importance: Optional[int] = None
+    metadata: Dict[str, Any] = Field(default_factory=dict)
+    embedding: Optional[List[float]] = None
+
+    def to_memory(self, importance: int) -> Memory:
+        return Memory(
+            id=self.id or str(uuid.uuid4()),
+            content=self.content,
+            created_at=self.created_at,
+            last_accessed_at=self.last_accessed_at or self.created_at,
+            importance=importance,
+            type=self.type,
+            metadata=self.metadata
+        )
+
+class MemoryFilter(BaseModel):
+    """
+    檢索前的 metadata 過濾條件
+    在打分數之前先縮小候選集 (Chroma 會轉成 where 子句下推到 DB)
+    """
+    types: Optional[List[str]] = Field(default=None, description="只保留這些記憶類型 (observation / reflection / plan)")
+    created_after: Optional[datetime] = Field(default=None, description="created_at >= 此時間")
+    created_before: Optional[datetime] = Field(default=None, description="created_at < 此時間")
+    min_importance: Optional[int] = Field(default=None, description="importance >= 此分數")
+    max_importance: Optional[int] = Field(default=None, description="importance <= 此分數")
+    accessed_before: Optional[datetime] = Field(default=None, description="last_accessed_at < 此時間")
+    agent_ids: Optional[List[str]] = Field(default=None, description="共用 store 時只保留這些 agent 的記憶")
+
+    def is_empty(self) -> bool:
+        return (
+            not self.types
+            and self.created_after is None
+            and self.created_before is None
+            and self.min_importance is None
+            and self.max_importance is None
+            and self.accessed_before is None
+            and not self.agent_ids
+        )
+
+    def to_chroma_where(self) -> Optional[Dict[str, Any]]:
+        """轉換為 Chroma 的 where 語法 (多個條件需要包在 $and 裡)"""
+        clauses = []
+        if self.types:
+            clauses.append({"type": {"$in": list(self.types)}})
+        if self.created_after is not None:
+            clauses.append({"created_at": {"$gte": self.created_after.timestamp()}})
+        if self.created_before is not None:
+            clauses.append({"created_at": {"$lt": self.created_before.timestamp()}})
+        if self.min_importance is not None:
+            clauses.append({"importance": {"$gte": self.min_importance}})
+        if self.max_importance is not None:
+            clauses.append({"importance": {"$lte": self.max_importance}})
+        if self.accessed_before is not None:
+            clauses.append({"last_accessed_at": {"$lt": self.accessed_before.timestamp()}})
+        if self.agent_ids:
+            clauses.append({"agent_id": {"$in": list(self.agent_ids)}})
+
+        if not clauses:
+            return None
+        if len(clauses) == 1:
+            return clauses[0]
+        return {"$and": clauses}
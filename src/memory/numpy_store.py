@@ -0,0 +1,473 @@
+import os
+import threading
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+import numpy as np
+from langchain_core.documents import Document
+
+from src.memory.models import MemoryFilter
+from src.memory.segments import VECTOR_DTYPES, ActiveSegment, SealedSegment, SegmentManifest
+
+# 有獨立欄位 (typed array) 的 metadata，其餘欄位放在 extra dict
+_COLUMN_FIELDS = ("id", "created_at", "last_accessed_at", "importance", "type", "agent_id")
+
+Segment = Union[ActiveSegment, SealedSegment]
+
+class NumpyMemoryStore:
+    """
+    純 NumPy 的 MemoryStore，不需要任何 server
+    - 向量存成正規化後的矩陣，cosine 相似度 = 內積
+    - importance / created_at / last_accessed_at / type / agent_id 存成 typed array，
+      過濾條件直接在欄位上算出 boolean mask，只對通過的列做內積
+    - vector_dtype 為 float16 / int8 時，記憶體中只保留壓縮向量做粗排，
+      精確的 float32 向量放在磁碟上的 memmap，只對前 k * rescore_factor 個候選重新計分
+
+    persist_dir 有設定時，資料存成 append-only 的 segment 目錄:
+        manifest.json  ---> 維度 / 向量格式 / 類型字典 / segment 列表
+        seg_000000/    ---> 已封存，所有欄位以 memmap 開啟 (只載入檢索碰到的 page)
+        active/        ---> 新記憶寫入這裡，超過 segment_rows 或 seal_interval 秒後封存
+    開啟 store 只讀 manifest，成本與記憶數量無關
+    delete 只標記 tombstone；vacuum() 把 tombstone 比例高的 segment 重寫成只含存活記錄的新 segment
+    """
+
+    def __init__(
+        self,
+        persist_dir: Optional[str] = None,
+        capacity: int = 1024,
+        vector_dtype: str = "float32",
+        rescore_factor: int = 4,
+        segment_rows: int = 8192,
+        seal_interval: Optional[float] = None,
+    ):
+        if vector_dtype not in VECTOR_DTYPES:
+            raise ValueError(f"Unknown vector dtype: {vector_dtype}")
+        self.persist_dir = persist_dir
+        self.vector_dtype = vector_dtype
+        self.rescore_factor = rescore_factor
+        self.segment_rows = segment_rows
+        self.seal_interval = seal_interval
+        self._capacity = capacity
+        self._lock = threading.RLock()
+
+        self._dim: Optional[int] = None # 第一次寫入時才知道維度
+        self._sealed: List[SealedSegment] = []
+        self._active: Optional[ActiveSegment] = None
+        self._type_vocab: List[str] = [] # code -> type 名稱
+        self._agent_vocab: List[str] = [] # code -> agent_id (多個 agent 共用一個 store 時的分區)
+        # sealed segment 上非欄位 metadata 的修改 (id -> {field: value})
+        self._overlay: Dict[str, Dict[str, Any]] = {}
+        self._dirty = False
+
+        if persist_dir and SegmentManifest.exists(persist_dir):
+            self._open()
+
+    # ==========================================
+    # 內部工具
+    # ==========================================
+    @property
+    def quantized(self) -> bool:
+        return self.vector_dtype != "float32"
+
+    def _segments(self) -> List[Segment]:
+        segments: List[Segment] = list(self._sealed)
+        if self._active is not None and self._active.size:
+            segments.append(self._active)
+        return segments
+
+    def _segment_path(self, name: str) -> Optional[str]:
+        return os.path.join(self.persist_dir, name) if self.persist_dir else None
+
+    def _new_active(self, dim: int) -> ActiveSegment:
+        return ActiveSegment(dim, self.vector_dtype, path=self._segment_path("active"), capacity=self._capacity)
+
+    def _open(self):
+        """只讀 manifest 並建立 memmap，不讀取任何向量資料"""
+        manifest = SegmentManifest.read(self.persist_dir)
+        if manifest.vector_dtype != self.vector_dtype:
+            raise ValueError(
+                f"Store at {self.persist_dir} was written as {manifest.vector_dtype}, not {self.vector_dtype}"
+            )
+        self._dim = manifest.dim
+        self._type_vocab = list(manifest.type_vocab)
+        self._agent_vocab = list(manifest.agent_vocab)
+        self._overlay = dict(manifest.overlay)
+        for seg in manifest.segments:
+            self._sealed.append(SealedSegment(
+                self._segment_path(seg["name"]), manifest.dim, self.vector_dtype, seg["rows"], seg["id_width"]
+            ))
+        self._active = ActiveSegment.load(
+            self._segment_path("active"), manifest.dim, self.vector_dtype, manifest.active_rows
+        )
+
+    def _write_manifest(self):
+        SegmentManifest(
+            dim=self._dim,
+            vector_dtype=self.vector_dtype,
+            type_vocab=self._type_vocab,
+            agent_vocab=self._agent_vocab,
+            segments=[
+                {"name": os.path.basename(seg.path), "rows": seg.size, "id_width": seg.id_width}
+                for seg in self._sealed
+            ],
+            active_rows=self._active.size if self._active else 0,
+            overlay=self._overlay,
+        ).write(self.persist_dir)
+
+    def _maybe_seal(self):
+        """active segment 夠大或夠舊時封存 (只有落地模式才需要)"""
+        active = self._active
+        if not self.persist_dir or active is None or active.size == 0:
+            return
+        too_big = active.size >= self.segment_rows
+        too_old = self.seal_interval is not None and time.time() - active.created >= self.seal_interval
+        if not (too_big or too_old):
+            return
+        # 先寫出新的 seg 目錄並更新 manifest，最後才刪除 active 目錄 (任何一步中斷都不會遺失記憶)
+        name = self._segment_name(self._next_segment_index())
+        sealed = active.seal_to(self._segment_path(name))
+        self._sealed.append(sealed)
+        self._active = None
+        try:
+            self._write_manifest()
+        except BaseException:
+            self._sealed.pop()
+            self._active = active
+            raise
+        active.discard()
+        self._active = self._new_active(self._dim)
+        print(f"📦 [NumpyStore] Sealed {name} ({active.size} memories).")
+
+    def _next_segment_index(self) -> int:
+        return max((int(os.path.basename(seg.path)[len("seg_"):]) for seg in self._sealed), default=-1) + 1
+
+    @staticmethod
+    def _segment_name(index: int) -> str:
+        return f"seg_{index:06d}"
+
+    def _rewrite(self, seg: Segment, rows: np.ndarray, path: Optional[str]) -> Segment:
+        """只保留 rows 這些列重寫成新的 segment (path 為 None 時留在記憶體中，不封存)"""
+        fresh = ActiveSegment(self._dim, self.vector_dtype, capacity=max(len(rows), self._capacity))
+        if len(rows):
+            texts, extras = zip(*(seg.text_and_extra(int(r)) for r in rows))
+            fresh.append(
+                [seg.id_at(int(r)) for r in rows],
+                list(texts),
+                seg.exact_rows(rows), # 從精確向量重新編碼，量化結果與原本相同
+                {name: np.asarray(getattr(seg, name)[rows])
+                 for name in ("created_at", "last_accessed_at", "importance", "type_codes", "agent_codes")},
+                [dict(extra) for extra in extras],
+            )
+        return fresh.seal_to(path) if path else fresh
+
+    def _type_code(self, type_name: str) -> int:
+        if type_name not in self._type_vocab:
+            self._type_vocab.append(type_name)
+        return self._type_vocab.index(type_name)
+
+    def _agent_code(self, agent_id: Optional[str]) -> int:
+        if agent_id is None:
+            return -1
+        if agent_id not in self._agent_vocab:
+            self._agent_vocab.append(agent_id)
+        return self._agent_vocab.index(agent_id)
+
+    def _mask(self, seg: Segment, memory_filter: Optional[MemoryFilter]) -> Optional[np.ndarray]:
+        """把過濾條件轉成欄位上的 boolean mask，沒有條件時回傳 None"""
+        if memory_filter is None or memory_filter.is_empty():
+            return None
+        n = seg.size
+        mask = np.ones(n, dtype=bool)
+        if memory_filter.types:
+            codes = [self._type_vocab.index(t) for t in memory_filter.types if t in self._type_vocab]
+            mask &= np.isin(seg.type_codes[:n], codes)
+        if memory_filter.agent_ids:
+            codes = [self._agent_vocab.index(a) for a in memory_filter.agent_ids if a in self._agent_vocab]
+            mask &= np.isin(seg.agent_codes[:n], codes)
+        if memory_filter.created_after is not None:
+            mask &= seg.created_at[:n] >= memory_filter.created_after.timestamp()
+        if memory_filter.created_before is not None:
+            mask &= seg.created_at[:n] < memory_filter.created_before.timestamp()
+        if memory_filter.min_importance is not None:
+            mask &= seg.importance[:n] >= memory_filter.min_importance
+        if memory_filter.max_importance is not None:
+            mask &= seg.importance[:n] <= memory_filter.max_importance
+        if memory_filter.accessed_before is not None:
+            mask &= seg.last_accessed_at[:n] < memory_filter.accessed_before.timestamp()
+        return mask
+
+    def _rows(self, seg: Segment, memory_filter: Optional[MemoryFilter]) -> np.ndarray:
+        alive = seg.deleted[:seg.size] == 0
+        mask = self._mask(seg, memory_filter)
+        return np.flatnonzero(alive if mask is None else alive & mask)
+
+    def _coarse_scores(self, seg: Segment, rows: np.ndarray, query: np.ndarray) -> np.ndarray:
+        """以儲存格式計算 (近似) 內積"""
+        codes = seg.codes[rows]
+        if self.vector_dtype == "int8":
+            return (codes.astype(np.float32) @ query) * seg.scales[rows]
+        return codes.astype(np.float32, copy=False) @ query
+
+    def _document(self, seg: Segment, row: int) -> Document:
+        text, extra = seg.text_and_extra(row)
+        doc_id = seg.id_at(row)
+        metadata = {
+            "id": doc_id,
+            "created_at": float(seg.created_at[row]),
+            "last_accessed_at": float(seg.last_accessed_at[row]),
+            "importance": int(seg.importance[row]),
+            "type": self._type_vocab[seg.type_codes[row]],
+            **extra,
+            **({"agent_id": self._agent_vocab[seg.agent_codes[row]]} if seg.agent_codes[row] >= 0 else {}),
+            **self._overlay.get(doc_id, {})
+        }
+        return Document(page_content=text, metadata=metadata)
+
+    def _locate(self, doc_id: str) -> Optional[Tuple[Segment, int]]:
+        """找出 id 所在的 segment 與列號 (已刪除的視為不存在)"""
+        candidates = ([self._active] if self._active is not None else []) + self._sealed
+        for seg in candidates:
+            row = seg.find(doc_id)
+            if row is not None and not seg.deleted[row]:
+                return seg, row
+        return None
+
+    def memory_footprint(self) -> Dict[str, int]:
+        """各部分的 bytes (精確向量在磁碟上，不計入)"""
+        n = self.count()
+        dim = self._dim or 0
+        return {
+            "vectors": n * dim * np.dtype(VECTOR_DTYPES[self.vector_dtype]).itemsize,
+            "scales": n * 4 if self.vector_dtype == "int8" else 0,
+            "columns": n * (8 + 8 + 1 + 1 + 2),
+        }
+
+    # ==========================================
+    # MemoryStore 介面
+    # ==========================================
+    def add(self, ids, texts, embeddings, metadatas) -> None:
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        if vectors.ndim == 1:
+            vectors = vectors[None, :]
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors = vectors / np.maximum(norms, 1e-12)
+
+        with self._lock:
+            if self._dim is None:
+                self._dim = vectors.shape[1]
+            if self._active is None:
+                self._active = self._new_active(self._dim)
+            columns = {
+                "created_at": np.array([m.get("created_at", 0.0) for m in metadatas], dtype=np.float64),
+                "last_accessed_at": np.array(
+                    [m.get("last_accessed_at", m.get("created_at", 0.0)) for m in metadatas], dtype=np.float64
+                ),
+                "importance": np.array([m.get("importance", 1) for m in metadatas], dtype=np.int8),
+                "type_codes": np.array([self._type_code(m.get("type", "observation")) for m in metadatas], dtype=np.int8),
+                "agent_codes": np.array([self._agent_code(m.get("agent_id")) for m in metadatas], dtype=np.int16),
+            }
+            extras = [{k: v for k, v in m.items() if k not in _COLUMN_FIELDS} for m in metadatas]
+            self._active.append(list(ids), list(texts), vectors, columns, extras)
+            self._dirty = True
+            self._maybe_seal()
+
+    def knn(self, embedding, k, memory_filter=None) -> List[Tuple[Document, float]]:
+        with self._lock:
+            query = np.asarray(embedding, dtype=np.float32)
+            query = query / max(float(np.linalg.norm(query)), 1e-12)
+            n_keep = k * self.rescore_factor if self.quantized else k
+
+            # 每個 segment 各自取前 n_keep 個，再合併
+            seg_ids, rows_all, sims_all = [], [], []
+            segments = self._segments()
+            for seg_idx, seg in enumerate(segments):
+                rows = self._rows(seg, memory_filter)
+                if len(rows) == 0:
+                    continue
+                sims = self._coarse_scores(seg, rows, query)
+                if len(rows) > n_keep:
+                    keep = np.argpartition(-sims, n_keep - 1)[:n_keep]
+                    rows, sims = rows[keep], sims[keep]
+                seg_ids.append(np.full(len(rows), seg_idx))
+                rows_all.append(rows)
+                sims_all.append(sims)
+            if not rows_all:
+                return []
+            seg_ids = np.concatenate(seg_ids)
+            rows = np.concatenate(rows_all)
+            sims = np.concatenate(sims_all)
+
+            if self.quantized:
+                # 精排: 只對候選讀取精確向量
+                if len(rows) > n_keep:
+                    keep = np.argpartition(-sims, n_keep - 1)[:n_keep]
+                    seg_ids, rows = seg_ids[keep], rows[keep]
+                sims = np.empty(len(rows), dtype=np.float32)
+                for seg_idx in np.unique(seg_ids):
+                    sel = np.flatnonzero(seg_ids == seg_idx)
+                    # 依列號排序，讓 memmap 讀取連續一點
+                    sel = sel[np.argsort(rows[sel])]
+                    sims[sel] = segments[seg_idx].exact_rows(rows[sel]) @ query
+
+            # argpartition 取前 k 個，再只對這 k 個排序
+            k = min(k, len(rows))
+            top = np.argpartition(-sims, k - 1)[:k]
+            top = top[np.argsort(-sims[top])]
+            return [
+                (self._document(segments[seg_ids[i]], int(rows[i])), float(1.0 - sims[i]))
+                for i in top
+            ]
+
+    def patch_metadata(self, ids, columns) -> None:
+        with self._lock:
+            located = [self._locate(doc_id) for doc_id in ids]
+            for field, values in columns.items():
+                for doc_id, loc, value in zip(ids, located, values):
+                    if loc is None:
+                        continue
+                    seg, row = loc
+                    if field == "last_accessed_at":
+                        seg.last_accessed_at[row] = value
+                    elif field == "importance":
+                        seg.importance[row] = value
+                    elif field == "created_at":
+                        seg.created_at[row] = value
+                    elif field == "type":
+                        seg.type_codes[row] = self._type_code(value)
+                    elif seg.sealed:
+                        self._overlay.setdefault(doc_id, {})[field] = value
+                    else:
+                        seg.patch_extra(row, field, value)
+                    if not seg.sealed:
+                        seg.dirty = True
+            self._dirty = True
+
+    def scan_by_time(self, start=None, end=None, memory_filter=None) -> List[Document]:
+        with self._lock:
+            memory_filter = (memory_filter or MemoryFilter()).model_copy()
+            if start is not None:
+                memory_filter.created_after = max(start, memory_filter.created_after or start)
+            if end is not None:
+                memory_filter.created_before = min(end, memory_filter.created_before or end)
+
+            found = []
+            for seg in self._segments():
+                rows = self._rows(seg, memory_filter)
+                found.extend((float(seg.created_at[r]), seg, int(r)) for r in rows)
+            found.sort(key=lambda item: item[0])
+            return [self._document(seg, row) for _, seg, row in found]
+
+    def scan_columns(self, memory_filter=None, fields=()) -> Dict[str, List[Any]]:
+        """只讀欄位陣列與 id (sealed segment 不會讀 rows.jsonl)"""
+        with self._lock:
+            columns: Dict[str, List[Any]] = {"id": [], **{f: [] for f in fields}}
+            for seg in self._segments():
+                rows = self._rows(seg, memory_filter)
+                columns["id"].extend(seg.id_at(int(r)) for r in rows)
+                for f in fields:
+                    if f in ("created_at", "last_accessed_at"):
+                        columns[f].extend(getattr(seg, f)[rows].tolist())
+                    elif f == "importance":
+                        columns[f].extend(int(v) for v in seg.importance[rows])
+                    elif f == "type":
+                        columns[f].extend(self._type_vocab[c] for c in seg.type_codes[rows])
+                    elif f == "agent_id":
+                        columns[f].extend(self._agent_vocab[c] if c >= 0 else None for c in seg.agent_codes[rows])
+                    else:
+                        raise ValueError(f"Unsupported column: {f}")
+            return columns
+
+    def fetch(self, ids) -> Tuple[List[Document], List[List[float]]]:
+        with self._lock:
+            docs, vectors = [], []
+            for doc_id in ids:
+                loc = self._locate(doc_id)
+                if loc is None:
+                    continue
+                seg, row = loc
+                docs.append(self._document(seg, row))
+                vectors.append(seg.exact_rows(np.array([row]))[0].astype(np.float32).tolist())
+            return docs, vectors
+
+    def delete(self, ids) -> None:
+        """append-only: 只標記 tombstone，空間在 vacuum() 重寫 segment 時回收"""
+        with self._lock:
+            for doc_id in ids:
+                loc = self._locate(doc_id)
+                if loc is None:
+                    continue
+                seg, row = loc
+                seg.deleted[row] = 1
+                if not seg.sealed:
+                    seg.dirty = True
+                self._overlay.pop(doc_id, None)
+            self._dirty = True
+
+    def vacuum(self, max_deleted_ratio: float = 0.3) -> int:
+        """
+        重寫 tombstone 比例 >= max_deleted_ratio 的 segment，回傳回收的列數
+        落地模式: 寫出新的 seg 目錄 -> 更新 manifest -> 才刪除舊目錄 (與封存相同的順序)；
+        active segment 等封存之後再處理。沒有落地時直接重建 active segment
+        """
+        def deleted_ratio(seg: Segment) -> float:
+            return np.count_nonzero(seg.deleted[:seg.size]) / seg.size if seg.size else 0.0
+
+        with self._lock:
+            if not self.persist_dir:
+                active = self._active
+                if active is None or not active.size or deleted_ratio(active) < max_deleted_ratio:
+                    return 0
+                rows = np.flatnonzero(active.deleted[:active.size] == 0)
+                self._active = self._rewrite(active, rows, None)
+                return active.size - len(rows)
+
+            previous = list(self._sealed)
+            rewritten: List[SealedSegment] = []
+            stale: List[SealedSegment] = []
+            kept: List[SealedSegment] = []
+            next_index = self._next_segment_index()
+            reclaimed = 0
+            try:
+                for seg in previous:
+                    if deleted_ratio(seg) < max_deleted_ratio:
+                        kept.append(seg)
+                        continue
+                    rows = np.flatnonzero(seg.deleted[:seg.size] == 0)
+                    reclaimed += seg.size - len(rows)
+                    stale.append(seg)
+                    if len(rows):
+                        fresh = self._rewrite(seg, rows, self._segment_path(self._segment_name(next_index)))
+                        next_index += 1
+                        rewritten.append(fresh)
+                        kept.append(fresh)
+                if not stale:
+                    return 0
+                self._sealed = kept
+                self._write_manifest()
+            except BaseException:
+                # manifest 沒有更新: 舊的 segment 仍然有效，丟掉寫到一半的新目錄
+                self._sealed = previous
+                for fresh in rewritten:
+                    fresh.discard()
+                raise
+            for seg in stale:
+                seg.discard()
+            print(f"🧹 [NumpyStore] Rewrote {len(stale)} segment(s), reclaimed {reclaimed} deleted rows.")
+            return reclaimed
+
+    def count(self) -> int:
+        return sum(int(seg.size - np.count_nonzero(seg.deleted[:seg.size])) for seg in self._segments())
+
+    def flush(self) -> None:
+        """寫回 active segment、sealed 的原地 patch 與 manifest"""
+        if not self.persist_dir or not self._dirty or self._dim is None:
+            return
+        with self._lock:
+            self._maybe_seal()
+            if self._active is not None:
+                self._active.save()
+            for seg in self._sealed:
+                seg.flush()
+            self._write_manifest()
+            self._dirty = False
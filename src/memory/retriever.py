@@ -1,57 +1,236 @@
 import asyncio
+import json
+import threading
 import uuid
+from collections import OrderedDict
 import numpy as np
-from datetime import datetime
-from typing import List, Optional
+from datetime import datetime, timedelta
+from typing import Iterator, List, Optional, Sequence, Set
 
-from langchain_chroma import Chroma
 from langchain_core.documents import Document
 
-from src.memory.models import Memory
+from src.memory.models import Memory, MemoryFilter, MemoryRecord
 from src.memory.importance import get_importance_scorer
+from src.memory.store import MemoryStore, get_memory_store, get_shared_memory_store
+from src.memory.access import AccessTracker
+from src.memory.compaction import CompactionReport, MemoryCompactor
+from src.config import config
+from src.executors import get_executor
 from src.llm_factory import get_embeddings
+from src.tracing import span, traced
+
+# 共用 store 中所有 agent 都看得到的分區 (例如世界設定、公告)
+WORLD_AGENT_ID = "__world__"
+
+# 檢索句的 embedding 快取 (整個 process 共用；計畫流程的固定檢索句會在 warmup 時先放進來)
+_QUERY_CACHE_SIZE = 1024
+_query_cache: "OrderedDict[str, List[float]]" = OrderedDict()
+_query_cache_lock = threading.Lock()
+
+def cache_query_embeddings(queries: List[str], vectors: List[List[float]]):
+    with _query_cache_lock:
+        for query, vector in zip(queries, vectors):
+            _query_cache[query] = vector
+            _query_cache.move_to_end(query)
+        while len(_query_cache) > _QUERY_CACHE_SIZE:
+            _query_cache.popitem(last=False)
+
+def _cached_query_embedding(query: str) -> Optional[List[float]]:
+    with _query_cache_lock:
+        vector = _query_cache.get(query)
+        if vector is not None:
+            _query_cache.move_to_end(query)
+        return vector
 
 class GenerativeRetriever:
     """
     add_memory (新增記憶) ---> 寫入 DB
 
-    retriever (回想) ---> 更新 last_access_time
-                           |
-                           +--> push memory.id 到 update_queue (可選)
-    _background_flusher (背景守護) ---> 取出 queue 中的 id
+    retriever (回想) ---> access_tracker.touch (記憶體中的 id -> 存取時間，打分數立即生效)
+    _background_flusher (背景守護) ---> 每 ACCESS_FLUSH_INTERVAL 秒 或 累積超過門檻時
                                         |
-                                        +--> asyncio.to_thread(_batch_update_access_time)
-    _batch_update_access_time (同步) ---> 讀取 metadata -> 更新 last_accessed_at -> 寫回 DB
+                                        +--> vector_io executor (_batch_update_access_time)
+    _batch_update_access_time (同步) ---> store.patch_metadata 只更新 last_accessed_at 欄位
+                                          被檢索到的封存記憶在這裡搬回熱資料層 (封存層不會收到 patch)
+    待寫回數量超過 ACCESS_MAX_PENDING 時，retrieve 會先等這次寫回完成 (backpressure)
+
+    阻塞式工作分別送到專用的 executor (見 src/executors.py)，CPU 密集的 embedding 不會卡住 DB 讀寫:
+        embed ---> embedding 模型 / vector_io ---> MemoryStore
+    重要性評分走 ainvoke，由 LLM 排程器 (src/llm_scheduler.py) 以 score 的優先權排隊
+
+    儲存後端透過 MemoryStore 介面存取 (Chroma / NumPy)，打分數邏輯與後端無關
+
+    shared_collection 有設定時，所有 agent 共用同一個 store (同一份 index / embedding 模型)，
+    每筆記憶帶 agent_id，檢索只看 [自己, __world__] 兩個分區
     """
-    def __init__(self, collection_name: str, decay_factor: float = 0.995):
+    def __init__(
+        self,
+        collection_name: str,
+        decay_factor: float = 0.995,
+        mode: Optional[str] = None,
+        store: Optional[MemoryStore] = None,
+        hot_cap: Optional[int] = None,
+        agent_id: Optional[str] = None,
+        shared_collection: Optional[str] = None,
+    ):
         """
         初始化檢索器
         Args:
-            collection_name: ChromaDB 的集合名稱
+            collection_name: 記憶集合名稱
             decay_factor: 記憶遺忘係數 (論文預設 0.995)
+            mode: embedded / http / memory (預設讀取 config.CHROMA_MODE)
+            store: 直接指定儲存後端 (預設依 config.MEMORY_STORE 建立)
+            hot_cap: 此 agent 熱資料層的記憶上限 (預設讀取 config.MEMORY_HOT_CAP)
+            agent_id: 共用 store 時的分區名稱 (預設為 collection_name)
+            shared_collection: 共用的 collection 名稱 (預設讀取 config.MEMORY_SHARED_COLLECTION，空字串 = 不共用)
         """
-        # 用來將文字轉成向量 (vector) 儲存於向量資料庫中。
-        self.embeddings = get_embeddings()
+        shared_collection = shared_collection if shared_collection is not None else config.MEMORY_SHARED_COLLECTION
+        self.shared_collection = shared_collection or None
+        self.agent_id = agent_id or collection_name
         
-        # 初始化 Chroma Vector Database (向量搜尋使用 cosine similarity)
-        self.vector_store = Chroma(
-            collection_name=collection_name,
-            embedding_function=self.embeddings,
-            client_settings=None, 
-            collection_metadata={"hnsw:space": "cosine"} # 使用餘弦相似度
-        )
+        # 初始化向量儲存 (向量搜尋使用 cosine similarity)
+        # 持久化模式下，既有的向量直接從磁碟讀回，不會重新 embedding
+        if store is not None:
+            self.store = store
+        elif self.shared_collection:
+            self.store = get_shared_memory_store(self.shared_collection, mode=mode)
+        else:
+            self.store = get_memory_store(collection_name, mode=mode)
+        existing = self.store.count()
+        if existing:
+            print(f"💾 [Retriever] Restored {existing} memories from '{self.shared_collection or collection_name}'.")
         
         # 使用本地小模型的評分器
         self.importance_scorer = get_importance_scorer()
         # 記憶衰退係數
         self.decay_factor = decay_factor
         
-        # 存放待更新記憶，不阻塞主執行流程
-        self.update_queue = asyncio.Queue()
-        # 建立背景工作任務，持續處理更新佇列 → 將更新後的記憶批量寫回 Chroma
+        # 記憶的存取時間先記在記憶體，不阻塞主執行流程
+        self.access_tracker = AccessTracker(
+            flush_threshold=config.ACCESS_FLUSH_THRESHOLD, max_pending=config.ACCESS_MAX_PENDING
+        )
+        self.flush_interval = config.ACCESS_FLUSH_INTERVAL
+        self._flush_now = asyncio.Event()
+        self._flush_lock = asyncio.Lock() # 背景寫回與 backpressure 寫回不同時 drain
+
+        self._embed_pool = get_executor("embed")
+        self._io_pool = get_executor("vector_io")
+        # 建立背景工作任務 → 將存取時間批量寫回 DB
         self.flusher_task = asyncio.create_task(self._background_flusher())
+
+        # 封存層 (冷資料)，只在 include_archive=True 時搜尋
+        self.collection_name = collection_name
+        self._mode = mode
+        self._archive_store: Optional[MemoryStore] = None
+        # 被檢索到的封存記憶 id，下次寫回存取時間時搬回熱資料層
+        self._archive_hits: Set[str] = set()
+        self._archive_hits_lock = threading.Lock()
+        # 記憶流中看過的最新時間 (模擬時間)，壓縮時用來判斷冷熱
+        self._stream_now: Optional[datetime] = None
+        self.hot_cap = hot_cap if hot_cap is not None else (config.MEMORY_HOT_CAP or None)
+        self.compactor: Optional[MemoryCompactor] = None
+        self.compaction_task = None
+        if config.MEMORY_COMPACTION_INTERVAL > 0:
+            self.compaction_task = asyncio.create_task(self._background_compactor())
         print(f"🚀 [Retriever] Initialized with Async Write-back & Local LLM Scoring.")
 
+    @property
+    def embeddings(self):
+        """
+        用來將文字轉成向量 (vector) 儲存於向量資料庫中。(所有 agent 共用同一個模型)
+        第一次用到時才載入，而且只在 embed executor 的 thread 中被呼叫，不會卡住 event loop
+        """
+        return get_embeddings()
+
+    def _embed_array(self, texts: List[str]) -> np.ndarray:
+        """(N, dim) float32；EmbeddingService / CPU 引擎直接回傳陣列，不轉成 list"""
+        embed_array = getattr(self.embeddings, "embed_array", None)
+        if embed_array is not None:
+            return embed_array(texts)
+        return np.asarray(self.embeddings.embed_documents(texts), dtype=np.float32)
+
+    def _embed_query(self, text: str) -> np.ndarray:
+        # 查詢向量會放進快取，只複製這一列 (不長期佔住 embedding service 的輸出區)
+        return self._embed_array([text])[0].copy()
+
+    def _embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.embeddings.embed_documents(texts)
+
+    async def embed_query(self, text: str) -> Sequence[float]:
+        """[Async] 查詢句的 embedding: 先查快取，沒有才送到 embed executor"""
+        vector = _cached_query_embedding(text)
+        if vector is None:
+            with span("embed", cat="embedding"):
+                vector = await self._embed_pool.run(self._embed_query, text)
+            cache_query_embeddings([text], [vector])
+        return vector
+
+    @property
+    def archive_store(self) -> MemoryStore:
+        """封存層在第一次用到時才建立"""
+        if self._archive_store is None:
+            if self.shared_collection:
+                self._archive_store = get_shared_memory_store(f"{self.shared_collection}_archive", mode=self._mode)
+            else:
+                self._archive_store = get_memory_store(f"{self.collection_name}_archive", mode=self._mode)
+        return self._archive_store
+
+    def _partition(self) -> Optional[List[str]]:
+        """共用 store 時此 agent 可見的分區 (不共用時不需要過濾)"""
+        return [self.agent_id, WORLD_AGENT_ID] if self.shared_collection else None
+
+    def _stamp(self, shared: bool = False) -> dict:
+        """寫入時附加的分區 metadata"""
+        if not self.shared_collection:
+            return {}
+        return {"agent_id": WORLD_AGENT_ID if shared else self.agent_id}
+
+    def _touch_stream_time(self, t: datetime):
+        """
+        只由呼叫端明確傳入的時間 (模擬時間) 推進；沒有傳時間時的系統時間預設值不算，
+        否則一次系統時間的寫入就會讓壓縮把所有模擬記憶當成冷資料
+        """
+        if self._stream_now is None or t > self._stream_now:
+            self._stream_now = t
+
+    async def compact(self, now: datetime = None) -> CompactionReport:
+        """
+        [Async] 執行一輪記憶壓縮
+        1. 合併重複的低重要性觀察
+        2. 把冷資料移到封存層，並讓熱資料層維持在 MEMORY_HOT_CAP 以下
+        3. 重寫已刪除比例超過 MEMORY_VACUUM_RATIO 的 segment
+        """
+        if self.compactor is None:
+            self.compactor = MemoryCompactor(
+                self.store,
+                self.archive_store,
+                max_merge_importance=config.MEMORY_MERGE_MAX_IMPORTANCE,
+                similarity=config.MEMORY_MERGE_SIMILARITY,
+                archive_after=timedelta(hours=config.MEMORY_ARCHIVE_AFTER_HOURS),
+                hot_cap=self.hot_cap,
+                vacuum_ratio=config.MEMORY_VACUUM_RATIO,
+                # 只壓縮自己的分區，世界記憶不歸任何一個 agent 管
+                agent_ids=[self.agent_id] if self.shared_collection else None,
+            )
+        now = now or self._stream_now or datetime.now()
+        # 先把記憶體中的存取時間寫回，冷熱判斷才會準確
+        await self._flush_access()
+        report = await self._io_pool.run(self.compactor.run, now)
+        print(f"🗜️ [Retriever] Compaction: merged {report.merged_records} -> {report.merged_groups}, "
+              f"archived {report.archived}, reclaimed {report.reclaimed}, hot {report.hot_count}")
+        return report
+
+    async def _background_compactor(self):
+        """[Background Task] 定期執行記憶壓縮"""
+        while True:
+            try:
+                await asyncio.sleep(config.MEMORY_COMPACTION_INTERVAL)
+                await self.compact()
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                print(f"Compaction Error: {e}")
+
     async def _background_flusher(self):
         """
         [Background Task] 定期將 last_accessed_at 寫回 DB
@@ -59,66 +238,85 @@ class GenerativeRetriever:
         """
         while True:
             try:
-                ids_to_update = []
-                # 嘗試將 Queue 中的所有任務取出
-                while not self.update_queue.empty():
-                    ids_to_update.append(self.update_queue.get_nowait())
-                
-                if ids_to_update:
-                    # 避免同一個 ID 被多次更新, 去重複
-                    unique_ids = list(set(ids_to_update))
-                    current_time = datetime.now().timestamp()
-                    
-                    # ChromaDB 寫入是 同步 & 阻塞式 I/O, 要 await (需放入其他 thread 避免阻塞)
-                    await asyncio.to_thread(self._batch_update_access_time, unique_ids, current_time)
-                    
-                # 每 5 秒 loop 一次
-                await asyncio.sleep(5)
+                # 等到時間到，或是累積的存取數超過門檻被提早喚醒
+                try:
+                    await asyncio.wait_for(self._flush_now.wait(), timeout=self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+                self._flush_now.clear()
+
+                # DB 寫入是 同步 & 阻塞式 I/O, 要 await (需放入其他 thread 避免阻塞)
+                await self._flush_access()
+                # 沒有即時落地的後端 (NumPy) 在這裡寫回磁碟
+                await self._io_pool.run(self.store.flush)
                 
             except asyncio.CancelledError:
                 print("Flusher task cancelled.")
                 break
             except Exception as e:
                 print(f"Flusher Error: {e}")
-                await asyncio.sleep(5)
+                await asyncio.sleep(self.flush_interval)
+
+    async def _flush_access(self):
+        """[Async] 把記憶體中的存取時間寫回 DB (同一時間只有一個寫回)"""
+        async with self._flush_lock:
+            if self.access_tracker.pending_count():
+                await self._io_pool.run(self._batch_update_access_time)
 
-    def _batch_update_access_time(self, ids: List[str], timestamp: float):
-        """同步的 Chroma 批量更新邏輯 (被上面的 async 包裝)"""
+    def _batch_update_access_time(self):
+        """同步的批量更新邏輯 (被上面的 async 包裝)"""
+        ids, timestamps = self.access_tracker.drain()
+        self._promote_archive_hits()
         try:
-            # 必須先取出 metadata 的其他欄位，因為 update time 會覆蓋整個 metadata
-            existing_data = self.vector_store.get(ids=ids)
-            
-            if existing_data and existing_data['ids']:
-                new_metadatas = []
-                for meta in existing_data['metadatas']:
-                    # 更新時間戳
-                    meta['last_accessed_at'] = timestamp
-                    new_metadatas.append(meta)
-                
-                # 寫回 DB
-                self.vector_store.update_documents(
-                    ids=existing_data['ids'],
-                    metadatas=new_metadatas
-                )
+            # 欄位式 patch: 只寫 last_accessed_at，不需要先讀出整份 metadata
+            self.store.patch_metadata(ids, {"last_accessed_at": timestamps})
+            self.access_tracker.commit()
+        except Exception as e:
+            print(f"   ⚠️ Access Time Update Failed: {e}")
+
+    def _promote_archive_hits(self):
+        """把被檢索到的封存記憶搬回熱資料層 (帶上最新的存取時間)，失敗時留到下次再搬"""
+        with self._archive_hits_lock:
+            hit_ids, self._archive_hits = list(self._archive_hits), set()
+        if not hit_ids:
+            return
+        try:
+            docs, vectors = self.archive_store.fetch(hit_ids)
+            if docs:
+                metadatas = []
+                for doc in docs:
+                    meta = dict(doc.metadata)
+                    meta["last_accessed_at"] = self.access_tracker.get(
+                        meta["id"], meta.get("last_accessed_at", meta["created_at"])
+                    )
+                    metadatas.append(meta)
+                moved_ids = [meta["id"] for meta in metadatas]
+                # 先寫入熱資料層再從封存層刪除 (中途失敗最多留下重複，不會遺失)
+                self.store.add(moved_ids, [doc.page_content for doc in docs], vectors, metadatas)
+                self.archive_store.delete(moved_ids)
         except Exception as e:
-            print(f"   ⚠️ Chroma Update Failed: {e}")
+            print(f"   ⚠️ Archive Promotion Failed: {e}")
+            with self._archive_hits_lock:
+                self._archive_hits.update(hit_ids)
 
-    async def add_memory(self, content: str, created_at: datetime = None, type: str = "observation"):
+    @traced("add_memory", cat="memory")
+    async def add_memory(self, content: str, created_at: datetime = None, type: str = "observation", shared: bool = False):
         """
         [Async] 新增記憶
         1. 呼叫本地 LLM 評分 (Fast)
         2. 寫入 Vector DB
+        shared=True 時寫入 __world__ 分區 (只存一份，所有 agent 都檢索得到)
         """
         if created_at is None:
             created_at = datetime.now()
+        else:
+            self._touch_stream_time(created_at)
 
         # 計算重要性
-        # 使用 to_thread 避免 invoke 阻塞 Event Loop
+        # ainvoke 不會阻塞 Event Loop，並經過 LLM 排程器
         try:
-            score = await asyncio.to_thread(
-                self.importance_scorer.invoke, # blocking method
-                {"memory_content": content} # method param
-            )
+            with span("importance_score", cat="memory"):
+                score = await self.importance_scorer.ainvoke({"memory_content": content})
         except Exception as e:
             print(f"   ⚠️ Scoring failed, defaulting to 1. Error: {e}")
             score = 1
@@ -129,33 +327,178 @@ class GenerativeRetriever:
             created_at=created_at,
             last_accessed_at=created_at,
             importance=score,
-            type=type
+            type=type,
+            metadata=self._stamp(shared)
         )
         
         # 寫入 Vector DB (Async)
         payload = memory.to_chroma_payload()
-        await asyncio.to_thread(
-            self.vector_store.add_documents,
-            [Document(page_content=payload["page_content"], metadata=payload["metadata"])]
+        with span("embed", cat="embedding"):
+            embeddings = await self._embed_pool.run(self._embed_array, [payload["page_content"]])
+        with span("store.add", cat="store"):
+            await self._io_pool.run(
+                self.store.add,
+                [memory.id], [payload["page_content"]], embeddings, [payload["metadata"]]
+            )
+
+
+    # ==========================================
+    # 批次匯入 / 匯出 (JSONL，一行一筆 MemoryRecord)
+    # ==========================================
+    async def import_jsonl(self, path: str, batch_size: int = 256) -> int:
+        """
+        [Async] 從 JSONL 批次匯入記憶
+        - 有 embedding 的直接使用，缺少的整批一次 embed
+        - 有 importance 的跳過 LLM 評分，缺少的整批並行評分
+        回傳匯入的筆數
+        """
+        total = 0
+        batch: List[MemoryRecord] = []
+        for record in self._iter_records(path):
+            batch.append(record)
+            if len(batch) >= batch_size:
+                total += await self._import_batch(batch)
+                batch = []
+        if batch:
+            total += await self._import_batch(batch)
+        print(f"📥 [Retriever] Imported {total} memories from {path}")
+        return total
+
+    def _iter_records(self, path: str) -> Iterator[MemoryRecord]:
+        with open(path, encoding="utf-8") as f:
+            for line_no, line in enumerate(f, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield MemoryRecord.model_validate_json(line)
+                except ValueError as e:
+                    print(f"   ⚠️ Skipping line {line_no}: {e}")
+
+    async def _import_batch(self, records: List[MemoryRecord]) -> int:
+        # 1. 只對缺少向量的記錄做 embedding (一次整批)
+        missing = [i for i, r in enumerate(records) if r.embedding is None]
+        if missing:
+            vectors = await self._embed_pool.run(
+                self._embed_documents, [records[i].content for i in missing]
+            )
+            for i, vector in zip(missing, vectors):
+                records[i].embedding = vector
+
+        # 2. 只對缺少 importance 的記錄評分 (batch 會並行呼叫本地 LLM)
+        unscored = [i for i, r in enumerate(records) if r.importance is None]
+        scores = {}
+        if unscored:
+            results = await self.importance_scorer.abatch(
+                [{"memory_content": records[i].content} for i in unscored],
+                return_exceptions=True
+            )
+            scores = {i: (s if isinstance(s, int) else 1) for i, s in zip(unscored, results)}
+
+        # 沒有指定分區的記錄歸到此 agent
+        stamp = self._stamp()
+        for r in records:
+            for key, value in stamp.items():
+                r.metadata.setdefault(key, value)
+        memories = [r.to_memory(r.importance if r.importance is not None else scores[i]) for i, r in enumerate(records)]
+        payloads = [m.to_chroma_payload() for m in memories]
+        await self._io_pool.run(
+            self.store.add,
+            [m.id for m in memories],
+            [p["page_content"] for p in payloads],
+            [r.embedding for r in records],
+            [p["metadata"] for p in payloads]
         )
+        self._touch_stream_time(max(m.created_at for m in memories))
+        return len(memories)
 
-        
+    async def export_jsonl(self, path: str, include_embeddings: bool = False, batch_size: int = 512) -> int:
+        """[Async] 依時間順序把記憶匯出成 JSONL，回傳匯出的筆數"""
+        return await self._io_pool.run(self._export_jsonl, path, include_embeddings, batch_size)
 
-    async def retrieve(self, query: str, now: datetime = None, k: int = 5, fetch_k: int = 100) -> List[Document]:
+    def _export_jsonl(self, path: str, include_embeddings: bool, batch_size: int) -> int:
+        docs = self.store.scan_by_time(memory_filter=MemoryFilter(agent_ids=self._partition()))
+        reserved = {"id", "created_at", "last_accessed_at", "importance", "type"}
+        with open(path, "w", encoding="utf-8") as f:
+            for start in range(0, len(docs), batch_size):
+                chunk = docs[start:start + batch_size]
+                vectors = {}
+                if include_embeddings:
+                    fetched, embs = self.store.fetch([d.metadata["id"] for d in chunk])
+                    vectors = {d.metadata["id"]: e for d, e in zip(fetched, embs)}
+                for doc in chunk:
+                    meta = doc.metadata
+                    record = MemoryRecord(
+                        id=meta["id"],
+                        content=doc.page_content,
+                        type=meta.get("type", "observation"),
+                        created_at=datetime.fromtimestamp(meta["created_at"]),
+                        last_accessed_at=datetime.fromtimestamp(
+                            self.access_tracker.get(meta["id"], meta.get("last_accessed_at", meta["created_at"]))
+                        ),
+                        importance=meta.get("importance"),
+                        metadata={k: v for k, v in meta.items() if k not in reserved},
+                        embedding=vectors.get(meta["id"])
+                    )
+                    f.write(record.model_dump_json(exclude_none=True) + "\n")
+        print(f"📤 [Retriever] Exported {len(docs)} memories to {path}")
+        return len(docs)
+
+    @traced("retrieve_memories", cat="memory")
+    async def retrieve(
+        self,
+        query: str,
+        now: datetime = None,
+        k: int = 5,
+        fetch_k: int = 100,
+        memory_types: Optional[List[str]] = None,
+        created_after: Optional[datetime] = None,
+        created_before: Optional[datetime] = None,
+        min_importance: Optional[int] = None,
+        include_archive: bool = False,
+    ) -> List[Document]:
         """
         [Async] 混合檢索核心邏輯
+        Args:
+            memory_types: 只檢索這些類型 (例如 ["reflection"])
+            created_after / created_before: created_at 的時間範圍 [after, before)
+            min_importance: 重要性下限
+            include_archive: 是否一併搜尋封存層 (預設只搜尋熱資料層)
+        過濾條件會在向量搜尋時一併下推，而不是搜完再丟掉
         """
         if now is None:
             now = datetime.now()
+        else:
+            self._touch_stream_time(now)
 
-        # 向量檢索 (Relevance) - 抓取較大範圍的候選集
-        # 使用 to_thread 因為 similarity_search 是同步且耗時的
-        candidates = await asyncio.to_thread(
-            self.vector_store.similarity_search_with_score,
-            query,
-            k=fetch_k
+        memory_filter = MemoryFilter(
+            types=memory_types,
+            created_after=created_after,
+            created_before=created_before,
+            min_importance=min_importance,
+            agent_ids=self._partition(),
         )
 
+        # 向量檢索 (Relevance) - 抓取較大範圍的候選集
+        # embedding 與向量搜尋都是同步且耗時的，分別放到各自的 executor
+        query_embedding = await self.embed_query(query)
+        with span("store.knn", cat="store", k=fetch_k):
+            candidates = await self._io_pool.run(
+                self.store.knn,
+                query_embedding,
+                fetch_k,
+                memory_filter
+            )
+        hot_count = len(candidates)
+        if include_archive:
+            with span("archive.knn", cat="store", k=fetch_k):
+                candidates += await self._io_pool.run(
+                    self.archive_store.knn,
+                    query_embedding,
+                    fetch_k,
+                    memory_filter
+                )
+
         if not candidates:
             return []
 
@@ -163,14 +506,17 @@ class GenerativeRetriever:
         # 論文公式: Score = a*Recency + b*Importance + c*Relevance
         docs = [doc for doc, _ in candidates]
         # A. Relevance (Similarity)
-        # Chroma 回傳的是 Distance (0~2)，轉為 Similarity
+        # 後端回傳的是 cosine Distance (0~2)，轉為 Similarity
         relevance_scores = [1.0 - dist for _, dist in candidates]
         # B. Importance (1-10 -> 0-1)
         importance_scores = [doc.metadata.get("importance", 1) / 10.0 for doc in docs]
         # C. Recency (Decay Factor)
         recency_scores = []
         for doc in docs:
-            last_accessed_ts = doc.metadata.get("last_accessed_at", now.timestamp())
+            # 記憶體中的存取時間比 DB 裡的新 (尚未寫回)
+            last_accessed_ts = self.access_tracker.get(
+                doc.metadata.get("id"), doc.metadata.get("last_accessed_at", now.timestamp())
+            )
             last_accessed = datetime.fromtimestamp(last_accessed_ts)
             hours_passed = (now - last_accessed).total_seconds() / 3600
             hours_passed = max(0, hours_passed)
@@ -196,15 +542,21 @@ class GenerativeRetriever:
         # argsort 是從小到大，所以用 [::-1] 反轉
         top_indices = np.argsort(total_scores)[::-1][:k]
         
-        final_results = []
-        for idx in top_indices:
-            doc = docs[idx]
-            final_results.append(doc)
-            
-            # 將此 ID 加入更新佇列
-            # 我們不等待它寫入，直接繼續
-            doc_id = doc.metadata.get("id")
-            if doc_id:
-                await self.update_queue.put(doc_id)
+        final_results = [docs[idx] for idx in top_indices]
+
+        # 更新存取時間 (只寫記憶體，由背景任務寫回)
+        self.access_tracker.touch(
+            [doc.metadata["id"] for doc in final_results if doc.metadata.get("id")],
+            now.timestamp()
+        )
+        archive_hits = [docs[idx].metadata["id"] for idx in top_indices if idx >= hot_count and docs[idx].metadata.get("id")]
+        if archive_hits:
+            with self._archive_hits_lock:
+                self._archive_hits.update(archive_hits)
+        if self.access_tracker.is_full():
+            # backpressure: 寫回跟不上時，等這次寫回完成再回傳
+            await self._flush_access()
+        elif self.access_tracker.should_flush():
+            self._flush_now.set()
 
         return final_results
\ No newline at end of file
@@ -0,0 +1,346 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import weakref
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+# 向量的儲存格式
+# float32: 原始精度 / float16: 一半空間 / int8: 每個向量一個 scale，約 1/4 空間
+VECTOR_DTYPES = {"float32": np.float32, "float16": np.float16, "int8": np.int8}
+
+# 每個欄位在 segment 目錄中的檔名與型別
+_COLUMN_FILES = {
+    "scales": ("scales.f32", np.float32),
+    "created_at": ("created_at.f64", np.float64),
+    "last_accessed_at": ("last_accessed_at.f64", np.float64),
+    "importance": ("importance.i8", np.int8),
+    "type_codes": ("type.i8", np.int8),
+    "agent_codes": ("agent.i16", np.int16), # agent 分區 (-1 = 未分區)
+    "deleted": ("deleted.i8", np.int8), # tombstone: 1 = 已刪除 (壓縮 / 移到封存層)
+}
+# 後來才加入的欄位: 舊 segment 沒有這個檔案時以預設值補上
+_OPTIONAL_COLUMNS = {"agent_codes": -1}
+# 可以原地 patch 的欄位 (sealed segment 以 r+ 開啟)
+_PATCHABLE = ("created_at", "last_accessed_at", "importance", "type_codes", "deleted")
+
+def encode_vectors(vectors: np.ndarray, vector_dtype: str) -> Tuple[np.ndarray, np.ndarray]:
+    """把正規化後的 float32 向量轉成儲存格式，回傳 (codes, scales)"""
+    if vector_dtype == "int8":
+        scales = np.maximum(np.abs(vectors).max(axis=1), 1e-12) / 127.0
+        codes = np.round(vectors / scales[:, None]).astype(np.int8)
+        return codes, scales.astype(np.float32)
+    return vectors.astype(VECTOR_DTYPES[vector_dtype]), np.ones(len(vectors), dtype=np.float32)
+
+class ActiveSegment:
+    """
+    尾端可寫入的 segment，欄位放在 RAM 中 (大小受 segment_rows 限制)
+    量化模式下精確向量寫在 exact.f32 (memmap)；沒有 path 時使用暫存檔
+    """
+    sealed = False
+
+    def __init__(self, dim: int, vector_dtype: str, path: Optional[str] = None, capacity: int = 1024):
+        self.dim = dim
+        self.vector_dtype = vector_dtype
+        self.path = path
+        self.size = 0
+        self.created = time.time()
+        self.dirty = False
+
+        self.codes = np.zeros((capacity, dim), dtype=VECTOR_DTYPES[vector_dtype])
+        self.scales = np.ones(capacity, dtype=np.float32)
+        self.created_at = np.zeros(capacity, dtype=np.float64)
+        self.last_accessed_at = np.zeros(capacity, dtype=np.float64)
+        self.importance = np.zeros(capacity, dtype=np.int8)
+        self.type_codes = np.zeros(capacity, dtype=np.int8)
+        self.agent_codes = np.full(capacity, -1, dtype=np.int16)
+        self.deleted = np.zeros(capacity, dtype=np.int8)
+        self.ids: List[str] = []
+        self.texts: List[str] = []
+        self.extra: List[Dict[str, Any]] = []
+        self.row_of: Dict[str, int] = {}
+
+        self.exact: Optional[np.memmap] = None
+        self._exact_path: Optional[str] = None
+        if self.quantized:
+            self._grow_exact(capacity)
+
+    @property
+    def quantized(self) -> bool:
+        return self.vector_dtype != "float32"
+
+    def _capacity(self) -> int:
+        return len(self.created_at)
+
+    def _grow_exact(self, capacity: int):
+        """精確向量存放在磁碟檔案上 (memmap)，擴充時只需要加大檔案"""
+        if self._exact_path is None:
+            if self.path:
+                os.makedirs(self.path, exist_ok=True)
+                self._exact_path = os.path.join(self.path, "exact.f32")
+            else:
+                fd, self._exact_path = tempfile.mkstemp(suffix=".f32")
+                os.close(fd)
+                # 沒有 path 時是暫存檔，segment 被回收時一起刪除
+                weakref.finalize(self, os.remove, self._exact_path)
+        if self.exact is not None:
+            self.exact.flush()
+            self.exact = None
+        nbytes = capacity * self.dim * 4
+        with open(self._exact_path, "ab") as f:
+            if f.tell() < nbytes:
+                f.truncate(nbytes)
+        self.exact = np.memmap(self._exact_path, dtype=np.float32, mode="r+", shape=(capacity, self.dim))
+
+    def _ensure_capacity(self, needed: int):
+        capacity = self._capacity()
+        if needed <= capacity:
+            return
+        while capacity < needed:
+            capacity *= 2
+
+        def grow(arr: np.ndarray, fill=0) -> np.ndarray:
+            out = np.full((capacity,) + arr.shape[1:], fill, dtype=arr.dtype)
+            out[:self.size] = arr[:self.size]
+            return out
+
+        self.codes = grow(self.codes)
+        for name in _COLUMN_FILES:
+            setattr(self, name, grow(getattr(self, name), _OPTIONAL_COLUMNS.get(name, 0)))
+        if self.quantized:
+            self._grow_exact(capacity)
+
+    def append(self, ids, texts, vectors: np.ndarray, columns: Dict[str, np.ndarray], extras: List[Dict[str, Any]]):
+        start, end = self.size, self.size + len(ids)
+        self._ensure_capacity(end)
+        codes, scales = encode_vectors(vectors, self.vector_dtype)
+        self.codes[start:end] = codes
+        self.scales[start:end] = scales
+        if self.quantized:
+            self.exact[start:end] = vectors
+        for name, values in columns.items():
+            getattr(self, name)[start:end] = values
+        for offset, doc_id in enumerate(ids):
+            self.row_of[doc_id] = start + offset
+        self.ids.extend(ids)
+        self.texts.extend(texts)
+        self.extra.extend(extras)
+        self.size = end
+        self.dirty = True
+
+    def find(self, doc_id: str) -> Optional[int]:
+        return self.row_of.get(doc_id)
+
+    def id_at(self, row: int) -> str:
+        return self.ids[row]
+
+    def text_and_extra(self, row: int) -> Tuple[str, Dict[str, Any]]:
+        return self.texts[row], self.extra[row]
+
+    def exact_rows(self, rows: np.ndarray) -> np.ndarray:
+        if self.quantized:
+            return np.asarray(self.exact[rows])
+        return self.codes[rows]
+
+    def patch_extra(self, row: int, field: str, value: Any):
+        self.extra[row][field] = value
+        self.dirty = True
+
+    # ==========================================
+    # 落地
+    # ==========================================
+    def _write_files(self, path: str):
+        """把欄位寫成 raw 檔案 (與 sealed segment 相同格式)"""
+        os.makedirs(path, exist_ok=True)
+        n = self.size
+        self.codes[:n].tofile(os.path.join(path, "codes.bin"))
+        for name, (filename, _) in _COLUMN_FILES.items():
+            getattr(self, name)[:n].tofile(os.path.join(path, filename))
+        # 文字與其他 metadata 一行一筆，另外記錄每一行的 byte offset 方便隨機讀取
+        offsets = np.zeros(n + 1, dtype=np.uint64)
+        with open(os.path.join(path, "rows.jsonl"), "wb") as f:
+            for i, (doc_id, text, extra) in enumerate(zip(self.ids, self.texts, self.extra)):
+                f.write(json.dumps({"id": doc_id, "text": text, "extra": extra}, ensure_ascii=False).encode("utf-8") + b"\n")
+                offsets[i + 1] = f.tell()
+        offsets.tofile(os.path.join(path, "offsets.u64"))
+        if self.exact is not None:
+            self.exact.flush()
+
+    def save(self):
+        """把 active segment 寫回自己的目錄 (只在 dirty 時)"""
+        if self.path and self.dirty:
+            self._write_files(self.path)
+            self.dirty = False
+
+    @classmethod
+    def load(cls, path: str, dim: int, vector_dtype: str, rows: int) -> "ActiveSegment":
+        """重新開啟 active segment (大小受 segment_rows 限制，直接讀進 RAM)"""
+        seg = cls(dim, vector_dtype, path=path, capacity=max(rows, 1024))
+        if rows == 0:
+            return seg
+        codes = np.fromfile(os.path.join(path, "codes.bin"), dtype=VECTOR_DTYPES[vector_dtype], count=rows * dim)
+        seg.codes[:rows] = codes.reshape(rows, dim)
+        for name, (filename, dtype) in _COLUMN_FILES.items():
+            if name in _OPTIONAL_COLUMNS and not os.path.exists(os.path.join(path, filename)):
+                continue
+            getattr(seg, name)[:rows] = np.fromfile(os.path.join(path, filename), dtype=dtype, count=rows)
+        with open(os.path.join(path, "rows.jsonl"), encoding="utf-8") as f:
+            for i, line in enumerate(f):
+                if i >= rows:
+                    break
+                row = json.loads(line)
+                seg.row_of[row["id"]] = i
+                seg.ids.append(row["id"])
+                seg.texts.append(row["text"])
+                seg.extra.append(row["extra"])
+        seg.size = rows
+        return seg
+
+    def seal_to(self, path: str) -> "SealedSegment":
+        """
+        在新目錄寫出最終檔案與 id 索引，之後以唯讀 memmap 開啟
+        不動 active 目錄: manifest 列入新的 segment 之後，呼叫端才用 discard() 刪除 active 目錄
+        (中途當機時 manifest 仍指向完整的 active 目錄，沒列入 manifest 的 seg 目錄下次封存時覆寫)
+        """
+        n = self.size
+        if self.exact is not None:
+            self.exact.flush()
+        shutil.rmtree(path, ignore_errors=True) # 上次封存到一半留下的目錄
+        self._write_files(path)
+        if self.quantized:
+            exact_path = os.path.join(path, "exact.f32")
+            if self._exact_path and os.path.abspath(self._exact_path) != os.path.abspath(exact_path) \
+                    and os.path.exists(self._exact_path):
+                shutil.copyfile(self._exact_path, exact_path)
+            with open(exact_path, "r+b") as f:
+                f.truncate(n * self.dim * 4)
+
+        # 排序後的 id，用 searchsorted 查 id -> 列號，不需要把所有 id 載入 dict
+        id_width = max((len(i.encode("utf-8")) for i in self.ids), default=1)
+        ids = np.array([i.encode("utf-8") for i in self.ids], dtype=f"S{id_width}")
+        order = np.argsort(ids, kind="stable").astype(np.int64)
+        ids.tofile(os.path.join(path, "ids.bin"))
+        ids[order].tofile(os.path.join(path, "ids_sorted.bin"))
+        order.tofile(os.path.join(path, "id_order.i64"))
+        return SealedSegment(path, self.dim, self.vector_dtype, n, id_width)
+
+    def discard(self):
+        """封存完成 (manifest 已更新) 後刪除 active 目錄"""
+        if self.path and os.path.exists(self.path):
+            shutil.rmtree(self.path)
+
+class SealedSegment:
+    """
+    封存後的 segment: 所有欄位都是 memmap，開啟時不讀取資料
+    只有檢索真正碰到的 page 才會被載入
+    """
+    sealed = True
+
+    def __init__(self, path: str, dim: int, vector_dtype: str, rows: int, id_width: int):
+        self.path = path
+        self.dim = dim
+        self.vector_dtype = vector_dtype
+        self.size = rows
+        self.id_width = id_width
+        self._lock = threading.Lock()
+        self._rows_file = None
+
+        def mm(filename, dtype, shape, mode="r"):
+            return np.memmap(os.path.join(path, filename), dtype=dtype, mode=mode, shape=shape)
+
+        self.codes = mm("codes.bin", VECTOR_DTYPES[vector_dtype], (rows, dim))
+        for name, (filename, dtype) in _COLUMN_FILES.items():
+            if name in _OPTIONAL_COLUMNS and not os.path.exists(os.path.join(path, filename)):
+                setattr(self, name, np.full(rows, _OPTIONAL_COLUMNS[name], dtype=dtype))
+                continue
+            setattr(self, name, mm(filename, dtype, (rows,), "r+" if name in _PATCHABLE else "r"))
+        self.exact = mm("exact.f32", np.float32, (rows, dim)) if self.quantized else None
+        self._ids = mm("ids.bin", f"S{id_width}", (rows,))
+        self._ids_sorted = mm("ids_sorted.bin", f"S{id_width}", (rows,))
+        self._id_order = mm("id_order.i64", np.int64, (rows,))
+        self._offsets = mm("offsets.u64", np.uint64, (rows + 1,))
+
+    @property
+    def quantized(self) -> bool:
+        return self.vector_dtype != "float32"
+
+    def find(self, doc_id: str) -> Optional[int]:
+        key = doc_id.encode("utf-8")
+        if len(key) > self.id_width:
+            return None
+        lo = int(np.searchsorted(self._ids_sorted, key, side="left"))
+        hi = int(np.searchsorted(self._ids_sorted, key, side="right"))
+        if lo == hi:
+            return None
+        # 同一個 id 刪除後又重新加入時會有多列: 取最新一筆還沒刪除的 (都刪除了就取最新一筆)
+        rows = np.asarray(self._id_order[lo:hi])
+        alive = rows[self.deleted[rows] == 0]
+        return int(alive.max() if len(alive) else rows.max())
+
+    def id_at(self, row: int) -> str:
+        return self._ids[row].decode("utf-8")
+
+    def text_and_extra(self, row: int) -> Tuple[str, Dict[str, Any]]:
+        start, end = int(self._offsets[row]), int(self._offsets[row + 1])
+        with self._lock:
+            if self._rows_file is None:
+                self._rows_file = open(os.path.join(self.path, "rows.jsonl"), "rb")
+            self._rows_file.seek(start)
+            record = json.loads(self._rows_file.read(end - start))
+        return record["text"], record["extra"]
+
+    def exact_rows(self, rows: np.ndarray) -> np.ndarray:
+        source = self.exact if self.quantized else self.codes
+        return np.asarray(source[rows], dtype=np.float32)
+
+    def flush(self):
+        """把原地 patch 過的欄位寫回磁碟"""
+        for name in _PATCHABLE:
+            getattr(self, name).flush()
+
+    def discard(self):
+        """重寫後的舊 segment (manifest 已不再列入) 刪除目錄"""
+        with self._lock:
+            if self._rows_file is not None:
+                self._rows_file.close()
+                self._rows_file = None
+        shutil.rmtree(self.path, ignore_errors=True)
+
+class SegmentManifest:
+    """
+    manifest.json: 記錄維度、向量格式、類型字典與 segment 列表
+    寫入時先寫暫存檔再 rename，避免寫到一半的 manifest
+    """
+    FILENAME = "manifest.json"
+
+    def __init__(self, dim: int, vector_dtype: str, type_vocab: List[str], segments: List[Dict[str, Any]],
+                 active_rows: int = 0, overlay: Optional[Dict[str, Dict[str, Any]]] = None,
+                 agent_vocab: Optional[List[str]] = None):
+        self.dim = dim
+        self.vector_dtype = vector_dtype
+        self.type_vocab = type_vocab
+        self.agent_vocab = agent_vocab or []
+        self.segments = segments
+        self.active_rows = active_rows
+        self.overlay = overlay or {}
+
+    @classmethod
+    def exists(cls, root: str) -> bool:
+        return os.path.exists(os.path.join(root, cls.FILENAME))
+
+    @classmethod
+    def read(cls, root: str) -> "SegmentManifest":
+        with open(os.path.join(root, cls.FILENAME), encoding="utf-8") as f:
+            data = json.load(f)
+        return cls(**data)
+
+    def write(self, root: str):
+        os.makedirs(root, exist_ok=True)
+        tmp = os.path.join(root, self.FILENAME + ".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.__dict__, f, ensure_ascii=False)
+        os.replace(tmp, os.path.join(root, self.FILENAME))
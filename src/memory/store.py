@@ -0,0 +1,217 @@
+import os
+import threading
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Protocol, Sequence, Tuple
+
+from langchain_core.documents import Document
+
+from src.config import config
+from src.memory.models import MemoryFilter
+from src.memory.chroma_client import get_chroma_client
+
+class MemoryStore(Protocol):
+    """
+    記憶流的向量儲存介面
+    GenerativeRetriever 只透過這幾個方法存取後端，打分數邏輯不需要知道背後是哪一種 DB
+
+    距離一律使用 cosine distance (0~2)，與 Chroma 的 "hnsw:space": "cosine" 相同
+    """
+
+    def add(
+        self,
+        ids: List[str],
+        texts: List[str],
+        embeddings: Sequence[Sequence[float]],
+        metadatas: List[Dict[str, Any]],
+    ) -> None:
+        """批次寫入記憶 (向量由呼叫端先算好)"""
+        ...
+
+    def knn(
+        self,
+        embedding: Sequence[float],
+        k: int,
+        memory_filter: Optional[MemoryFilter] = None,
+    ) -> List[Tuple[Document, float]]:
+        """回傳 (Document, distance)，過濾條件在搜尋前套用"""
+        ...
+
+    def patch_metadata(self, ids: List[str], columns: Dict[str, List[Any]]) -> None:
+        """以欄位為單位更新 metadata，只覆蓋指定的欄位，其他欄位保持不變"""
+        ...
+
+    def scan_by_time(
+        self,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None,
+        memory_filter: Optional[MemoryFilter] = None,
+    ) -> List[Document]:
+        """依 created_at 範圍 [start, end) 掃描記憶，結果依時間排序"""
+        ...
+
+    def scan_columns(
+        self,
+        memory_filter: Optional[MemoryFilter] = None,
+        fields: Sequence[str] = (),
+    ) -> Dict[str, List[Any]]:
+        """
+        只讀 metadata 欄位的掃描 (不載入內容): 回傳 {"id": [...], field: [...]}
+        fields 可用 created_at / last_accessed_at / importance / type / agent_id
+        """
+        ...
+
+    def fetch(self, ids: List[str]) -> Tuple[List[Document], List[List[float]]]:
+        """依 id 取回記憶與向量 (搬移到其他 store 時不需要重新 embedding)"""
+        ...
+
+    def delete(self, ids: List[str]) -> None:
+        ...
+
+    def count(self) -> int:
+        ...
+
+    def vacuum(self, max_deleted_ratio: float = 0.3) -> int:
+        """回收已刪除記錄佔用的空間，回傳回收的筆數 (刪除時就會回收的後端回傳 0)"""
+        ...
+
+    def flush(self) -> None:
+        """把尚未落地的寫入寫回儲存 (不需要的後端可以是 no-op)"""
+        ...
+
+def _with_time_range(memory_filter: Optional[MemoryFilter], start: Optional[datetime], end: Optional[datetime]) -> MemoryFilter:
+    """把時間範圍合併進既有的過濾條件 (取交集)"""
+    memory_filter = memory_filter or MemoryFilter()
+    update = {}
+    if start is not None and (memory_filter.created_after is None or start > memory_filter.created_after):
+        update["created_after"] = start
+    if end is not None and (memory_filter.created_before is None or end < memory_filter.created_before):
+        update["created_before"] = end
+    return memory_filter.model_copy(update=update)
+
+class ChromaMemoryStore:
+    """直接使用 chromadb collection 的 MemoryStore (不經過 langchain_chroma)"""
+
+    def __init__(self, collection_name: str, mode: Optional[str] = None):
+        self.client = get_chroma_client(mode)
+        # embedding_function=None: 向量一律由 retriever 算好再傳進來
+        self.collection = self.client.get_or_create_collection(
+            name=collection_name,
+            embedding_function=None,
+            metadata={"hnsw:space": "cosine"} # 使用餘弦相似度
+        )
+
+    def add(self, ids, texts, embeddings, metadatas) -> None:
+        self.collection.add(
+            ids=list(ids),
+            documents=list(texts),
+            embeddings=[list(map(float, e)) for e in embeddings],
+            metadatas=list(metadatas)
+        )
+
+    def knn(self, embedding, k, memory_filter=None) -> List[Tuple[Document, float]]:
+        where = memory_filter.to_chroma_where() if memory_filter else None
+        result = self.collection.query(
+            query_embeddings=[list(map(float, embedding))],
+            n_results=k,
+            where=where,
+            include=["documents", "metadatas", "distances"]
+        )
+        if not result["ids"] or not result["ids"][0]:
+            return []
+        return [
+            (Document(page_content=text, metadata=meta or {}), dist)
+            for text, meta, dist in zip(result["documents"][0], result["metadatas"][0], result["distances"][0])
+        ]
+
+    def patch_metadata(self, ids, columns) -> None:
+        # Chroma 的 update 會合併 metadata，不需要先 get 整份再寫回
+        metadatas = [
+            {field: values[i] for field, values in columns.items()}
+            for i in range(len(ids))
+        ]
+        self.collection.update(ids=list(ids), metadatas=metadatas)
+
+    def scan_by_time(self, start=None, end=None, memory_filter=None) -> List[Document]:
+        where = _with_time_range(memory_filter, start, end).to_chroma_where()
+        result = self.collection.get(where=where, include=["documents", "metadatas"])
+        docs = [
+            Document(page_content=text, metadata=meta or {})
+            for text, meta in zip(result["documents"], result["metadatas"])
+        ]
+        docs.sort(key=lambda d: d.metadata.get("created_at", 0.0))
+        return docs
+
+    def scan_columns(self, memory_filter=None, fields=()) -> Dict[str, List[Any]]:
+        where = memory_filter.to_chroma_where() if memory_filter else None
+        result = self.collection.get(where=where, include=["metadatas"])
+        metas = [meta or {} for meta in result["metadatas"]]
+        columns = {"id": list(result["ids"])}
+        for f in fields:
+            if f == "last_accessed_at":
+                columns[f] = [m.get(f, m.get("created_at", 0.0)) for m in metas]
+            else:
+                columns[f] = [m.get(f) for m in metas]
+        return columns
+
+    def fetch(self, ids) -> Tuple[List[Document], List[List[float]]]:
+        if not ids:
+            return [], []
+        result = self.collection.get(ids=list(ids), include=["documents", "metadatas", "embeddings"])
+        docs = [
+            Document(page_content=text, metadata=meta or {})
+            for text, meta in zip(result["documents"], result["metadatas"])
+        ]
+        return docs, [list(map(float, e)) for e in result["embeddings"]]
+
+    def delete(self, ids) -> None:
+        if ids:
+            self.collection.delete(ids=list(ids))
+
+    def count(self) -> int:
+        return self.collection.count()
+
+    def vacuum(self, max_deleted_ratio: float = 0.3) -> int:
+        # Chroma 刪除時就會移除記錄
+        return 0
+
+    def flush(self) -> None:
+        # Chroma 每次寫入都已經落地
+        pass
+
+def get_memory_store(collection_name: str, kind: Optional[str] = None, mode: Optional[str] = None) -> MemoryStore:
+    """
+    依照設定建立記憶儲存後端
+    - chroma: ChromaMemoryStore (mode 為 embedded / http / memory)
+    - numpy: NumpyMemoryStore (純 NumPy，不需要 server)
+    """
+    kind = kind or config.MEMORY_STORE
+    if kind == "chroma":
+        return ChromaMemoryStore(collection_name, mode=mode)
+    if kind == "numpy":
+        # 延遲 import，只用 Chroma 時不需要載入
+        from src.memory.numpy_store import NumpyMemoryStore
+        persist_dir = os.path.join(config.NUMPY_STORE_DIR, collection_name) if mode != "memory" else None
+        return NumpyMemoryStore(
+            persist_dir=persist_dir,
+            vector_dtype=config.NUMPY_VECTOR_DTYPE,
+            rescore_factor=config.NUMPY_RESCORE_FACTOR,
+            segment_rows=config.NUMPY_SEGMENT_ROWS,
+            seal_interval=config.NUMPY_SEAL_INTERVAL
+        )
+    raise ValueError(f"Unknown memory store: {kind}")
+
+
+# 共用 store: 同一個 process 中所有 agent 拿到同一個實例 (一份 index / 一組 memmap)
+_shared_stores: Dict[Tuple[str, str, Optional[str]], MemoryStore] = {}
+_shared_lock = threading.Lock()
+
+def get_shared_memory_store(collection_name: str, kind: Optional[str] = None, mode: Optional[str] = None) -> MemoryStore:
+    """
+    取得多個 agent 共用的記憶儲存 (以 metadata 的 agent_id 分區)
+    檢索時透過 MemoryFilter(agent_ids=...) 只看自己的分區
+    """
+    key = (collection_name, kind or config.MEMORY_STORE, mode)
+    with _shared_lock:
+        if key not in _shared_stores:
+            _shared_stores[key] = get_memory_store(collection_name, kind=kind, mode=mode)
+        return _shared_stores[key]
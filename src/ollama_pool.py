@@ -0,0 +1,73 @@
+import asyncio
+import hashlib
+import threading
+import weakref
+from typing import Dict, Optional, Tuple
+
+import httpx
+import ollama
+
+from src.config import config
+
+# ==========================================
+# 整個 process 共用的 Ollama client
+# ==========================================
+# 同一個 (host, 金鑰) 只建立一個 client，所有 LLM wrapper 共用同一個 httpx 連線池:
+# - keep-alive 連線重複使用，不必每次呼叫都重新做 TLS handshake
+# - 每個 host 的連線數有上限 (OLLAMA_MAX_CONNECTIONS)
+# - OLLAMA_HTTP2=1 且有安裝 h2 時使用 HTTP/2 (多個請求共用一條連線)
+_sync_clients: Dict[Tuple[str, str], ollama.Client] = {}
+# httpx.AsyncClient 綁定 event loop，每個 loop 各一組
+_async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[Tuple[str, str], ollama.AsyncClient]]" = \
+    weakref.WeakKeyDictionary()
+_lock = threading.Lock()
+
+def _key(host: str, api_key: Optional[str]) -> Tuple[str, str]:
+    # 金鑰只以 hash 當作 key，不留在 registry 中
+    digest = hashlib.sha256(api_key.encode("utf-8")).hexdigest() if api_key else ""
+    return host.rstrip("/"), digest
+
+def _client_kwargs(api_key: Optional[str]) -> dict:
+    kwargs = {
+        "headers": {"Authorization": f"Bearer {api_key}"} if api_key else {},
+        "timeout": config.OLLAMA_TIMEOUT,
+        "limits": httpx.Limits(
+            max_connections=config.OLLAMA_MAX_CONNECTIONS,
+            max_keepalive_connections=config.OLLAMA_MAX_CONNECTIONS,
+            keepalive_expiry=config.OLLAMA_KEEPALIVE_EXPIRY,
+        ),
+    }
+    if config.OLLAMA_HTTP2:
+        try:
+            import h2 # noqa: F401 (httpx 的 HTTP/2 需要 h2 套件)
+            kwargs["http2"] = True
+        except ImportError:
+            print("   ⚠️ OLLAMA_HTTP2=1 but 'h2' is not installed, falling back to HTTP/1.1 keep-alive.")
+    return kwargs
+
+def get_ollama_client(host: str, api_key: Optional[str] = None) -> ollama.Client:
+    """取得 (host, api_key) 共用的同步 client"""
+    key = _key(host, api_key)
+    with _lock:
+        client = _sync_clients.get(key)
+        if client is None:
+            client = _sync_clients[key] = ollama.Client(host=host, **_client_kwargs(api_key))
+        return client
+
+def get_async_ollama_client(host: str, api_key: Optional[str] = None) -> ollama.AsyncClient:
+    """取得 (host, api_key) 在目前 event loop 上共用的 async client"""
+    loop = asyncio.get_running_loop()
+    key = _key(host, api_key)
+    with _lock:
+        clients = _async_clients.setdefault(loop, {})
+        client = clients.get(key)
+        if client is None:
+            client = clients[key] = ollama.AsyncClient(host=host, **_client_kwargs(api_key))
+        return client
+
+def close_ollama_clients():
+    """關閉同步 client 的連線池 (async client 隨 event loop 一起回收)"""
+    with _lock:
+        for client in _sync_clients.values():
+            client._client.close()
+        _sync_clients.clear()
@@ -0,0 +1,280 @@
+import asyncio
+import contextvars
+import functools
+import inspect
+import itertools
+import json
+import os
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Dict, List, Optional
+
+from src.config import config
+
+# ==========================================
+# Tick tracing
+# ==========================================
+# span 以 contextvar 記錄父子關係: asyncio task 建立時會複製 context，
+# 所以 LangGraph 的 node、gather 出去的工作、RoutedLLM 的後端 task 都會接在呼叫者的 span 底下
+# TRACE_ENABLED=0 時 span() 直接回傳共用的空物件，traced 函式只多一次判斷
+# TRACE_* 設定在第一次使用時才讀取 (import 本模組不會載入 config)
+
+class _Span:
+    __slots__ = ("id", "parent", "root", "name", "cat", "agent", "start", "end", "task", "args")
+
+    def __init__(self, name: str, cat: str, parent: Optional["_Span"], args: Dict[str, Any]):
+        self.id = next(_ids)
+        self.parent = parent.id if parent else None
+        self.root = parent.root if parent else self.id
+        self.name = name
+        self.cat = cat
+        self.agent = args.pop("agent", None) or (parent.agent if parent else "")
+        self.start = time.perf_counter()
+        self.end: Optional[float] = None
+        self.task = _task_label()
+        self.args = args
+
+    @property
+    def duration_ms(self) -> float:
+        return ((self.end or time.perf_counter()) - self.start) * 1000
+
+_ids = itertools.count(1)
+_current_span: contextvars.ContextVar[Optional[_Span]] = contextvars.ContextVar("trace_span", default=None)
+
+def _task_label() -> str:
+    """同一個 asyncio task 內的 span 一定是巢狀的，所以 trace 中以 task 當作 thread"""
+    try:
+        task = asyncio.current_task()
+    except RuntimeError:
+        task = None
+    if task is None:
+        return threading.current_thread().name
+    return task.get_name()
+
+class _Tracer:
+    """保存結束的 span (最多 max_spans 個)，每個 tick (根 span) 結束時彙整一份 breakdown"""
+
+    def __init__(self, max_spans: int, max_ticks: int = 200):
+        self._lock = threading.Lock()
+        self.spans: deque = deque(maxlen=max_spans)
+        self.ticks: deque = deque(maxlen=max_ticks)
+        self._open_roots: Dict[int, List[_Span]] = {}
+
+    def start(self, span: _Span):
+        if span.parent is None:
+            with self._lock:
+                self._open_roots[span.id] = []
+
+    def finish(self, span: _Span):
+        with self._lock:
+            self.spans.append(span)
+            members = self._open_roots.get(span.root)
+            if members is None:
+                return # 根 span 已經結束 (例如被取消的 hedge 請求比 tick 晚結束)
+            members.append(span)
+            if span.parent is None:
+                del self._open_roots[span.id]
+                if span.cat == "tick":
+                    self.ticks.append(_breakdown(span, members))
+
+    def clear(self):
+        with self._lock:
+            self.spans.clear()
+            self.ticks.clear()
+            self._open_roots.clear()
+
+_tracer: Optional[_Tracer] = None
+_tracer_lock = threading.Lock()
+_enabled: Optional[bool] = None
+
+def _get_tracer() -> _Tracer:
+    global _tracer
+    if _tracer is None:
+        with _tracer_lock:
+            if _tracer is None:
+                _tracer = _Tracer(config.TRACE_MAX_SPANS)
+    return _tracer
+
+def enable_tracing(enabled: bool = True):
+    global _enabled
+    _enabled = enabled
+
+def tracing_enabled() -> bool:
+    global _enabled
+    if _enabled is None:
+        _enabled = config.TRACE_ENABLED
+    return _enabled
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **args):
+        pass
+
+_NOOP = _NoopSpan()
+
+class _ActiveSpan:
+    __slots__ = ("_name", "_cat", "_args", "_span", "_token")
+
+    def __init__(self, name: str, cat: str, args: Dict[str, Any]):
+        self._name, self._cat, self._args = name, cat, args
+
+    def __enter__(self):
+        self._span = _Span(self._name, self._cat, _current_span.get(), self._args)
+        _get_tracer().start(self._span)
+        self._token = _current_span.set(self._span)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._span.end = time.perf_counter()
+        if exc_type is not None:
+            self._span.args["error"] = exc_type.__name__
+        _current_span.reset(self._token)
+        _get_tracer().finish(self._span)
+        return False
+
+    def set(self, **args):
+        """在 span 上補充屬性 (例如結果筆數)"""
+        self._span.args.update(args)
+
+def span(name: str, cat: str = "", **args):
+    """
+    with span("store.knn", cat="memory", k=100): ...
+    沒有父 span 的 span 是根；cat="tick" 的根 span 結束時會產生一份 tick breakdown
+    """
+    if not tracing_enabled():
+        return _NOOP
+    return _ActiveSpan(name, cat, args)
+
+def traced(name: Optional[str] = None, cat: str = ""):
+    """把整個函式 (同步或 async) 包成一個 span"""
+    def decorate(fn: Callable):
+        label = name or fn.__qualname__
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                if not tracing_enabled():
+                    return await fn(*args, **kwargs)
+                with _ActiveSpan(label, cat, {}):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not tracing_enabled():
+                return fn(*args, **kwargs)
+            with _ActiveSpan(label, cat, {}):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def record_span(name: str, cat: str, started: float, **args):
+    """補記一個已經結束的 span (started 為 time.perf_counter())，用在不方便包 with 的地方，例如串流 generator"""
+    if not tracing_enabled():
+        return
+    s = _Span(name, cat, _current_span.get(), args)
+    s.start = started
+    s.end = time.perf_counter()
+    _get_tracer().finish(s)
+
+# ==========================================
+# Tick breakdown
+# ==========================================
+def _breakdown(tick: _Span, members: List[_Span]) -> Dict[str, Any]:
+    """依 span 名稱彙整: 次數 / 總時間 / self 時間 (扣掉直接子 span，併發時可能重疊，最小為 0)"""
+    child_ms: Dict[int, float] = {}
+    for s in members:
+        if s.parent is not None:
+            child_ms[s.parent] = child_ms.get(s.parent, 0.0) + s.duration_ms
+    rows: Dict[str, Dict[str, Any]] = {}
+    for s in members:
+        if s is tick:
+            continue
+        row = rows.setdefault(s.name, {"cat": s.cat, "count": 0, "total_ms": 0.0, "self_ms": 0.0})
+        row["count"] += 1
+        row["total_ms"] += s.duration_ms
+        row["self_ms"] += max(0.0, s.duration_ms - child_ms.get(s.id, 0.0))
+    total = tick.duration_ms
+    for row in rows.values():
+        row["total_ms"] = round(row["total_ms"], 1)
+        row["self_ms"] = round(row["self_ms"], 1)
+        row["share"] = round(row["total_ms"] / total, 3) if total else 0.0
+    return {
+        "agent": tick.agent,
+        "args": dict(tick.args),
+        "total_ms": round(total, 1),
+        "untracked_ms": round(max(0.0, total - child_ms.get(tick.id, 0.0)), 1),
+        "spans": dict(sorted(rows.items(), key=lambda kv: -kv[1]["total_ms"])),
+    }
+
+def tick_breakdowns(last: int = 20) -> List[Dict[str, Any]]:
+    """最近 last 個 tick 的時間分佈"""
+    tracer = _get_tracer()
+    with tracer._lock:
+        return list(tracer.ticks)[-last:]
+
+def format_breakdown(breakdown: Dict[str, Any]) -> str:
+    header = ["span", "count", "total ms", "self ms", "share"]
+    rows = [header] + [
+        [name, str(r["count"]), f"{r['total_ms']:.1f}", f"{r['self_ms']:.1f}", f"{r['share'] * 100:.0f}%"]
+        for name, r in breakdown["spans"].items()
+    ]
+    widths = [max(len(row[i]) for row in rows) for i in range(len(header))]
+    lines = [f"🧭 [{breakdown['agent']}] tick {breakdown['total_ms']:.0f}ms "
+             f"(未追蹤 {breakdown['untracked_ms']:.0f}ms)"]
+    for row in rows:
+        lines.append("   " + "  ".join(v.ljust(w) if i == 0 else v.rjust(w) for i, (v, w) in enumerate(zip(row, widths))))
+    return "\n".join(lines)
+
+# ==========================================
+# Chrome trace 匯出 (chrome://tracing / ui.perfetto.dev)
+# ==========================================
+def export_chrome_trace(path: Optional[str] = None) -> int:
+    """
+    寫出 Chrome trace event 格式 (complete events, ph="X")，回傳 span 數
+    pid = agent，tid = asyncio task，父子關係放在 args 的 span_id / parent_id
+    """
+    path = path or config.TRACE_PATH
+    tracer = _get_tracer()
+    with tracer._lock:
+        spans = list(tracer.spans)
+    if not spans:
+        return 0
+    origin = min(s.start for s in spans)
+    pids: Dict[str, int] = {}
+    tids: Dict[str, int] = {}
+    threads = set()
+    events = []
+    for s in spans:
+        pid = pids.setdefault(s.agent or "(background)", len(pids) + 1)
+        tid = tids.setdefault(s.task, len(tids) + 1)
+        threads.add((pid, tid, s.task))
+        events.append({
+            "name": s.name,
+            "cat": s.cat or "default",
+            "ph": "X",
+            "ts": round((s.start - origin) * 1e6, 1),
+            "dur": round((s.end - s.start) * 1e6, 1),
+            "pid": pid,
+            "tid": tid,
+            "args": {"span_id": s.id, "parent_id": s.parent, **{k: str(v) for k, v in s.args.items()}},
+        })
+    for agent, pid in pids.items():
+        events.append({"name": "process_name", "ph": "M", "pid": pid, "args": {"name": agent}})
+    for pid, tid, task in sorted(threads):
+        events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": task}})
+
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f, ensure_ascii=False)
+    print(f"🧭 [Trace] 已匯出 {len(spans)} 個 span 到 {path}")
+    return len(spans)
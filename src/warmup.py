@@ -0,0 +1,72 @@
+import asyncio
+import time
+from typing import Any, Dict, List, Optional, Sequence
+
+from src.config import config
+
+async def _timed(name: str, coro) -> float:
+    start = time.perf_counter()
+    await coro
+    elapsed = time.perf_counter() - start
+    print(f"   🔥 [Warmup] {name} ready in {elapsed:.2f}s")
+    return elapsed
+
+def _fixed_queries(agent_names: Sequence[str]) -> List[str]:
+    """計畫 / 反思流程中只依 agent 名稱變化的檢索句"""
+    from src.agent.planning import PLANNER_QUERY_TEMPLATES
+    from src.agent.reflection import REFLECTION_QUERY
+    templates = PLANNER_QUERY_TEMPLATES + [REFLECTION_QUERY]
+    return [t.format(agent_name=name) for name in agent_names for t in templates]
+
+def _load_embeddings(queries: List[str]):
+    """載入 embedding 模型，並把固定的檢索句先算好放進快取"""
+    from src.llm_factory import get_embeddings, get_similarity_embeddings
+    from src.memory.retriever import cache_query_embeddings
+    embeddings = get_embeddings()
+    if queries:
+        cache_query_embeddings(queries, embeddings.embed_documents(queries))
+    else:
+        embeddings.embed_query("warmup")
+    # 計畫比對用的多語言模型
+    get_similarity_embeddings().embed_query("warmup")
+
+async def _warm_embeddings(agent_names: Sequence[str]):
+    from src.executors import get_executor
+    await get_executor("embed").run(_load_embeddings, _fixed_queries(agent_names))
+
+async def _ping_ollama(host: str, model: str, api_key: Optional[str] = None):
+    """
+    送出空的 generate 請求: Ollama 會把模型載入記憶體，並依 keep_alive 保留
+    (之後第一個真正的請求就不需要等模型載入)
+    """
+    from src.ollama_pool import get_async_ollama_client
+    client = get_async_ollama_client(host, api_key)
+    await client.generate(model=model, prompt="", keep_alive=config.OLLAMA_KEEP_ALIVE)
+
+async def warmup(agent_names: Sequence[str] = (), timeout: float = 300.0) -> Dict[str, Any]:
+    """
+    [Async] 啟動後的預熱，三件事並行:
+    1. 載入 embedding 模型 (含計畫比對用的多語言模型) 並預先 embed 計畫流程的固定檢索句
+    2. ping 遠端 Ollama (決策用大模型)，讓模型常駐
+    3. ping 本地 Ollama (評分 / 哨兵用小模型)，讓模型常駐
+    任何一項失敗只會記錄下來，不影響其他項目；回傳 {步驟: 秒數 或 錯誤訊息}
+    """
+    print("🔥 [Warmup] Starting...")
+    steps = {
+        "embeddings": _warm_embeddings(agent_names),
+        "remote_llm": _ping_ollama(config.LLM_HOST, config.LLM_MODEL, config.LLM_API_KEY),
+        "local_llm": _ping_ollama(config.FAST_LLM_HOST, config.FAST_LLM_MODEL),
+    }
+    results = await asyncio.gather(
+        *(asyncio.wait_for(_timed(name, coro), timeout) for name, coro in steps.items()),
+        return_exceptions=True
+    )
+    report = {}
+    for name, result in zip(steps, results):
+        if isinstance(result, BaseException):
+            print(f"   ⚠️ [Warmup] {name} failed: {result!r}")
+            report[name] = repr(result)
+        else:
+            report[name] = round(result, 3)
+    print("✅ [Warmup] Done.")
+    return report
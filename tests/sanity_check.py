@@ -7,6 +7,7 @@ sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 from src.llm_factory import get_llm, get_embeddings
 from src.config import config
+from src.memory.chroma_client import get_chroma_client
 from langchain_chroma import Chroma
 from langchain_core.documents import Document
 from langchain_core.prompts import ChatPromptTemplate
@@ -41,9 +42,9 @@ def test_environment():
     try:
         # Client Setup
         db = Chroma(
+            client=get_chroma_client("http"), # 連到 docker-compose 的 Chroma server
             collection_name="sanity_check_collection",
             embedding_function=embeddings,
-            client_settings=None, # 使用預設 HTTP Client
             collection_metadata={"hnsw:space": "cosine"}
         )
         
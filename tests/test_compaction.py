@@ -0,0 +1,123 @@
+import sys
+import os
+from datetime import datetime, timedelta
+
+import numpy as np
+
+# 加入路徑
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src.memory.compaction import MemoryCompactor
+from src.memory.models import MemoryFilter
+from src.memory.numpy_store import NumpyMemoryStore
+
+def _add(store, doc_id, text, vector, created, importance=1, type="observation"):
+    store.add([doc_id], [text], [vector], [{
+        "id": doc_id, "type": type, "importance": importance,
+        "created_at": created.timestamp(), "last_accessed_at": created.timestamp()
+    }])
+
+def test_merge_and_archive():
+    print("========================================")
+    print("🗜️ TESTING MEMORY COMPACTION")
+    print("========================================")
+    now = datetime(2025, 6, 3, 8, 0)
+    hot, archive = NumpyMemoryStore(), NumpyMemoryStore()
+
+    # 同一句環境描述重複出現 5 次 (低重要性)
+    bed = [1.0, 0.0, 0.0, 0.0]
+    for i in range(5):
+        _add(hot, f"bed-{i}", "這裡有一個 [bed] 床，狀態是: 鋪好的。", bed, now - timedelta(hours=5 - i))
+    # 語意不同的觀察不應被合併
+    _add(hot, "desk", "這裡有一個 [desk] 書桌，狀態是: 雜亂。", [0.0, 1.0, 0.0, 0.0], now - timedelta(hours=1))
+    # 重要的記憶不合併
+    _add(hot, "fire", "宿舍發生火災！", [1.0, 0.01, 0.0, 0.0], now - timedelta(hours=2), importance=9)
+    # 很久以前的瑣事 -> 封存
+    _add(hot, "old", "Klaus 刷牙。", [0.0, 0.0, 1.0, 0.0], now - timedelta(days=10), importance=2)
+
+    report = MemoryCompactor(hot, archive).run(now)
+    print(f"   report: {report}")
+
+    assert report.merged_groups == 1 and report.merged_records == 5
+    assert report.archived == 1
+    assert hot.count() == 3 and archive.count() == 1
+
+    summary = hot.knn(bed, k=1, memory_filter=None)[0][0]
+    assert summary.metadata["merged_count"] == 5
+    assert "重複 5 次" in summary.page_content
+    assert summary.metadata["first_seen"] == (now - timedelta(hours=5)).timestamp()
+    assert archive.knn([0.0, 0.0, 1.0, 0.0], k=1)[0][0].metadata["id"] == "old"
+
+    # 再出現一次時，與既有摘要合併 (次數累加，內容不重複疊加)
+    _add(hot, "bed-5", "這裡有一個 [bed] 床，狀態是: 鋪好的。", bed, now)
+    MemoryCompactor(hot, archive).run(now)
+    summary = hot.knn(bed, k=1)[0][0]
+    assert summary.metadata["merged_count"] == 6
+    assert summary.page_content.count("重複") == 1
+    print("   ✅ passed")
+
+def test_hot_cap():
+    print("🧪 hot-set cap")
+    now = datetime(2025, 6, 3, 8, 0)
+    hot, archive = NumpyMemoryStore(), NumpyMemoryStore()
+    rng = np.random.default_rng(0)
+    for i in range(10):
+        _add(hot, f"m{i}", f"記憶 {i}", rng.standard_normal(8), now - timedelta(minutes=10 - i), importance=6)
+    _add(hot, "ref", "Klaus 很在意論文進度。", rng.standard_normal(8), now - timedelta(hours=1), type="reflection")
+
+    report = MemoryCompactor(hot, archive, hot_cap=5).run(now)
+    assert hot.count() == 5 and report.archived == 6
+    # 先搬 observation，而且是最久沒被存取的
+    kept = {d.metadata["id"] for d in hot.scan_by_time()}
+    assert kept == {"ref", "m6", "m7", "m8", "m9"}
+    print("   ✅ passed")
+
+def test_archive_uses_last_access():
+    print("🧪 archive by last access (column scan)")
+    now = datetime(2025, 6, 3, 8, 0)
+    hot, archive = NumpyMemoryStore(), NumpyMemoryStore()
+    _add(hot, "old", "Klaus 刷牙。", [0.0, 0.0, 1.0, 0.0], now - timedelta(days=10), importance=2)
+    _add(hot, "recalled", "Klaus 吃早餐。", [0.0, 1.0, 0.0, 0.0], now - timedelta(days=10), importance=2)
+    # 最近才被檢索過的舊記憶留在熱資料層
+    hot.patch_metadata(["recalled"], {"last_accessed_at": [(now - timedelta(hours=1)).timestamp()]})
+
+    columns = hot.scan_columns(MemoryFilter(accessed_before=now - timedelta(days=3)), ["last_accessed_at"])
+    assert columns["id"] == ["old"]
+
+    report = MemoryCompactor(hot, archive).run(now)
+    assert report.archived == 1
+    assert {d.metadata["id"] for d in hot.scan_by_time()} == {"recalled"}
+    print("   ✅ passed")
+
+def test_vacuum_rewrites_segments(tmp_path="./memory_data/test_compaction_vacuum"):
+    print("🧪 vacuum after archiving")
+    import shutil
+    now = datetime(2025, 6, 3, 8, 0)
+    for vector_dtype in ("float32", "int8"):
+        path = os.path.join(str(tmp_path), vector_dtype)
+        shutil.rmtree(path, ignore_errors=True)
+        hot = NumpyMemoryStore(persist_dir=path, vector_dtype=vector_dtype, segment_rows=4)
+        archive = NumpyMemoryStore()
+        rng = np.random.default_rng(0)
+        for i in range(8):
+            created = now - timedelta(days=10 if i % 4 else 0)
+            _add(hot, f"m{i}", f"記憶 {i}", rng.standard_normal(8), created, importance=6 if i % 4 else 9)
+        assert len(hot._sealed) == 2
+        old_dirs = {s.path for s in hot._sealed}
+
+        report = MemoryCompactor(hot, archive, max_archive_importance=6).run(now)
+        # 每個 segment 4 筆中封存了 3 筆 -> 重寫成只剩存活記錄的新 segment
+        assert report.archived == 6 and report.reclaimed == 6
+        assert [s.size for s in hot._sealed] == [1, 1]
+        assert not any(os.path.exists(d) for d in old_dirs)
+
+        reopened = NumpyMemoryStore(persist_dir=path, vector_dtype=vector_dtype, segment_rows=4)
+        assert sorted(d.metadata["id"] for d in reopened.scan_by_time()) == ["m0", "m4"]
+        assert reopened.fetch(["m4"])[0][0].page_content == "記憶 4"
+    print("   ✅ passed")
+
+if __name__ == "__main__":
+    test_merge_and_archive()
+    test_hot_cap()
+    test_archive_uses_last_access()
+    test_vacuum_rewrites_segments()
@@ -0,0 +1,100 @@
+import sys
+import os
+import threading
+import time
+
+import numpy as np
+
+# 加入路徑
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src.embedding_service import DynamicBatcher, EmbeddingService
+
+class FakeEmbeddings:
+    """不需要下載模型: 以文字長度產生固定的向量"""
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+    def embed_documents(self, texts):
+        return [[float(len(t)), float(i), 1.0] for i, t in enumerate(texts)]
+
+def load_fake(model_name):
+    return FakeEmbeddings()
+
+def test_batcher_coalesces_requests():
+    print("🧪 DynamicBatcher")
+    calls = []
+
+    def fn(items):
+        calls.append(len(items))
+        return np.array([[float(len(t))] for t in items], dtype=np.float32)
+
+    batcher = DynamicBatcher(fn, max_batch=64, max_wait_ms=50)
+    results = {}
+
+    def agent(i):
+        results[i] = batcher([f"x" * i, "y"])
+
+    threads = [threading.Thread(target=agent, args=(i,)) for i in range(1, 9)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    batcher.close()
+
+    # 8 個請求被合併成少數幾個 batch，且結果對應回各自的請求
+    assert sum(calls) == 16 and len(calls) < 8
+    for i in range(1, 9):
+        assert results[i][:, 0].tolist() == [float(i), 1.0]
+    print(f"   ✅ passed ({len(calls)} batch(es), mean size {batcher.mean_batch_size():.1f})")
+
+def test_service_round_trip():
+    print("🧪 EmbeddingService (2 worker processes)")
+    service = EmbeddingService("fake", workers=2, max_batch=4, max_wait_ms=1, loader=load_fake)
+    try:
+        assert service.dim == 3
+        vectors = service.embed(["a", "bb", "ccc", "dddd", "eeeee", "ffffff"]) # 大於 max_batch，分段處理
+        assert vectors.shape == (6, 3) and vectors.dtype == np.float32
+        assert vectors[:, 0].tolist() == [1.0, 2.0, 3.0, 4.0, 5.0, 6.0]
+    finally:
+        service.close()
+    print("   ✅ passed")
+
+def _leased(worker, expected, timeout=2.0):
+    """batch thread 結束後才會放掉最後一個參照，稍等一下"""
+    deadline = time.monotonic() + timeout
+    while worker.leased() != expected and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return worker.leased() == expected
+
+def test_output_leases_and_restart():
+    print("🧪 EmbeddingService output leases / worker restart")
+    service = EmbeddingService("fake", workers=1, max_batch=4, max_wait_ms=1, loader=load_fake)
+    try:
+        worker = service._workers[0]
+        held = service.embed(["a", "bb"])
+        # 結果是輸出區上的 view，持有期間不會被下一個 batch 覆寫
+        service.embed(["ccc"])
+        assert held[:, 0].tolist() == [1.0, 2.0] and _leased(worker, 1)
+        del held
+        assert _leased(worker, 0)
+
+        # worker process 意外結束: 這次失敗，之後由新的 worker 接手
+        worker.process.kill()
+        worker.process.join()
+        try:
+            service.embed(["a"])
+            raise AssertionError("should have failed")
+        except (EOFError, OSError, RuntimeError):
+            pass
+        assert service.embed(["dddd"])[0, 0] == 4.0
+        assert len(service._workers) == 1 and service._workers[0] is not worker
+    finally:
+        service.close()
+    print("   ✅ passed")
+
+if __name__ == "__main__":
+    test_batcher_coalesces_requests()
+    test_service_round_trip()
+    test_output_leases_and_restart()
@@ -0,0 +1,61 @@
+import sys
+import os
+
+# 加入路徑
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from typing import Optional
+from pydantic import BaseModel
+from langchain_core.exceptions import OutputParserException
+from src.json_repair import IncrementalJsonObject, RepairingJsonParser, repair_json
+
+class Decision(BaseModel):
+    action: str
+    target_object_id: Optional[str] = None
+    duration: int = 15
+    should_replan: bool = False
+
+def test_repair_json():
+    print("🧪 repair_json")
+    # Markdown 圍欄 + 前後說明文字
+    assert repair_json('好的：\n```json\n{"a": 1}\n```') == {"a": 1}
+    assert repair_json('結果是 {"a": [1, 2]} 以上') == {"a": [1, 2]}
+    # 結尾逗號、Python 常值 (字串內的 True 不能被換掉)
+    assert repair_json('{"a": True, "b": None, "c": "True",}') == {"a": True, "b": None, "c": "True"}
+    # 輸出被截斷
+    assert repair_json('{"a": {"b": [1, 2') == {"a": {"b": [1, 2]}}
+    assert repair_json('{"a": "看書') == {"a": "看書"}
+    print("   ✅ passed")
+
+def test_parser_validates_schema():
+    print("🧪 RepairingJsonParser")
+    parser = RepairingJsonParser(pydantic_object=Decision)
+    res = parser.parse('```json\n{"action": "看書", "target_object_id": null, "should_replan": False,}\n```')
+    assert res == Decision(action="看書")
+    for bad in ['{"duration": 30}', "沒有 JSON"]:
+        try:
+            parser.parse(bad)
+            raise AssertionError("should have failed")
+        except OutputParserException:
+            pass
+    print("   ✅ passed")
+
+def test_incremental_fields():
+    print("🧪 IncrementalJsonObject")
+    stream = ['```json\n{"act', 'ion": "走去, {廚房}", "target_', 'location_id": "kitchen",', ' "duration": 3', '0, "reason": "肚子', '餓了"}\n```']
+    parser = IncrementalJsonObject()
+    seen = []
+    for piece in stream:
+        seen.append(dict(parser.feed(piece)))
+    # 字串中的 , { } 不會被誤判為分隔符號
+    assert seen[1] == {"action": "走去, {廚房}"}
+    assert seen[2] == {"action": "走去, {廚房}", "target_location_id": "kitchen"}
+    # 數字要等到下一個分隔符號才算完成
+    assert "duration" not in seen[3] and seen[4]["duration"] == 30
+    assert parser.done and parser.fields["reason"] == "肚子餓了"
+    print("   ✅ passed")
+
+if __name__ == "__main__":
+    test_repair_json()
+    test_parser_validates_schema()
+    test_incremental_fields()
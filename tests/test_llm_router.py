@@ -0,0 +1,139 @@
+import sys
+import os
+import asyncio
+import time
+from typing import Optional
+
+# 加入路徑
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+# 不連線的假後端，設定只要通過驗證即可
+os.environ.setdefault("LLM_API_KEY", "test")
+os.environ.setdefault("LLM_HOST", "http://localhost:11434")
+
+from langchain_core.messages import AIMessage, AIMessageChunk, HumanMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from src.llm_factory import NCKUCustomLLM
+from src import llm_router
+from src.llm_router import RoutedLLM, router_stats
+
+# 被取消的請求 (記錄 reply)
+CANCELLED = []
+# 串流時後端收到的 run_manager
+STREAM_RUN_MANAGERS = []
+
+class FakeBackend(NCKUCustomLLM):
+    """不連線的後端: 等 delay 秒後回傳 reply (reply 為 None 時丟出錯誤)"""
+    delay: float = 0.0
+    reply: Optional[str] = ""
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        try:
+            await asyncio.sleep(self.delay)
+        except asyncio.CancelledError:
+            CANCELLED.append(self.reply)
+            raise
+        if self.reply is None:
+            raise ConnectionError("backend down")
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=self.reply))])
+
+    async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+        STREAM_RUN_MANAGERS.append(run_manager)
+        await asyncio.sleep(self.delay)
+        for ch in self.reply:
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=ch))
+            if run_manager:
+                await run_manager.on_llm_new_token(ch, chunk=chunk)
+            yield chunk
+            await asyncio.sleep(0.005)
+
+class TokenRecorder:
+    """只記錄 token 的 run manager (有些 LangChain 版本會把 run_manager 交給 _astream)"""
+    def __init__(self):
+        self.tokens = []
+
+    async def on_llm_new_token(self, token, **kwargs):
+        self.tokens.append(token)
+
+def _routed(role, *backends, budget=None, hedge=False):
+    names = [f"{role}-{i}" for i in range(len(backends))]
+    return RoutedLLM(role=role, backend_names=names, backends=list(backends), budget=budget, hedge=hedge)
+
+def _backend(**kwargs):
+    return FakeBackend(host="http://fake", api_key=None, model_name="fake", **kwargs)
+
+async def _ask(llm):
+    return (await llm.ainvoke([HumanMessage(content="hi")])).content
+
+def test_fallback_on_budget_and_error():
+    print("🧪 RoutedLLM fallback")
+    # 主要後端超過延遲預算 ---> 備援
+    slow = _routed("react", _backend(delay=1.0, reply="remote"), _backend(reply="local"), budget=0.05)
+    assert asyncio.run(_ask(slow)) == "local"
+    # 主要後端失敗 ---> 備援；之後在 cooldown 期間直接略過
+    down = _routed("plan", _backend(reply=None), _backend(reply="local"))
+    assert asyncio.run(_ask(down)) == "local"
+    assert asyncio.run(_ask(down)) == "local"
+    stats = router_stats()
+    assert stats["react-0"]["over_budget"] == 1 and stats["react-1"]["fallback_used"] == 1
+    assert stats["plan-0"]["failed"] == 1 and stats["plan-0"]["down"]
+    assert stats["plan-1"]["ok"] == 2
+    print("   ✅ passed")
+
+def test_last_backend_raises():
+    print("🧪 RoutedLLM last backend")
+    llm = _routed("score", _backend(reply=None))
+    try:
+        asyncio.run(_ask(llm))
+        raise AssertionError("should have failed")
+    except ConnectionError:
+        pass
+    print("   ✅ passed")
+
+def test_hedge_after_percentile():
+    print("🧪 RoutedLLM hedge")
+    # 主要後端平常 10ms 就回應 ---> P95 之後還沒回應就同時送給備援，先回來的勝出
+    for _ in range(50):
+        llm_router._latency.record("hedge", "hedge-0", 0.01)
+    llm = _routed("hedge", _backend(delay=1.0, reply="remote"), _backend(reply="local"), budget=5, hedge=True)
+    started = time.perf_counter()
+    assert asyncio.run(_ask(llm)) == "local"
+    # 不用等到 budget，落後的請求被取消
+    assert time.perf_counter() - started < 0.5
+    assert "remote" in CANCELLED
+    print("   ✅ passed")
+
+def test_hedge_stream_callbacks():
+    print("🧪 RoutedLLM hedge stream callbacks")
+    for _ in range(50):
+        llm_router._latency.record("hedge-stream", "hedge-stream-0", 0.01)
+    # 兩個後端同時在串流，callback 只收到勝出後端的 token
+    llm = _routed("hedge-stream", _backend(delay=0.03, reply="AAAA"), _backend(delay=0.02, reply="BBBB"), hedge=True)
+    recorder = TokenRecorder()
+
+    async def run():
+        return "".join([c.text async for c in llm._astream([HumanMessage(content="hi")], run_manager=recorder)])
+    text = asyncio.run(run())
+    assert text in ("AAAA", "BBBB")
+    assert "".join(recorder.tokens) == text
+    # 後端自己不送 callback (避免落後的後端 token 混進來)
+    assert len(STREAM_RUN_MANAGERS) == 2 and not any(STREAM_RUN_MANAGERS)
+    print("   ✅ passed")
+
+def test_censored_latency():
+    print("🧪 RoutedLLM censored latency")
+    tracker = llm_router._LatencyTracker()
+    # 一半的請求很快完成，另一半在 2 秒時被 hedge 取消 (實際延遲未知，只知道 > 2 秒)
+    for _ in range(10):
+        tracker.record("r", "b", 0.1)
+        tracker.record("r", "b", 2.0, censored=True)
+    # 只看完成的樣本會得到 0.1；加上 censored 樣本後 P95 至少是 2 秒
+    assert tracker.percentile("r", "b", 50, 1) == 0.1
+    assert tracker.percentile("r", "b", 95, 1) == 2.0
+    print("   ✅ passed")
+
+if __name__ == "__main__":
+    test_fallback_on_budget_and_error()
+    test_last_backend_raises()
+    test_hedge_after_percentile()
+    test_hedge_stream_callbacks()
+    test_censored_latency()
@@ -0,0 +1,63 @@
+import sys
+import os
+import asyncio
+
+# 加入路徑
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src.llm_scheduler import HostScheduler, LLMDeadlineExceeded
+
+async def _run_order():
+    """名額只有 1 個時，依優先權與 agent 輪流決定執行順序"""
+    scheduler = HostScheduler("http://test", max_concurrency=1)
+    order = []
+
+    async def request(name, priority, agent):
+        await scheduler.acquire(priority, agent, None)
+        order.append(name)
+        await asyncio.sleep(0)
+        scheduler.release()
+
+    await scheduler.acquire(0, "holder", None) # 先佔住名額，讓其他請求排隊
+    tasks = [
+        asyncio.create_task(request("reflect-klaus", 4, "Klaus")),
+        asyncio.create_task(request("plan-klaus-1", 2, "Klaus")),
+        asyncio.create_task(request("plan-klaus-2", 2, "Klaus")),
+        asyncio.create_task(request("plan-maria-1", 2, "Maria")),
+        asyncio.create_task(request("react-maria", 0, "Maria")),
+    ]
+    await asyncio.sleep(0)
+    scheduler.release()
+    await asyncio.gather(*tasks)
+    return order
+
+def test_priority_and_fairness():
+    print("🧪 HostScheduler priority / fairness")
+    order = asyncio.run(_run_order())
+    # react 先；同一優先權內 Klaus / Maria 輪流；反思最後
+    assert order == ["react-maria", "plan-klaus-1", "plan-maria-1", "plan-klaus-2", "reflect-klaus"]
+    print("   ✅ passed")
+
+async def _run_deadline():
+    scheduler = HostScheduler("http://test", max_concurrency=1)
+    await scheduler.acquire(0, "holder", None)
+    loop = asyncio.get_running_loop()
+    try:
+        await scheduler.acquire(3, "Klaus", loop.time() + 0.05)
+        raise AssertionError("should have expired")
+    except LLMDeadlineExceeded:
+        pass
+    # 逾時的請求不會留在佇列中，也不會佔用名額
+    assert scheduler.queued() == 0 and scheduler.expired == 1
+    scheduler.release()
+    await scheduler.acquire(3, "Klaus", loop.time() + 0.05)
+    scheduler.release()
+
+def test_deadline_expiry():
+    print("🧪 HostScheduler deadline")
+    asyncio.run(_run_deadline())
+    print("   ✅ passed")
+
+if __name__ == "__main__":
+    test_priority_and_fairness()
+    test_deadline_expiry()
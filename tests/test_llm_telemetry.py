@@ -0,0 +1,69 @@
+import sys
+import os
+import json
+import asyncio
+import tempfile
+
+# 加入路徑
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+# 不連線的假後端，設定只要通過驗證即可
+os.environ.setdefault("LLM_API_KEY", "test")
+os.environ.setdefault("LLM_HOST", "http://localhost:11434")
+
+from langchain_core.messages import HumanMessage
+from src import llm_factory
+from src.config import config
+from src.llm_factory import NCKUCustomLLM
+from src.llm_scheduler import llm_agent
+from src.llm_telemetry import format_summary, llm_node_attempt, load_records, summarize
+
+class FakeAsyncClient:
+    """回傳固定內容與 Ollama 統計的 client (時間單位: 奈秒)"""
+
+    async def chat(self, **kwargs):
+        await asyncio.sleep(0.01)
+        return {
+            "message": {"content": "{}"},
+            "prompt_eval_count": 400, "prompt_eval_duration": 200_000_000,
+            "eval_count": 50, "eval_duration": 1_000_000_000,
+        }
+
+def test_records_and_summary():
+    print("🧪 LLM telemetry")
+    original_client, original_path = llm_factory.get_async_ollama_client, config.LLM_TELEMETRY_PATH
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "llm.jsonl")
+        llm_factory.get_async_ollama_client = lambda host, api_key: FakeAsyncClient()
+        config.LLM_TELEMETRY_PATH = path
+        try:
+            async def run():
+                with llm_agent("Klaus"):
+                    for node_attempt, role in enumerate(("react", "react", "score")):
+                        llm = NCKUCustomLLM(host="http://fake-telemetry", api_key=None, model_name="m", role=role)
+                        # 第二次 react 是 node 層級的重試
+                        with llm_node_attempt(min(node_attempt, 1) if role == "react" else 0):
+                            await llm.ainvoke([HumanMessage(content="hi")])
+            asyncio.run(run())
+        finally:
+            llm_factory.get_async_ollama_client = original_client
+            config.LLM_TELEMETRY_PATH = original_path
+
+        records = load_records(path)
+        assert len(records) == 3
+        first = records[0]
+        assert first["role"] == "react" and first["agent"] == "Klaus" and first["status"] == "ok"
+        assert first["prompt_tokens"] == 400 and first["prefill_ms"] == 200.0 and first["queue_ms"] is not None
+        assert [r["node_attempt"] for r in records] == [0, 1, 0]
+        json.dumps(first) # 每一行都是純 JSON
+
+        summary = summarize(records)
+        assert summary["react"]["calls"] == 2 and summary["score"]["calls"] == 1
+        assert summary["react"]["prefill_tok_s"] == 2000.0 and summary["react"]["decode_tok_s"] == 50.0
+        assert summary["react"]["latency_ms"]["p50"] >= 10
+        assert summary["react"]["node_retries"] == 1 and summary["score"]["node_retries"] == 0
+        assert summary["react"]["avg_prefill_ms"] == 200.0 and summary["react"]["prefill_share"] == round(200 / 1200, 3)
+        assert "react" in format_summary(summary)
+    print("   ✅ passed")
+
+if __name__ == "__main__":
+    test_records_and_summary()
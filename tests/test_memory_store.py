@@ -0,0 +1,186 @@
+import sys
+import os
+from datetime import datetime, timedelta
+
+import numpy as np
+
+# 加入路徑
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src.memory.models import MemoryFilter
+from src.memory.numpy_store import NumpyMemoryStore
+from src.memory.store import ChromaMemoryStore
+
+def _seed(store, now):
+    """寫入 4 條記憶 (向量直接給定，不需要 embedding 模型)"""
+    rows = [
+        ("obs-1", "Klaus 在臥室睡覺。", [1.0, 0.0, 0.0], "observation", 2, now - timedelta(days=1)),
+        ("obs-2", "Klaus 在圖書館寫論文。", [0.9, 0.1, 0.0], "observation", 6, now - timedelta(hours=2)),
+        ("ref-1", "Klaus 最近壓力很大。", [0.8, 0.2, 0.0], "reflection", 8, now - timedelta(hours=1)),
+        ("plan-1", "08:00: 吃早餐 (地點: kitchen)", [0.0, 0.0, 1.0], "plan", 3, now),
+    ]
+    store.add(
+        [r[0] for r in rows],
+        [r[1] for r in rows],
+        [r[2] for r in rows],
+        [{"id": r[0], "type": r[3], "importance": r[4],
+          "created_at": r[5].timestamp(), "last_accessed_at": r[5].timestamp()} for r in rows]
+    )
+
+def _check_store(store, now):
+    _seed(store, now)
+    assert store.count() == 4
+
+    # 1. 無過濾: 最接近 [1,0,0] 的是 obs-1
+    top = store.knn([1.0, 0.0, 0.0], k=2)
+    assert [d.metadata["id"] for d, _ in top] == ["obs-1", "obs-2"]
+    assert 0.0 <= top[0][1] < top[1][1]
+
+    # 2. 類型過濾
+    top = store.knn([1.0, 0.0, 0.0], k=5, memory_filter=MemoryFilter(types=["reflection"]))
+    assert [d.metadata["id"] for d, _ in top] == ["ref-1"]
+
+    # 3. 時間範圍 + 重要性下限
+    f = MemoryFilter(created_after=now - timedelta(hours=3), min_importance=5)
+    top = store.knn([1.0, 0.0, 0.0], k=5, memory_filter=f)
+    assert sorted(d.metadata["id"] for d, _ in top) == ["obs-2", "ref-1"]
+
+    # 4. metadata patch 只更新指定欄位
+    store.patch_metadata(["obs-1"], {"last_accessed_at": [now.timestamp() + 60]})
+    doc = store.knn([1.0, 0.0, 0.0], k=1)[0][0]
+    assert doc.metadata["last_accessed_at"] == now.timestamp() + 60
+    assert doc.metadata["importance"] == 2 and doc.metadata["type"] == "observation"
+
+    # 5. 依時間掃描
+    docs = store.scan_by_time(start=now - timedelta(hours=3))
+    assert [d.metadata["id"] for d in docs] == ["obs-2", "ref-1", "plan-1"]
+
+    # 6. 共用 store 的 agent 分區 (沒有 agent_id 的舊記錄不屬於任何分區)
+    store.add(
+        ["klaus-1", "maria-1", "world-1"],
+        ["Klaus 在咖啡廳。", "Maria 在咖啡廳。", "咖啡廳早上八點開門。"],
+        [[1.0, 0.0, 0.0]] * 3,
+        [{"id": "klaus-1", "agent_id": "Klaus", "created_at": now.timestamp()},
+         {"id": "maria-1", "agent_id": "Maria", "created_at": now.timestamp()},
+         {"id": "world-1", "agent_id": "__world__", "created_at": now.timestamp()}]
+    )
+    top = store.knn([1.0, 0.0, 0.0], k=10, memory_filter=MemoryFilter(agent_ids=["Klaus", "__world__"]))
+    assert sorted(d.metadata["id"] for d, _ in top) == ["klaus-1", "world-1"]
+    assert {d.metadata["agent_id"] for d, _ in top} == {"Klaus", "__world__"}
+    docs = store.scan_by_time(memory_filter=MemoryFilter(agent_ids=["Maria"]))
+    assert [d.metadata["id"] for d in docs] == ["maria-1"]
+
+def test_numpy_store():
+    print("🧪 NumpyMemoryStore")
+    _check_store(NumpyMemoryStore(), datetime(2025, 6, 1, 8, 0))
+    print("   ✅ passed")
+
+def test_numpy_store_int8():
+    print("🧪 NumpyMemoryStore (int8)")
+    _check_store(NumpyMemoryStore(vector_dtype="int8"), datetime(2025, 6, 1, 8, 0))
+    print("   ✅ passed")
+
+def test_numpy_store_persistence(tmp_path="./memory_data/test_numpy_store"):
+    print("🧪 NumpyMemoryStore persistence (segments)")
+    import shutil
+    now = datetime(2025, 6, 1, 8, 0)
+
+    for vector_dtype in ("float32", "int8"):
+        path = os.path.join(str(tmp_path), vector_dtype)
+        shutil.rmtree(path, ignore_errors=True)
+
+        # segment_rows=3: 一次寫入 4 筆後 active segment 會被封存
+        store = NumpyMemoryStore(persist_dir=path, vector_dtype=vector_dtype, segment_rows=3)
+        _seed(store, now)
+        store.flush()
+        assert len(store._sealed) == 1 and store._active.size == 0
+
+        reopened = NumpyMemoryStore(persist_dir=path, vector_dtype=vector_dtype, segment_rows=3)
+        assert reopened.count() == 4
+        top = reopened.knn([0.0, 0.0, 1.0], k=1)
+        assert top[0][0].metadata["id"] == "plan-1"
+        assert top[0][0].page_content == "08:00: 吃早餐 (地點: kitchen)"
+
+        # sealed segment 上的 patch (欄位原地寫入 / 其他欄位寫在 overlay)
+        reopened.patch_metadata(["obs-1"], {"last_accessed_at": [now.timestamp() + 60], "summary_count": [3]})
+        reopened.flush()
+        again = NumpyMemoryStore(persist_dir=path, vector_dtype=vector_dtype, segment_rows=3)
+        doc = again.knn([1.0, 0.0, 0.0], k=1)[0][0]
+        assert doc.metadata["last_accessed_at"] == now.timestamp() + 60
+        assert doc.metadata["summary_count"] == 3
+
+        # 讀回後仍然可以繼續寫入
+        again.add(["obs-3"], ["新的觀察"], [[0.0, 1.0, 0.0]], [{"id": "obs-3", "created_at": now.timestamp()}])
+        assert again.knn([0.0, 1.0, 0.0], k=1)[0][0].metadata["id"] == "obs-3"
+        assert [d.metadata["id"] for d in again.scan_by_time(start=now - timedelta(hours=3))] == \
+            ["obs-2", "ref-1", "plan-1", "obs-3"]
+    print("   ✅ passed")
+
+def test_numpy_store_readded_id(tmp_path="./memory_data/test_numpy_store_readded"):
+    print("🧪 NumpyMemoryStore re-added id after sealing")
+    import shutil
+    now = datetime(2025, 6, 1, 8, 0)
+    shutil.rmtree(str(tmp_path), ignore_errors=True)
+    store = NumpyMemoryStore(persist_dir=str(tmp_path), segment_rows=3)
+    meta = {"id": "A", "created_at": now.timestamp()}
+    # 同一個 segment 中: 加入 -> 刪除 (例如移到封存層) -> 再加入 (例如被檢索後搬回)
+    store.add(["A"], ["舊的"], [[1.0, 0.0, 0.0]], [meta])
+    store.delete(["A"])
+    store.add(["A", "B"], ["新的", "其他"], [[1.0, 0.0, 0.0], [0.0, 1.0, 0.0]], [meta, {"id": "B", "created_at": now.timestamp()}])
+    assert len(store._sealed) == 1 and store.count() == 2
+
+    docs, _ = store.fetch(["A"])
+    assert [d.page_content for d in docs] == ["新的"]
+    store.patch_metadata(["A"], {"last_accessed_at": [now.timestamp() + 60]})
+    assert store.knn([1.0, 0.0, 0.0], k=1)[0][0].metadata["last_accessed_at"] == now.timestamp() + 60
+    store.delete(["A"])
+    assert store.count() == 1 and store.fetch(["A"]) == ([], [])
+    print("   ✅ passed")
+
+def test_numpy_store_seal_crash(tmp_path="./memory_data/test_numpy_store_seal_crash"):
+    print("🧪 NumpyMemoryStore interrupted seal")
+    import shutil
+    now = datetime(2025, 6, 1, 8, 0)
+    for vector_dtype in ("float32", "int8"):
+        path = os.path.join(str(tmp_path), vector_dtype)
+        shutil.rmtree(path, ignore_errors=True)
+        store = NumpyMemoryStore(persist_dir=path, vector_dtype=vector_dtype, segment_rows=3)
+        store.add(["a", "b"], ["一", "二"], [[1.0, 0.0, 0.0], [0.0, 1.0, 0.0]],
+                  [{"id": i, "created_at": now.timestamp()} for i in ("a", "b")])
+        store.flush()
+
+        # 封存途中 (seg 目錄已寫出、manifest 還沒更新) 中斷
+        def crash():
+            raise OSError("disk full")
+        store._write_manifest = crash
+        try:
+            store.add(["c"], ["三"], [[0.0, 0.0, 1.0]], [{"id": "c", "created_at": now.timestamp()}])
+            raise AssertionError("should have failed")
+        except OSError:
+            pass
+
+        # 已經落地的記憶仍然在 (manifest 指向完整的 active 目錄)
+        reopened = NumpyMemoryStore(persist_dir=path, vector_dtype=vector_dtype, segment_rows=3)
+        assert reopened.count() == 2 and not reopened._sealed
+        assert reopened.knn([0.0, 1.0, 0.0], k=1)[0][0].metadata["id"] == "b"
+        # 之後的封存會覆寫上次留下的 seg 目錄
+        reopened.add(["c"], ["三"], [[0.0, 0.0, 1.0]], [{"id": "c", "created_at": now.timestamp()}])
+        reopened.flush()
+        again = NumpyMemoryStore(persist_dir=path, vector_dtype=vector_dtype, segment_rows=3)
+        assert again.count() == 3 and len(again._sealed) == 1
+        assert again.knn([0.0, 0.0, 1.0], k=1)[0][0].page_content == "三"
+    print("   ✅ passed")
+
+def test_chroma_store():
+    print("🧪 ChromaMemoryStore (memory mode)")
+    name = f"test_store_{np.random.randint(1_000_000)}"
+    _check_store(ChromaMemoryStore(name, mode="memory"), datetime(2025, 6, 1, 8, 0))
+    print("   ✅ passed")
+
+if __name__ == "__main__":
+    test_numpy_store()
+    test_numpy_store_int8()
+    test_numpy_store_persistence()
+    test_numpy_store_readded_id()
+    test_numpy_store_seal_crash()
+    test_chroma_store()
@@ -0,0 +1,54 @@
+import sys
+import os
+from datetime import datetime, timedelta
+
+# 加入路徑
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src.agent.plan_cache import PlanCache, window_minutes
+
+SLEEP = [
+    {"start_time": "22:00", "end_time": "22:30", "description": "刷牙洗臉", "location": "bathroom"},
+    {"start_time": "22:30", "end_time": "06:00", "description": "睡覺", "location": "bedroom"},
+]
+NOW = datetime(2025, 6, 1, 21, 0)
+
+def test_rescale_across_midnight():
+    print("🧪 PlanCache rescale")
+    assert window_minutes("22:00", "06:00") == 480
+    cache = PlanCache(threshold=0.9, max_age_hours=0, max_reuse=0)
+    cache.store("Klaus", "睡覺", [1.0, 0.0], "22:00", "06:00", SLEEP, NOW)
+    # 同一個時長區間、時段往後移 1 小時 (23:00 - 06:30 = 450 分鐘)
+    reused = cache.lookup("Klaus", [0.99, 0.05], "23:00", "06:30", NOW)
+    assert [t["start_time"] for t in reused] == ["23:00", "23:30"]
+    assert reused[-1]["end_time"] == "06:30" and reused[-1]["location"] == "bedroom"
+    print("   ✅ passed")
+
+def test_key_and_staleness():
+    print("🧪 PlanCache key / staleness")
+    cache = PlanCache(threshold=0.9, max_age_hours=0, max_reuse=2)
+    cache.store("Klaus", "睡覺", [1.0, 0.0], "22:00", "06:00", SLEEP, NOW)
+    assert cache.lookup("Maria", [1.0, 0.0], "22:00", "06:00", NOW) is None  # 不同 agent
+    assert cache.lookup("Klaus", [0.0, 1.0], "22:00", "06:00", NOW) is None  # 語意不相近
+    assert cache.lookup("Klaus", [1.0, 0.0], "08:00", "08:30", NOW) is None  # 時長區間不同
+    assert cache.lookup("Klaus", [1.0, 0.0], "22:00", "06:00", NOW) is not None
+    assert cache.lookup("Klaus", [1.0, 0.0], "22:00", "06:00", NOW) is not None
+    # 已重用 max_reuse 次: 淘汰，下次重新生成
+    assert cache.lookup("Klaus", [1.0, 0.0], "22:00", "06:00", NOW) is None
+    assert cache.stats()["entries"] == 0 and cache.stats()["hits"] == 2
+    print("   ✅ passed")
+
+def test_max_age_uses_sim_time():
+    print("🧪 PlanCache max_age (模擬時間)")
+    cache = PlanCache(threshold=0.9, max_age_hours=24, max_reuse=0)
+    cache.store("Klaus", "睡覺", [1.0, 0.0], "22:00", "06:00", SLEEP, NOW)
+    assert cache.lookup("Klaus", [1.0, 0.0], "22:00", "06:00", NOW + timedelta(hours=23)) is not None
+    # 牆鐘時間只過了一瞬間，但模擬時間已經過了兩天
+    assert cache.lookup("Klaus", [1.0, 0.0], "22:00", "06:00", NOW + timedelta(days=2)) is None
+    assert cache.stats()["entries"] == 0
+    print("   ✅ passed")
+
+if __name__ == "__main__":
+    test_rescale_across_midnight()
+    test_key_and_staleness()
+    test_max_age_uses_sim_time()
@@ -0,0 +1,69 @@
+import sys
+import os
+import asyncio
+from datetime import datetime, timedelta
+
+# 加入路徑
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src.agent.plan_repair import PlanRepairer, reflow, ESCALATE, REPAIRED, DEBOUNCED
+
+PLAN = [
+    {"start_time": "08:00", "activity": "吃早餐", "location": "kitchen"},
+    {"start_time": "09:00", "activity": "寫論文", "location": "library"},
+    {"start_time": "12:00", "activity": "吃午餐", "location": "kitchen"},
+    {"start_time": "13:00", "activity": "上課", "location": "lecture_hall"},
+    {"start_time": "22:00", "activity": "睡覺", "location": "bedroom", "calculated_end_time": "00:00"},
+]
+
+# 以關鍵字代替 embedding: 同一組的文字相似度為 1，其餘為 0
+_TOPICS = ["早餐", "論文", "午餐", "上課", "睡", "火災"]
+
+async def fake_embed(text):
+    return [1.0 if topic in text else 0.0 for topic in _TOPICS]
+
+def _times(plan):
+    return [b["start_time"] for b in plan]
+
+def test_reflow():
+    print("🧪 reflow")
+    # 壓縮中間的時段，最後一個時段 (睡覺) 不動
+    assert _times(reflow(PLAN[1:], 9 * 60 + 30, 15)) == ["09:30", "12:23", "13:21", "22:00"]
+    # 空間不夠: 捨棄錨點前的時段
+    assert _times(reflow(PLAN[1:], 21 * 60 + 30, 15)) == ["21:30", "22:00"]
+    # 連錨點都來不及: 全部順延
+    assert _times(reflow(PLAN[3:], 22 * 60 + 30, 15)) == ["22:30", "23:59"]
+    print("   ✅ passed")
+
+async def _run_repair():
+    repairer = PlanRepairer(fake_embed, similarity=0.5, debounce_minutes=60, min_block_minutes=15)
+    now = datetime(2025, 6, 1, 8, 45)
+
+    # 早餐超時 30 分鐘: 本地修正，寫論文順延並壓縮
+    outcome, plan = await repairer.repair(PLAN, now, now + timedelta(minutes=45), "慢慢吃完早餐")
+    assert outcome == REPAIRED
+    assert _times(plan)[:3] == ["08:00", "09:30", "12:23"] and plan[-1]["start_time"] == "22:00"
+    assert all("calculated_end_time" not in b for b in plan)
+
+    # 提早開始下一個時段，並移除已經過去的時段
+    outcome, plan = await repairer.repair(PLAN, now, now + timedelta(minutes=15), "開始寫論文")
+    assert outcome == REPAIRED and _times(plan)[:2] == ["08:45", "12:00"]
+
+    # 語意不同: 交給 LLM；一小時內再次要求則只做本地修正
+    outcome, plan = await repairer.repair(PLAN, now, now + timedelta(minutes=15), "逃離火災")
+    assert outcome == ESCALATE and plan is None
+    later = now + timedelta(minutes=30)
+    outcome, plan = await repairer.repair(PLAN, later, later + timedelta(minutes=15), "逃離火災")
+    assert outcome == DEBOUNCED and plan[0]["activity"] == "寫論文" # 吃早餐已經過去
+    later = now + timedelta(minutes=90)
+    outcome, _ = await repairer.repair(PLAN, later, later + timedelta(minutes=15), "逃離火災")
+    assert outcome == ESCALATE
+
+def test_repair_decisions():
+    print("🧪 PlanRepairer")
+    asyncio.run(_run_repair())
+    print("   ✅ passed")
+
+if __name__ == "__main__":
+    test_reflow()
+    test_repair_decisions()
@@ -0,0 +1,85 @@
+import sys
+import os
+import asyncio
+
+import numpy as np
+
+# 加入路徑
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src.config import config
+from src.agent.plan_repair import PlanRepairer
+from src.agent.similarity import embed_for_similarity
+
+# 用真正的 embedding 模型驗證 PLAN_REPAIR_SIMILARITY / PLAN_CACHE_THRESHOLD 的門檻
+# (行動描述, 計畫活動): 同一件事要高於門檻，不同的事要低於門檻
+SAME_ACTIVITY = [
+    ("在圖書館寫論文", "寫論文"),
+    ("在廚房吃早餐", "吃早餐"),
+    ("去教室上課", "上課"),
+    ("回房間睡覺", "睡覺"),
+]
+DIFFERENT_ACTIVITY = [
+    ("逃離火災現場", "寫論文"),
+    ("吃早餐", "上課"),
+    ("在圖書館寫論文", "睡覺"),
+    ("去教室上課", "吃午餐"),
+]
+
+# 計畫快取: 只有幾乎相同的活動才能重用子任務 (早餐和晚餐的時段、地點都不一樣)
+CACHE_HIT = [
+    ("吃早餐", "吃早餐"),
+    ("在圖書館寫論文", "在圖書館寫論文"),
+]
+CACHE_MISS = [
+    ("吃早餐", "吃晚餐"),
+    ("吃早餐", "吃午餐"),
+]
+
+def _model_available() -> bool:
+    try:
+        from src.llm_factory import get_similarity_embeddings
+        get_similarity_embeddings().embed_query("warmup")
+        return True
+    except Exception as e:
+        print(f"   ⏭️ skipped: 無法載入 {config.PLAN_SIMILARITY_MODEL_NAME} ({e})")
+        return False
+
+async def _run_repair_threshold():
+    repairer = PlanRepairer(embed_for_similarity)
+    for action, activity in SAME_ACTIVITY:
+        score = await repairer._similar(action, activity)
+        assert score >= config.PLAN_REPAIR_SIMILARITY, (action, activity, score)
+    for action, activity in DIFFERENT_ACTIVITY:
+        score = await repairer._similar(action, activity)
+        assert score < config.PLAN_REPAIR_SIMILARITY, (action, activity, score)
+
+async def _cosine(a: str, b: str) -> float:
+    va, vb = await embed_for_similarity(a), await embed_for_similarity(b)
+    return float(va @ vb / (np.linalg.norm(va) * np.linalg.norm(vb)))
+
+async def _run_cache_threshold():
+    for a, b in CACHE_HIT:
+        score = await _cosine(a, b)
+        assert score >= config.PLAN_CACHE_THRESHOLD, (a, b, score)
+    for a, b in CACHE_MISS:
+        score = await _cosine(a, b)
+        assert score < config.PLAN_CACHE_THRESHOLD, (a, b, score)
+
+def test_repair_threshold():
+    print("🧪 PLAN_REPAIR_SIMILARITY 門檻 (真實模型)")
+    if not _model_available():
+        return
+    asyncio.run(_run_repair_threshold())
+    print("   ✅ passed")
+
+def test_cache_threshold():
+    print("🧪 PLAN_CACHE_THRESHOLD 門檻 (真實模型)")
+    if not _model_available():
+        return
+    asyncio.run(_run_cache_threshold())
+    print("   ✅ passed")
+
+if __name__ == "__main__":
+    test_repair_threshold()
+    test_cache_threshold()
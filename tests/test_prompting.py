@@ -0,0 +1,70 @@
+import sys
+import os
+
+# 加入路徑
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from langchain_core.documents import Document
+from src.agent.prompting import ContextBudget, Section, count_tokens, get_prompt, memory_lines
+
+def test_dedupe_and_section_budget():
+    print("🧪 ContextBudget section budget")
+    memories = [
+        Document(page_content="計畫:\n08:00: 起床\n09:00: 寫論文"),
+        Document(page_content="修正計畫:\n08:00: 起床\n10:00: 去圖書館"),
+        Document(page_content="計畫:"),
+    ]
+    lines = memory_lines(memories)
+    ctx = ContextBudget("test", max_tokens=10_000).fit([
+        Section("memories", lines, max_tokens=1000, dedupe=True),
+    ])
+    # 重複的行 (包含不同項目符號的同一句) 只保留第一次出現
+    assert ctx["memories"].splitlines() == ["- 計畫:", "  08:00: 起床", "  09:00: 寫論文", "- 修正計畫:", "  10:00: 去圖書館"]
+
+    long_lines = [f"- 第 {i} 條記憶，內容很長很長很長很長" for i in range(50)]
+    ctx = ContextBudget("test", max_tokens=10_000).fit([Section("memories", long_lines, max_tokens=100)])
+    assert count_tokens(ctx["memories"]) <= 100
+    assert ctx["memories"].splitlines()[0] == long_lines[0] # 從後面截斷
+
+    # 單一行就超過區塊上限: 截斷那一行，而不是整個區塊變成空的
+    ctx = ContextBudget("test", max_tokens=10_000).fit([Section("plan", ["計" * 500], max_tokens=100)])
+    assert ctx["plan"].startswith("計") and ctx["plan"].endswith("…")
+    assert count_tokens(ctx["plan"]) + 1 <= 100
+    print("   ✅ passed")
+
+def test_priority_truncation():
+    print("🧪 ContextBudget priority")
+    obs = [f"觀察 {i}: 某人在做某事" for i in range(10)]
+    mem = [f"- 記憶 {i}: 很久以前發生的事情" for i in range(40)]
+    ctx = ContextBudget("test", max_tokens=300).fit([
+        Section("observations", obs, max_tokens=500, priority=0),
+        Section("memories", mem, max_tokens=500, priority=2, empty="(無)"),
+    ])
+    # 超出總預算時，先縮減 priority 大的區塊，重要的區塊完整保留
+    assert ctx["observations"] == "\n".join(obs)
+    assert 0 < len(ctx["memories"].splitlines()) < len(mem)
+    assert count_tokens(ctx["observations"]) + count_tokens(ctx["memories"]) <= 300
+    print("   ✅ passed")
+
+def test_template_cache():
+    print("🧪 get_prompt cache")
+    assert get_prompt("你是 {agent_name}") is get_prompt("你是 {agent_name}")
+    print("   ✅ passed")
+
+def test_stable_prefix():
+    print("🧪 get_prompt system prefix")
+    prompt = get_prompt("時間: {current_time}\n{observations}", "你是 {agent_name}。\n{world_desc}")
+    ticks = [
+        prompt.format_messages(agent_name="Klaus", world_desc="- bedroom", current_time=t, observations=o)
+        for t, o in [("08:00 AM", "床是鋪好的"), ("08:15 AM", "Maria 向你打招呼")]
+    ]
+    # 每個 tick 變動的內容只出現在最後一則訊息，system 前綴完全相同
+    assert ticks[0][0] == ticks[1][0] and ticks[0][0].type == "system"
+    assert ticks[0][1] != ticks[1][1]
+    print("   ✅ passed")
+
+if __name__ == "__main__":
+    test_dedupe_and_section_budget()
+    test_priority_truncation()
+    test_template_cache()
+    test_stable_prefix()
@@ -0,0 +1,57 @@
+import sys
+import os
+import time
+
+import numpy as np
+
+# 加入路徑
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src.memory.numpy_store import NumpyMemoryStore
+
+def _clustered_vectors(n: int, dim: int = 384, clusters: int = 200, seed: int = 0) -> np.ndarray:
+    """模擬 MiniLM 向量: 很多語意相近 (同一群) 的記憶"""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dim)).astype(np.float32)
+    labels = rng.integers(0, clusters, n)
+    vectors = centers[labels] + 0.35 * rng.standard_normal((n, dim)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+def _measure(vector_dtype: str, n: int = 20000, queries: int = 100, k: int = 10):
+    vectors = _clustered_vectors(n)
+    ids = [f"m{i}" for i in range(n)]
+    metas = [{"id": i, "created_at": 0.0, "importance": 1, "type": "observation"} for i in ids]
+
+    store = NumpyMemoryStore(vector_dtype=vector_dtype)
+    store.add(ids, [""] * n, vectors, metas)
+
+    query_vecs = _clustered_vectors(queries, seed=1)
+    # 正確答案: float32 暴力搜尋
+    truth = np.argsort(-(query_vecs @ vectors.T), axis=1)[:, :k]
+
+    hits = 0
+    start = time.time()
+    for q, expected in zip(query_vecs, truth):
+        got = {int(doc.metadata["id"][1:]) for doc, _ in store.knn(q, k)}
+        hits += len(got & set(expected.tolist()))
+    elapsed = (time.time() - start) / queries
+
+    footprint = sum(store.memory_footprint().values())
+    return hits / (queries * k), footprint, elapsed
+
+def test_quantized_recall():
+    print("========================================")
+    print("📐 QUANTIZED EMBEDDING RECALL")
+    print("========================================")
+    _, base_bytes, base_ms = _measure("float32")
+    print(f"   float32: {base_bytes / 1e6:.1f} MB, {base_ms * 1000:.2f} ms/query")
+
+    for dtype, min_ratio in (("float16", 1.7), ("int8", 3.0)):
+        recall, nbytes, ms = _measure(dtype)
+        ratio = base_bytes / nbytes
+        print(f"   {dtype}: recall@10 = {recall:.3f}, {nbytes / 1e6:.1f} MB ({ratio:.1f}x smaller), {ms * 1000:.2f} ms/query")
+        assert recall >= 0.98, f"{dtype} recall too low: {recall}"
+        assert ratio >= min_ratio
+
+if __name__ == "__main__":
+    test_quantized_recall()
@@ -0,0 +1,62 @@
+import sys
+import os
+import json
+import asyncio
+import tempfile
+
+# 加入路徑
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from src import tracing
+from src.tracing import enable_tracing, export_chrome_trace, span, tick_breakdowns, traced
+
+@traced("work", cat="test")
+async def _work(seconds: float):
+    with span("io", cat="test"):
+        await asyncio.sleep(seconds)
+
+async def _tick():
+    with span("tick", cat="tick", agent="Klaus"):
+        # gather 出去的 task 也要接在 tick 底下
+        await asyncio.gather(_work(0.02), _work(0.01))
+
+def test_disabled_is_noop():
+    print("🧪 tracing disabled")
+    enable_tracing(False)
+    tracing._tracer = tracing._Tracer(max_spans=1000)
+    asyncio.run(_tick())
+    assert not tracing._tracer.spans and not tick_breakdowns()
+    print("   ✅ passed")
+
+def test_tick_breakdown_and_export():
+    print("🧪 tracing tick breakdown")
+    enable_tracing(True)
+    tracing._tracer = tracing._Tracer(max_spans=1000)
+    try:
+        asyncio.run(_tick())
+        breakdown = tick_breakdowns()[-1]
+        assert breakdown["agent"] == "Klaus"
+        assert breakdown["spans"]["work"]["count"] == 2 and breakdown["spans"]["io"]["count"] == 2
+        # work 的時間幾乎都花在子 span io
+        assert breakdown["spans"]["work"]["self_ms"] < breakdown["spans"]["io"]["total_ms"]
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "trace.json")
+            assert export_chrome_trace(path) == 5
+            with open(path, encoding="utf-8") as f:
+                events = [e for e in json.load(f)["traceEvents"] if e["ph"] == "X"]
+        by_id = {e["args"]["span_id"]: e for e in events}
+        for e in events:
+            parent = e["args"]["parent_id"]
+            if parent is not None:
+                # 子 span 在父 span 的時間範圍內
+                assert by_id[parent]["ts"] <= e["ts"] <= by_id[parent]["ts"] + by_id[parent]["dur"]
+        assert {e["name"] for e in events if e["args"]["parent_id"] is None} == {"tick"}
+    finally:
+        enable_tracing(False)
+        tracing._tracer.clear()
+    print("   ✅ passed")
+
+if __name__ == "__main__":
+    test_disabled_is_noop()
+    test_tick_breakdown_and_export()